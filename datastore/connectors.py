@@ -1,8 +1,11 @@
 import os
 import json
+import time
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
 from mongoengine import connect
 
-from datastore.models import Product, ProductPricingModel, CustomerSegment, PricingPlanSegmentContribution, CustomerUsageAnalysis, ProductPricingMapping, OrchestrationResult, Competitors
+from datastore.models import Product, ProductPricingModel, CustomerSegment, PricingPlanSegmentContribution, CustomerUsageAnalysis, ProductPricingMapping, OrchestrationResult, Competitors, AgentResponseCache, RecommendedPricingModel, PricingModelAIGapDiagnosis, RateLimitWindow
 
 
 
@@ -27,31 +30,28 @@ MODEL_MAP = {
     "customersegment": CustomerSegment,
     "customerusageanalysis": CustomerUsageAnalysis,
     "orchestrationresult": OrchestrationResult,
+    "agentresponsecache": AgentResponseCache,
 }
 
 
-def create_pricing_plan_segment_contribution(product, segment, pricing_model, d=None):
-    number_active = 0
-    number_forecast = 0
-    if d:
-        try:
-            number_active = int(d.get("number_of_active_subscriptions", 0) or 0)
-        except Exception:
-            number_active = 0
-        try:
-            number_forecast = int(d.get("number_of_active_subscriptions_forecast", 0) or 0)
-        except Exception:
-            number_forecast = 0
+# Documents per insert_many call when importing JSON files
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
 
-    contribution = PricingPlanSegmentContribution(
+
+def build_pricing_plan_segment_contribution(product, segment, pricing_model):
+    # The segment's subscription counts in the JSON have no field on
+    # PricingPlanSegmentContribution; revenue and subscription series are filled in later
+    return PricingPlanSegmentContribution(
         product=product,
         customer_segment=segment,
         pricing_plan=pricing_model,
-        number_of_active_subscriptions=number_active,
-        number_of_active_subscriptions_forecast=number_forecast,
         revenue_ts_data=[],
         revenue_forecast_ts_data=[],
     )
+
+
+def create_pricing_plan_segment_contribution(product, segment, pricing_model):
+    contribution = build_pricing_plan_segment_contribution(product, segment, pricing_model)
     contribution.save()
     return contribution
 
@@ -84,31 +84,39 @@ def create_product_from_dict(d):
     return product
 
 
-def create_pricing_model_from_dict(d):
-    pricing_model = ProductPricingModel(
+def build_pricing_model_from_dict(d):
+    return ProductPricingModel(
         plan_name=d.get("plan_name", ""),
         unit_price=float(d.get("unit_price", 99.0)),
         min_unit_count=int(d.get("min_unit_count", 1)),
         unit_calculation_logic=d.get("unit_calculation_logic", "per_seat"),
         min_unit_utilization_period=d.get("min_unit_utilization_period", "monthly"),
     )
+
+
+def create_pricing_model_from_dict(d):
+    pricing_model = build_pricing_model_from_dict(d)
     pricing_model.save()
     return pricing_model
 
 
-def create_customer_segment_from_dict(product, d):
-    segment = CustomerSegment(
+def build_customer_segment_from_dict(product, d):
+    return CustomerSegment(
         product=product,
         customer_segment_uid=d.get("customer_segment_uid"),
         customer_segment_name=d.get("customer_segment_name"),
         customer_segment_description=d.get("customer_segment_description", ""),
     )
+
+
+def create_customer_segment_from_dict(product, d):
+    segment = build_customer_segment_from_dict(product, d)
     segment.save()
     return segment
 
 
-def create_customer_usage_analysis_from_dict(product, segment, d):
-    usage = CustomerUsageAnalysis(
+def build_customer_usage_analysis_from_dict(product, segment, d):
+    return CustomerUsageAnalysis(
         product=product,
         customer_segment=segment,
         customer_uid=d.get("customer_uid"),
@@ -116,66 +124,293 @@ def create_customer_usage_analysis_from_dict(product, segment, d):
         predicted_customer_satisfaction_response=float(d.get("predicted_customer_satisfaction_response", 0.0)),
         predicted_customer_satisfaction_response_reasoning=d.get("predicted_customer_satisfaction_response_reasoning", ""),
     )
+
+
+def create_customer_usage_analysis_from_dict(product, segment, d):
+    usage = build_customer_usage_analysis_from_dict(product, segment, d)
     usage.save()
     return usage
 
 
-def create_product_pricing_mapping(product, pricing_model, is_active="true"):
-    mapping = ProductPricingMapping(
+def build_product_pricing_mapping(product, pricing_model, is_active="true"):
+    return ProductPricingMapping(
         product=product,
         pricing_model=pricing_model,
         is_active=is_active,
     )
+
+
+def create_product_pricing_mapping(product, pricing_model, is_active="true"):
+    mapping = build_product_pricing_mapping(product, pricing_model, is_active)
     mapping.save()
     return mapping
 
 
-def create_from_json_file(path):
-    with open(path, "r") as f:
+class BulkWriter:
+    """Buffers new documents per collection and writes each batch with one unordered insert_many
+
+    Documents get their ObjectId when added, so later documents can reference
+    them before anything has been written.
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = max(1, batch_size or BULK_BATCH_SIZE)
+        self.buffers = {}
+        self.stats = {}
+        self.started = time.monotonic()
+
+    def add(self, document):
+        if document.id is None:
+            document.id = ObjectId()
+        document.validate()
+        model = type(document)
+        buffer = self.buffers.setdefault(model, [])
+        buffer.append(document.to_mongo())
+        if len(buffer) >= self.batch_size:
+            self.flush(model)
+        return document
+
+    def flush(self, model):
+        buffer = self.buffers.pop(model, None)
+        if not buffer:
+            return
+        name = model._get_collection_name()
+        stats = self.stats.setdefault(name, {"documents": 0, "batches": 0, "errors": 0, "seconds": 0.0})
+        started = time.monotonic()
+        try:
+            # Unordered: one bad document does not stop the rest of the batch
+            model._get_collection().insert_many(buffer, ordered=False)
+            errors = 0
+        except BulkWriteError as e:
+            errors = len(e.details.get("writeErrors", []))
+        stats["documents"] += len(buffer) - errors
+        stats["errors"] += errors
+        stats["batches"] += 1
+        stats["seconds"] += time.monotonic() - started
+
+    def close(self):
+        """Write everything still buffered and return per-collection counts with overall throughput"""
+        for model in list(self.buffers):
+            self.flush(model)
+        elapsed = time.monotonic() - self.started
+        documents = sum(stats["documents"] for stats in self.stats.values())
+        return {
+            "collections": self.stats,
+            "documents": documents,
+            "errors": sum(stats["errors"] for stats in self.stats.values()),
+            "seconds": elapsed,
+            "documents_per_second": documents / elapsed if elapsed > 0 else 0.0,
+        }
+
+
+def format_load_report(stats):
+    lines = []
+    lines.append("| collection | documents | batches | errors | docs/s |")
+    lines.append("|---|---|---|---|---|")
+    for name, collection in stats["collections"].items():
+        rate = collection["documents"] / collection["seconds"] if collection["seconds"] > 0 else 0.0
+        lines.append(f"| {name} | {collection['documents']} | {collection['batches']} | {collection['errors']} | {rate:,.0f} |")
+    lines.append(f"| total | {stats['documents']} | | {stats['errors']} | {stats['documents_per_second']:,.0f} |")
+    lines.append("")
+    lines.append(f"Loaded {stats['documents']} documents in {stats['seconds']:.2f}s")
+    return "\n".join(lines)
+
+
+def create_from_json_file(path, batch_size=None, stream=False):
+    product, created_pricing_models, created_segments, _ = bulk_load_json_file(path, batch_size, stream)
+    return product, created_pricing_models, created_segments
+
+
+def bulk_load_json_file(path, batch_size=None, stream=False):
+    """Import a product JSON or NDJSON file, writing everything but the product itself with batched insert_many
+
+    With stream=True (and always for .ndjson/.jsonl files) the file is parsed
+    incrementally, so memory stays flat however many usage analyses it holds.
+    Returns the product, pricing models, segments and the BulkWriter load stats.
+    """
+    with open(path, "rb") as f:
+        if path.endswith(NDJSON_SUFFIXES):
+            return _load_records(_ndjson_records(f), batch_size)
+        if stream:
+            return _load_records(_streamed_json_records(f), batch_size)
         payload = json.load(f)
 
     product_data = payload.get("product", {})
-    pricing_models_data = payload.get("pricing_models", [])
-    customer_segments = payload.get("customer_segments", [])
-
     if not product_data or not product_data.get("name"):
         raise ValueError("product.name is required in JSON payload")
 
-    if not pricing_models_data:
+    if not payload.get("pricing_models", []):
         raise ValueError("pricing_models array is required in JSON payload")
 
-    product = create_product_from_dict(product_data)
+    return _load_records(_payload_records(payload), batch_size)
 
-    created_pricing_models = []
-    pricing_model_map = {}
-    for pricing_data in pricing_models_data:
-        pricing_model = create_pricing_model_from_dict(pricing_data)
-        pricing_model_id = str(pricing_model.id)
-        pricing_model_map[pricing_model_id] = pricing_model
-        created_pricing_models.append(pricing_model)
 
-        # Create product-pricing mapping
-        create_product_pricing_mapping(product, pricing_model)
+NDJSON_SUFFIXES = (".ndjson", ".jsonl")
+NDJSON_RECORD_TYPES = ("product", "pricing_model", "customer_segment", "usage_analysis")
 
-    created_segments = []
-    for seg in customer_segments:
-        segment = create_customer_segment_from_dict(product, seg)
+# Import records are (kind, dict) pairs: "product", "pricing_model", then per
+# segment "segment_start", its "usage_analysis" items and the
+# "customer_segment" itself, whose fields may only be complete after its usage
+# analyses when the file is streamed
 
-        pricing_model_indices = seg.get("pricing_model_ids", [])
-        if not pricing_model_indices:
-            pricing_model_indices = list(range(len(created_pricing_models)))
 
-        for index in pricing_model_indices:
-            if isinstance(index, int) and 0 <= index < len(created_pricing_models):
-                create_pricing_plan_segment_contribution(product, segment, created_pricing_models[index], seg)
-            elif isinstance(index, str) and index in pricing_model_map:
-                create_pricing_plan_segment_contribution(product, segment, pricing_model_map[index], seg)
+def _segment_records(seg):
+    yield "segment_start", None
+    for usage in seg.get("usage_analyses", []) or []:
+        yield "usage_analysis", usage
+    yield "customer_segment", seg
 
-        for usage in seg.get("usage_analyses", []) or []:
-            create_customer_usage_analysis_from_dict(product, segment, usage)
-        created_segments.append(segment)
 
-    return product, created_pricing_models, created_segments
+def _payload_records(payload):
+    yield "product", payload.get("product", {})
+    for pricing_data in payload.get("pricing_models", []):
+        yield "pricing_model", pricing_data
+    for seg in payload.get("customer_segments", []):
+        yield from _segment_records(seg)
+
+
+_STREAMED_RECORD_PREFIXES = {
+    "product": "product",
+    "pricing_models.item": "pricing_model",
+    "customer_segments.item.usage_analyses.item": "usage_analysis",
+}
+_SEGMENT_PREFIX = "customer_segments.item"
+_USAGE_PREFIX = "customer_segments.item.usage_analyses"
+
+
+def _streamed_json_records(f):
+    """Records from a product JSON file, parsed incrementally with ijson
+
+    Only one usage analysis, pricing model or segment (without its usage
+    analyses) is held in memory at a time.
+    """
+    import ijson
+    from ijson.common import ObjectBuilder
+
+    record = None
+    segment = None
+    for prefix, event, value in ijson.parse(f, use_float=True):
+        if record is not None:
+            record_prefix, kind, builder = record
+            builder.event(event, value)
+            if prefix == record_prefix and event == "end_map":
+                yield kind, builder.value
+                record = None
+            continue
+        if event == "start_map" and prefix in _STREAMED_RECORD_PREFIXES:
+            builder = ObjectBuilder()
+            builder.event(event, value)
+            record = (prefix, _STREAMED_RECORD_PREFIXES[prefix], builder)
+            continue
+        if prefix == _SEGMENT_PREFIX and event == "start_map":
+            segment = ObjectBuilder()
+            segment.event(event, value)
+            yield "segment_start", None
+            continue
+        if segment is None:
+            continue
+        # Usage analyses are streamed above, not collected into the segment
+        if prefix == _USAGE_PREFIX or prefix.startswith(_USAGE_PREFIX + ".") or (prefix == _SEGMENT_PREFIX and event == "map_key" and value == "usage_analyses"):
+            continue
+        segment.event(event, value)
+        if prefix == _SEGMENT_PREFIX and event == "end_map":
+            yield "customer_segment", segment.value
+            segment = None
+
+
+def _ndjson_records(f):
+    """Records from an NDJSON file of objects with a "type" of product, pricing_model, customer_segment or usage_analysis
+
+    usage_analysis lines name their segment with customer_segment_uid.
+    """
+    for line_number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"Line {line_number}: invalid JSON ({e})")
+        kind = record.pop("type", None) if isinstance(record, dict) else None
+        if kind not in NDJSON_RECORD_TYPES:
+            raise ValueError(f"Line {line_number}: type must be one of {', '.join(NDJSON_RECORD_TYPES)}")
+        if kind == "customer_segment":
+            yield from _segment_records(record)
+        else:
+            yield kind, record
+
+
+def _load_records(records, batch_size=None):
+    product = None
+    writer = BulkWriter(batch_size)
+
+    created_pricing_models = []
+    pricing_model_map = {}
+    created_segments = []
+    segments_by_uid = {}
+    segment = None
+    for kind, data in records:
+        if kind == "product":
+            if product is not None:
+                raise ValueError("Only one product can be imported per file")
+            if not data or not data.get("name"):
+                raise ValueError("product.name is required in JSON payload")
+            # The product is saved on its own: its save() hook builds the vector stores
+            product = create_product_from_dict(data)
+            continue
+        if product is None:
+            raise ValueError("product must come before pricing models and customer segments")
+
+        if kind == "pricing_model":
+            pricing_model = writer.add(build_pricing_model_from_dict(data))
+            pricing_model_id = str(pricing_model.id)
+            pricing_model_map[pricing_model_id] = pricing_model
+            created_pricing_models.append(pricing_model)
+
+            # Create product-pricing mapping
+            writer.add(build_product_pricing_mapping(product, pricing_model))
+
+        elif kind == "segment_start":
+            if not created_pricing_models:
+                raise ValueError("pricing_models must come before customer_segments")
+            # Usage analyses may arrive before the segment's own fields, so
+            # they reference a placeholder carrying the segment's id
+            segment = CustomerSegment(product=product)
+            segment.id = ObjectId()
+
+        elif kind == "usage_analysis":
+            target = segment or segments_by_uid.get(data.get("customer_segment_uid"))
+            if target is None:
+                raise ValueError(f"Usage analysis for unknown customer segment {data.get('customer_segment_uid')!r}")
+            writer.add(build_customer_usage_analysis_from_dict(product, target, data))
+
+        elif kind == "customer_segment":
+            seg = data
+            placeholder, segment = segment, None
+            segment_doc = build_customer_segment_from_dict(product, seg)
+            segment_doc.id = placeholder.id
+            writer.add(segment_doc)
+
+            pricing_model_indices = seg.get("pricing_model_ids", [])
+            if not pricing_model_indices:
+                pricing_model_indices = list(range(len(created_pricing_models)))
+
+            for index in pricing_model_indices:
+                if isinstance(index, int) and 0 <= index < len(created_pricing_models):
+                    writer.add(build_pricing_plan_segment_contribution(product, segment_doc, created_pricing_models[index]))
+                elif isinstance(index, str) and index in pricing_model_map:
+                    writer.add(build_pricing_plan_segment_contribution(product, segment_doc, pricing_model_map[index]))
+
+            created_segments.append(segment_doc)
+            if segment_doc.customer_segment_uid:
+                segments_by_uid[segment_doc.customer_segment_uid] = segment_doc
+
+    if product is None:
+        raise ValueError("product.name is required in JSON payload")
+    if not created_pricing_models:
+        raise ValueError("pricing_models array is required in JSON payload")
+
+    return product, created_pricing_models, created_segments, writer.close()
 
 def delete_one(collection_name, doc_id):
     key = normalize_collection_name(collection_name)
@@ -223,6 +458,92 @@ def list_all_ids(collection_name):
     return [str(d.id) for d in docs]
 
 
+# Every model with indexes declared in its meta
+INDEXED_MODELS = list(MODEL_MAP.values()) + [RecommendedPricingModel, PricingModelAIGapDiagnosis, RateLimitWindow]
+
+
+def ensure_indexes():
+    """Build every declared index (existing ones are left as they are); returns {collection: [index names]}"""
+    built = {}
+    for Model in INDEXED_MODELS:
+        Model.ensure_indexes()
+        built[Model._get_collection_name()] = sorted(Model._get_collection().index_information())
+    return built
+
+
+def _hot_queries(product_id=None):
+    """The lookups the agents run on every orchestration, against a real product and segment where there is one"""
+    product = ObjectId(product_id) if product_id else getattr(Product.objects.only("id").first(), "id", None) or ObjectId()
+    segment = CustomerSegment.objects(product=product).only("id", "customer_segment_uid", "customer_segment_name").first()
+    segment_id = segment.id if segment else ObjectId()
+    invocation = OrchestrationResult.objects.only("invocation_id").first()
+    return [
+        ("CustomerSegment by product and uid", CustomerSegment.objects(product=product, customer_segment_uid=getattr(segment, "customer_segment_uid", ""))),
+        ("CustomerSegment by product and name", CustomerSegment.objects(product=product, customer_segment_name=getattr(segment, "customer_segment_name", ""))),
+        ("PricingPlanSegmentContribution by product and segments", PricingPlanSegmentContribution.objects(product=product, customer_segment__in=[segment_id])),
+        ("CustomerUsageAnalysis by product", CustomerUsageAnalysis.objects(product=product)),
+        ("CustomerUsageAnalysis by product and segment", CustomerUsageAnalysis.objects(product=product, customer_segment=segment_id)),
+        ("ProductPricingMapping by product", ProductPricingMapping.objects(product=product)),
+        ("OrchestrationResult by invocation", OrchestrationResult.objects(invocation_id=getattr(invocation, "invocation_id", "")).order_by("step_order")),
+    ]
+
+
+def _plan_stages(plan):
+    """Stages of a winning plan from the root down, and the index it reads"""
+    # Plans run by the slot-based engine nest the classic plan under queryPlan
+    plan = plan.get("queryPlan", plan)
+    stages, index = [], None
+    while plan:
+        stages.append(plan.get("stage", "?"))
+        index = index or plan.get("indexName")
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return stages, index
+
+
+def explain_queries(product_id=None):
+    """Query plans for the hot-path lookups: stages, index used, keys and documents examined"""
+    plans = []
+    for name, queryset in _hot_queries(product_id):
+        try:
+            explain = queryset.explain()
+        except Exception as e:
+            plans.append({"query": name, "error": str(e)})
+            continue
+        stages, index = _plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        execution = explain.get("executionStats", {})
+        plans.append({
+            "query": name,
+            "stages": " <- ".join(stages),
+            "index": index,
+            "collection_scan": "COLLSCAN" in stages,
+            "returned": execution.get("nReturned"),
+            "keys_examined": execution.get("totalKeysExamined"),
+            "docs_examined": execution.get("totalDocsExamined"),
+            "millis": execution.get("executionTimeMillis"),
+        })
+    return plans
+
+
+def format_index_report(built, plans):
+    lines = ["## Indexes", ""]
+    for collection, names in built.items():
+        lines.append(f"- {collection}: {', '.join(names) or '(collection not created yet)'}")
+    lines += ["", "## Query plans", ""]
+    lines.append("| query | plan | index | returned | keys examined | docs examined | ms |")
+    lines.append("|---|---|---|---|---|---|---|")
+    for plan in plans:
+        if "error" in plan:
+            lines.append(f"| {plan['query']} | explain failed: {plan['error']} | | | | | |")
+            continue
+        cells = [plan[key] for key in ("returned", "keys_examined", "docs_examined", "millis")]
+        cells = " | ".join("" if cell is None else str(cell) for cell in cells)
+        lines.append(f"| {plan['query']} | {plan['stages']} | {plan['index'] or '-'} | {cells} |")
+    scans = [plan["query"] for plan in plans if plan.get("collection_scan")]
+    if scans:
+        lines += ["", f"Collection scans: {', '.join(scans)}"]
+    return "\n".join(lines)
+
+
 def _to_plain_value(v):
     try:
         if isinstance(v, (dict, list)):
@@ -4,6 +4,7 @@ import tempfile
 import requests
 from utils.openai_client import openai_client
 from mongoengine import ReferenceField, DateTimeField, DynamicField, EmbeddedDocumentListField
+from mongoengine import BinaryField, EmbeddedDocumentField, MapField
 from mongoengine import Document, EmbeddedDocument, StringField, FloatField, IntField, ListField, URLField
 
 class Competitors(EmbeddedDocument):
@@ -357,21 +358,47 @@ class ProductPricingMapping(Document):
     is_active = StringField(default="true")
     created_at = DateTimeField(default=datetime.utcnow)
 
+    meta = {
+        'indexes': [
+            ('product', 'pricing_model'),
+        ]
+    }
+
 class PricingModelAIGapDiagnosis(Document):
     pricing_model = ReferenceField(ProductPricingModel)
     ai_gap_diagnosis_summary = StringField()
     ai_gap_diagnosis_reasoning = StringField()
 
+    meta = {
+        'indexes': [
+            'pricing_model',
+        ]
+    }
+
 class TimeseriesData(EmbeddedDocument):
     date = DateTimeField()
     value = FloatField()
 
+class TimeseriesColumn(EmbeddedDocument):
+    # One series as packed little-endian arrays: int64 epoch milliseconds and
+    # float64 values; read and written through datastore.timeseries
+    dates = BinaryField()
+    values = BinaryField()
+    count = IntField()
+
 class CustomerSegment(Document):
     product = ReferenceField(Product)
     customer_segment_uid = StringField()
     customer_segment_name = StringField()
     customer_segment_description = StringField()
 
+    meta = {
+        'indexes': [
+            ('product', 'customer_segment_uid'),
+            ('product', 'customer_segment_name'),
+        ]
+    }
+
 class PricingPlanSegmentContribution(Document):
     product = ReferenceField(Product)
     customer_segment = ReferenceField(CustomerSegment)
@@ -380,6 +407,14 @@ class PricingPlanSegmentContribution(Document):
     active_subscriptions = EmbeddedDocumentListField(TimeseriesData)
     revenue_forecast_ts_data = EmbeddedDocumentListField(TimeseriesData)
     active_subscriptions_forecast = EmbeddedDocumentListField(TimeseriesData)
+    # The same series in the columnar backend, keyed by the field names above
+    timeseries_columns = MapField(EmbeddedDocumentField(TimeseriesColumn))
+
+    meta = {
+        'indexes': [
+            ('product', 'customer_segment', 'pricing_plan'),
+        ]
+    }
 
 class CustomerUsageAnalysis(Document):
     product = ReferenceField(Product)
@@ -388,13 +423,25 @@ class CustomerUsageAnalysis(Document):
     customer_task_to_agent = StringField()
     predicted_customer_satisfaction_response = FloatField()
     predicted_customer_satisfaction_response_reasoning = StringField()
-    
+
+    meta = {
+        'indexes': [
+            ('product', 'customer_segment'),
+        ]
+    }
+
 class RecommendedPricingModel(Document):
     product = ReferenceField(Product)
     customer_segment = ReferenceField(CustomerSegment)
     pricing_plan = ReferenceField(ProductPricingModel)
     new_revenue_forecast_ts_data = EmbeddedDocumentListField(TimeseriesData)
 
+    meta = {
+        'indexes': [
+            ('product', 'customer_segment'),
+        ]
+    }
+
 class OrchestrationResult(Document):
     invocation_id = StringField(required=True)
     step_name = StringField(required=True)
@@ -402,6 +449,8 @@ class OrchestrationResult(Document):
     product_id = StringField()
     step_input = DynamicField()
     step_output = DynamicField()
+    # Per-call model usage (tokens, tool calls, latency, cost); per-agent totals on the state document
+    llm_usage = DynamicField()
     created_at = DateTimeField(default=datetime.utcnow)
 
     meta = {
@@ -409,4 +458,33 @@ class OrchestrationResult(Document):
             'invocation_id',
             ('invocation_id', 'step_order'),
         ]
-    }
\ No newline at end of file
+    }
+
+class AgentResponseCache(Document):
+    cache_key = StringField(required=True, unique=True)
+    agent_name = StringField()
+    model = StringField()
+    response = StringField()
+    created_at = DateTimeField(default=datetime.utcnow)
+    expires_at = DateTimeField()
+
+    meta = {
+        'indexes': [
+            'agent_name',
+            {'fields': ['expires_at'], 'expireAfterSeconds': 0},
+        ]
+    }
+
+class RateLimitWindow(Document):
+    key = StringField(required=True, unique=True)
+    model = StringField()
+    window_start = DateTimeField()
+    requests = IntField(default=0)
+    tokens = IntField(default=0)
+    expires_at = DateTimeField()
+
+    meta = {
+        'indexes': [
+            {'fields': ['expires_at'], 'expireAfterSeconds': 0},
+        ]
+    }
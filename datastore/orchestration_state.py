@@ -2,6 +2,39 @@ from datetime import datetime
 from typing import Optional, List, Dict, Any, Union
 from pydantic import BaseModel, Field
 from enum import Enum
+from utils.usage import summarize_calls
+
+# Orchestration dependency graph: each step lists the steps whose outputs it
+# actually consumes. A step can start as soon as all of them have completed.
+STEP_DEPENDENCIES: Dict[str, List[str]] = {
+    "product_offering": [],
+    "competitive_analysis": [],
+    "cashflow_analysis": [],
+    "pricing_analysis": [],
+    "segmentwise_roi": ["product_offering"],
+    "longterm_revenue": ["product_offering", "segmentwise_roi", "pricing_analysis"],
+    "value_capture_analysis": ["product_offering", "segmentwise_roi", "pricing_analysis"],
+    "experimental_pricing_recommendation": ["value_capture_analysis"],
+}
+
+# Dependencies a step can do without: if one of them fails or misses its
+# deadline, the step still runs (once it has finished) with that input marked
+# as not provided instead of being skipped.
+SOFT_DEPENDENCIES: Dict[str, List[str]] = {
+    "segmentwise_roi": ["product_offering"],
+    "longterm_revenue": ["product_offering", "pricing_analysis"],
+    "value_capture_analysis": ["product_offering"],
+}
+
+def to_serializable(value: Any) -> Any:
+    """Convert pydantic models, possibly nested in dicts/lists, into plain MongoDB-safe data"""
+    if hasattr(value, 'model_dump'):
+        return to_serializable(value.model_dump())
+    if isinstance(value, dict):
+        return {str(key): to_serializable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_serializable(item) for item in value]
+    return value
 
 class StepStatus(str, Enum):
     PENDING = "pending"
@@ -45,6 +78,19 @@ class RecommendedPricingModelResponse(BaseModel):
     unit_calculation_logic: str
     min_unit_utilization_period: str
 
+class LLMCallUsage(BaseModel):
+    agent_name: Optional[str] = None
+    kind: str = "response"
+    model: Optional[str] = None
+    input_tokens: int = 0
+    cached_tokens: int = 0
+    output_tokens: int = 0
+    reasoning_tokens: int = 0
+    tool_calls: int = 0
+    latency_seconds: float = 0.0
+    batched: bool = False
+    cost_usd: Optional[float] = None
+
 class StepResult(BaseModel):
     step_name: str
     step_order: int
@@ -54,6 +100,24 @@ class StepResult(BaseModel):
     error_message: Optional[str] = None
     step_input: Dict[str, Any] = Field(default_factory=dict)
     step_output: Optional[Union[str, Dict[str, Any]]] = None
+    # Background model responses submitted by this step: request fingerprint -> response id
+    background_jobs: Dict[str, str] = Field(default_factory=dict)
+    # Batch API requests submitted by this step: request fingerprint -> batch id
+    batch_jobs: Dict[str, str] = Field(default_factory=dict)
+    # Tokens, tool calls, wall time and cost of every model call this step made
+    llm_calls: List[LLMCallUsage] = Field(default_factory=list)
+
+    @property
+    def input_tokens(self) -> int:
+        return sum(call.input_tokens for call in self.llm_calls)
+
+    @property
+    def cached_tokens(self) -> int:
+        return sum(call.cached_tokens for call in self.llm_calls)
+
+    @property
+    def cost_usd(self) -> float:
+        return sum(call.cost_usd or 0 for call in self.llm_calls)
 
 class OrchestrationState(BaseModel):
     # Metadata
@@ -66,6 +130,8 @@ class OrchestrationState(BaseModel):
     usage_scope: Optional[str] = None
     customer_segment_id: Optional[str] = None
     pricing_objective: Optional[str] = None
+    # Model routing profile the run was started with (see utils.routing)
+    routing_profile: Optional[str] = None
     
     # Step tracking
     current_step: int = 0
@@ -91,6 +157,11 @@ class OrchestrationState(BaseModel):
     current_iteration: int = 0
     max_iterations: int = 3
     loop_completed: bool = False
+    loop_stop_reason: Optional[str] = None  # "converged", "max_iterations" or "failed"
+    loop_convergence: List[Dict[str, Any]] = Field(default_factory=list)
+    
+    # Steps that ran without some of their soft dependencies: step -> missing inputs
+    degraded_steps: Dict[str, List[str]] = Field(default_factory=dict)
     
     # Structured outputs from specific agents
     pricing_analysis_structured: Optional[PricingAnalysisResponse] = None
@@ -110,12 +181,16 @@ class OrchestrationState(BaseModel):
         self.updated_at = datetime.utcnow()
     
     def start_step(self, step_name: str, step_order: int, step_input: Dict[str, Any]):
+        # Keep background jobs of an interrupted attempt so a restart can re-attach to them
+        previous = self.steps.get(step_name)
         self.steps[step_name] = StepResult(
             step_name=step_name,
             step_order=step_order,
             status=StepStatus.IN_PROGRESS,
             started_at=datetime.utcnow(),
-            step_input=step_input
+            step_input=step_input,
+            background_jobs=dict(previous.background_jobs) if previous else {},
+            batch_jobs=dict(previous.batch_jobs) if previous else {}
         )
         self.current_step = step_order
         self.update_timestamp()
@@ -153,18 +228,11 @@ class OrchestrationState(BaseModel):
         ]
     
     def is_orchestration_complete(self) -> bool:
-        required_steps = [
-            "product_offering",
-            "competitive_analysis",
-            "cashflow_analysis",
-            "segmentwise_roi", 
-            "pricing_analysis",
-            "longterm_revenue",
-            "value_capture_analysis",
-            "experimental_pricing_recommendation"
-        ]
-        return all(self.is_step_completed(step) for step in required_steps) and self.loop_completed
+        return all(self.is_step_completed(step) for step in STEP_DEPENDENCIES) and self.loop_completed
     
+    def get_llm_calls(self) -> List[LLMCallUsage]:
+        return [call for step in self.steps.values() for call in step.llm_calls]
+
     def get_progress_percentage(self) -> float:
         if self.total_steps == 0:
             return 0.0
@@ -181,11 +249,14 @@ class OrchestrationState(BaseModel):
                     "step_name": step_result.step_name,
                     "step_order": step_result.step_order,
                     "status": step_result.status,
-                    "step_input": step_result.step_input,
-                    "step_output": step_result.step_output,
+                    "step_input": to_serializable(step_result.step_input),
+                    "step_output": to_serializable(step_result.step_output),
                     "started_at": step_result.started_at,
                     "completed_at": step_result.completed_at,
-                    "error_message": step_result.error_message
+                    "error_message": step_result.error_message,
+                    "background_jobs": step_result.background_jobs,
+                    "batch_jobs": step_result.batch_jobs,
+                    "llm_calls": [call.model_dump() for call in step_result.llm_calls]
                 }
                 for step_name, step_result in self.steps.items()
             },
@@ -221,7 +292,10 @@ class OrchestrationState(BaseModel):
                 "is_complete": self.is_orchestration_complete(),
                 "current_iteration": self.current_iteration,
                 "max_iterations": self.max_iterations,
-                "loop_completed": self.loop_completed
+                "loop_completed": self.loop_completed,
+                "loop_stop_reason": self.loop_stop_reason,
+                "loop_convergence": self.loop_convergence,
+                "degraded_steps": self.degraded_steps
             }
         }
 
@@ -301,27 +375,11 @@ class OrchestrationStateManager:
         """Get list of agents that can be executed based on current state"""
         executable = []
         
-        # Product offering can always run if not completed
-        if not state.is_step_completed("product_offering"):
-            executable.append("product_offering")
-        
-        # Segmentwise ROI and pricing analysis can run in parallel after product offering
-        if state.is_step_completed("product_offering"):
-            if not state.is_step_completed("segmentwise_roi"):
-                executable.append("segmentwise_roi")
-            if not state.is_step_completed("pricing_analysis"):
-                executable.append("pricing_analysis")
-        
-        # Value capture analysis needs both segmentwise ROI and pricing analysis
-        if (state.is_step_completed("segmentwise_roi") and 
-            state.is_step_completed("pricing_analysis") and 
-            not state.is_step_completed("value_capture_analysis")):
-            executable.append("value_capture_analysis")
-        
-        # Experimental pricing recommendation needs value capture analysis
-        if (state.is_step_completed("value_capture_analysis") and 
-            not state.is_step_completed("experimental_pricing_recommendation")):
-            executable.append("experimental_pricing_recommendation")
+        for step_name, dependencies in STEP_DEPENDENCIES.items():
+            if state.is_step_completed(step_name):
+                continue
+            if all(state.is_step_completed(dep) for dep in dependencies):
+                executable.append(step_name)
         
         return executable
     
@@ -359,26 +417,33 @@ class OrchestrationStateManager:
         }
     
     @staticmethod
-    def save_state_to_mongodb(state: OrchestrationState):
-        """Save the current state to MongoDB using OrchestrationResult model"""
+    def save_state_to_mongodb(state: OrchestrationState, state_dict: Optional[Dict[str, Any]] = None):
+        """
+        Checkpoint the current state to MongoDB using the OrchestrationResult model.
+        There is one checkpoint document per invocation, overwritten on every save.
+        """
         from .models import OrchestrationResult
         
-        state_dict = state.to_orchestration_result_dict()
+        if state_dict is None:
+            state_dict = state.to_orchestration_result_dict()
         
-        # Save overall state
-        overall_result = OrchestrationResult(
+        overall_result = OrchestrationResult.objects(
             invocation_id=state.invocation_id,
-            step_name="orchestration_state",
-            step_order=0,
-            product_id=state.product_id,
-            step_input={"initial_params": {
+            step_name="orchestration_state"
+        ).modify(
+            upsert=True,
+            new=True,
+            set__step_order=0,
+            set__product_id=state.product_id,
+            set__step_input={"initial_params": {
                 "usage_scope": state.usage_scope,
                 "customer_segment_id": state.customer_segment_id,
-                "pricing_objective": state.pricing_objective
+                "pricing_objective": state.pricing_objective,
+                "routing_profile": state.routing_profile
             }},
-            step_output=state_dict
+            set__step_output=state_dict,
+            set__llm_usage=summarize_calls(state.get_llm_calls())
         )
-        overall_result.save()
         
         return overall_result.id
     
@@ -399,7 +464,7 @@ class OrchestrationStateManager:
             state_data = overall_result.step_output
             
             # Reconstruct the state
-            initial_params = state_data.get("initial_params", {}) or {}
+            initial_params = (overall_result.step_input or {}).get("initial_params", {}) or {}
             state = OrchestrationState(
                 invocation_id=invocation_id,
                 product_id=state_data.get("product_id"),
@@ -409,7 +474,8 @@ class OrchestrationStateManager:
                 total_steps=state_data.get("metadata", {}).get("total_steps", 5),
                 usage_scope=initial_params.get("usage_scope"),
                 customer_segment_id=initial_params.get("customer_segment_id"),
-                pricing_objective=initial_params.get("pricing_objective")
+                pricing_objective=initial_params.get("pricing_objective"),
+                routing_profile=initial_params.get("routing_profile")
             )
             
             # Restore agent outputs
@@ -431,9 +497,16 @@ class OrchestrationStateManager:
             state.current_iteration = metadata.get("current_iteration", 0)
             state.max_iterations = metadata.get("max_iterations", 3)
             state.loop_completed = metadata.get("loop_completed", False)
+            state.loop_stop_reason = metadata.get("loop_stop_reason")
+            state.loop_convergence = metadata.get("loop_convergence", []) or []
+            state.degraded_steps = metadata.get("degraded_steps", {}) or {}
             
             # Restore structured outputs
             structured_outputs = state_data.get("structured_outputs", {})
+            if structured_outputs.get("pricing_analysis_structured"):
+                state.pricing_analysis_structured = PricingAnalysisResponse(
+                    **structured_outputs["pricing_analysis_structured"]
+                )
             if structured_outputs.get("experimental_pricing_structured"):
                 state.experimental_pricing_structured = RecommendedPricingModelResponse(
                     **structured_outputs["experimental_pricing_structured"]
@@ -0,0 +1,157 @@
+import os
+import logging
+from datetime import datetime, timezone
+import bson
+import numpy as np
+from bson import Binary, ObjectId
+from pymongo import UpdateOne
+from datastore.models import PricingPlanSegmentContribution, TimeseriesData
+
+logger = logging.getLogger(__name__)
+
+# How PricingPlanSegmentContribution time series are written:
+#   embedded - a list of TimeseriesData sub-documents per series, one per point
+#   columnar - packed date/value arrays per series under timeseries_columns
+# Readers accept both, so documents can be converted in place with
+# main.py --migrate-timeseries while runs continue
+TIMESERIES_BACKENDS = ("embedded", "columnar")
+TIMESERIES_BACKEND = os.getenv("TIMESERIES_BACKEND", "embedded").strip().lower()
+if TIMESERIES_BACKEND not in TIMESERIES_BACKENDS:
+    logger.warning(f"Unknown TIMESERIES_BACKEND '{TIMESERIES_BACKEND}'; using embedded")
+    TIMESERIES_BACKEND = "embedded"
+
+SERIES_NAMES = ("revenue_ts_data", "active_subscriptions", "revenue_forecast_ts_data", "active_subscriptions_forecast")
+COLUMNS_FIELD = "timeseries_columns"
+
+_DATE_DTYPE = np.dtype("<i8")
+_VALUE_DTYPE = np.dtype("<f8")
+
+
+def _to_datetime64(dates):
+    """Dates as datetime64[ms]; timezone-aware datetimes are converted to naive UTC, as MongoDB stores them"""
+    if isinstance(dates, np.ndarray) and np.issubdtype(dates.dtype, np.datetime64):
+        return dates.astype("datetime64[ms]")
+    naive = [d.astimezone(timezone.utc).replace(tzinfo=None) if getattr(d, "tzinfo", None) else d for d in dates]
+    return np.array(naive, dtype="datetime64[ms]")
+
+
+def pack(dates, values):
+    """A series as the stored form of a TimeseriesColumn"""
+    dates = _to_datetime64(dates)
+    values = np.asarray(values, dtype=_VALUE_DTYPE)
+    if len(dates) != len(values):
+        raise ValueError(f"Series has {len(dates)} dates but {len(values)} values")
+    return {
+        "dates": Binary(dates.astype(_DATE_DTYPE).tobytes()),
+        "values": Binary(values.tobytes()),
+        "count": len(values),
+    }
+
+
+def unpack(column):
+    """(dates as datetime64[ms], values as float64) from a TimeseriesColumn or its stored dict; the arrays are read-only"""
+    get = column.get if isinstance(column, dict) else lambda key: getattr(column, key, None)
+    dates = np.frombuffer(get("dates") or b"", dtype=_DATE_DTYPE).view("datetime64[ms]")
+    values = np.frombuffer(get("values") or b"", dtype=_VALUE_DTYPE)
+    return dates, values
+
+
+def _from_points(points):
+    """Arrays from embedded points, either TimeseriesData or their stored dicts"""
+    points = [p if isinstance(p, dict) else {"date": p.date, "value": p.value} for p in points or []]
+    points = [p for p in points if p.get("date") is not None and p.get("value") is not None]
+    return _to_datetime64([p["date"] for p in points]), np.array([p["value"] for p in points], dtype=_VALUE_DTYPE)
+
+
+def get_series(contribution, name):
+    """One of a contribution's series as (dates, values) NumPy arrays, whichever backend stored it"""
+    column = (contribution.timeseries_columns or {}).get(name)
+    if column is not None:
+        return unpack(column)
+    return _from_points(getattr(contribution, name))
+
+
+def latest_value(contribution, name, default=0):
+    """The series' last point's value, or default when it is empty"""
+    _, values = get_series(contribution, name)
+    return float(values[-1]) if len(values) else default
+
+
+def to_points(dates, values):
+    """(date, value) pairs as Python datetimes and floats, for code that needs per-point objects"""
+    return list(zip(_to_datetime64(dates).astype(datetime).tolist(), np.asarray(values, dtype=_VALUE_DTYPE).tolist()))
+
+
+def series_update(series, backend=None):
+    """A MongoDB update writing {name: (dates, values)} in the backend's format and removing the other format's copy"""
+    backend = backend or TIMESERIES_BACKEND
+    update = {"$set": {}, "$unset": {}}
+    for name, (dates, values) in series.items():
+        if backend == "columnar":
+            update["$set"][f"{COLUMNS_FIELD}.{name}"] = pack(dates, values)
+            update["$unset"][name] = ""
+        else:
+            update["$set"][name] = [TimeseriesData(date=date, value=value).to_mongo() for date, value in to_points(dates, values)]
+            update["$unset"][f"{COLUMNS_FIELD}.{name}"] = ""
+    return {operator: fields for operator, fields in update.items() if fields}
+
+
+def migrate_timeseries(backend, batch_size=500, product_id=None):
+    """Rewrite stored contribution series into backend's format, batch_size documents per bulk_write
+
+    Returns counts of documents scanned and rewritten, points moved and the
+    BSON size of the series before and after.
+    """
+    if backend not in TIMESERIES_BACKENDS:
+        raise ValueError(f"Unknown timeseries backend '{backend}' (available: {', '.join(TIMESERIES_BACKENDS)})")
+    collection = PricingPlanSegmentContribution._get_collection()
+    query = {"product": ObjectId(product_id)} if product_id else {}
+    projection = {name: 1 for name in SERIES_NAMES}
+    projection[COLUMNS_FIELD] = 1
+
+    stats = {"backend": backend, "scanned": 0, "migrated": 0, "points": 0, "bytes_before": 0, "bytes_after": 0}
+    operations = []
+    for doc in collection.find(query, projection, batch_size=batch_size):
+        stats["scanned"] += 1
+        columns = doc.get(COLUMNS_FIELD) or {}
+        # Only series still held in the other format need rewriting
+        if backend == "columnar":
+            pending = [name for name in SERIES_NAMES if name in doc]
+        else:
+            pending = [name for name in SERIES_NAMES if name in columns]
+        if not pending:
+            continue
+        series = {}
+        before = {}
+        for name in pending:
+            # A column written after the embedded list is the newer copy
+            if name in columns:
+                series[name] = unpack(columns[name])
+                before[f"{COLUMNS_FIELD}.{name}"] = columns[name]
+            else:
+                series[name] = _from_points(doc[name])
+            if name in doc:
+                before[name] = doc[name]
+            stats["points"] += len(series[name][1])
+        update = series_update(series, backend)
+        stats["bytes_before"] += len(bson.encode(before))
+        stats["bytes_after"] += len(bson.encode(update["$set"]))
+        operations.append(UpdateOne({"_id": doc["_id"]}, update))
+        stats["migrated"] += 1
+        if len(operations) >= batch_size:
+            collection.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+    logger.info(f"Migrated {stats['migrated']}/{stats['scanned']} contributions to {backend} time series")
+    return stats
+
+
+def format_migration_report(stats):
+    lines = []
+    lines.append(f"Time series migrated to {stats['backend']}: {stats['migrated']} of {stats['scanned']} contributions, {stats['points']} points")
+    if stats["bytes_before"]:
+        lines.append(f"Series storage: {stats['bytes_before']:,} -> {stats['bytes_after']:,} bytes ({stats['bytes_after'] / stats['bytes_before']:.0%})")
+    if stats["backend"] != TIMESERIES_BACKEND:
+        lines.append(f"Set TIMESERIES_BACKEND={stats['backend']} so new writes use the same format")
+    return "\n".join(lines)
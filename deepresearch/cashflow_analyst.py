@@ -1,35 +1,24 @@
+import asyncio
 from datastore.models import Product
-from utils.openai_client import openai_client
+from utils.openai_client import create_response, acreate_response
 from .prompts import cashflow_analysis_prompt
+from .product_context import compose_input, prompt_cache_key
 
 
-def agent(product_id=None, pricing_research=None, pricing_objective=None):
-    """
-    Cashflow Analyst Agent
-    Analyzes financial impact and cashflow implications of pricing strategies
-    """
+def build_request(product_id=None, pricing_research=None, pricing_objective=None):
     product = Product.objects.get(id=product_id)
-    input_data = f"""
-## Product
-{product.name}
-
-## Core Features
-{product.features_description_summary}
-
-## Ideal Customer Profile
-{product.icp_description}
-
-## Pricing Research Context
-{pricing_research or "No pricing research provided"}
-"""
-    
-    if pricing_objective:
-        input_data = f"{input_data}\n\n## Pricing Objective:\n{pricing_objective}"
+    input_data = compose_input(
+        product,
+        ("Pricing Research Context", pricing_research or "No pricing research provided"),
+        ("Pricing Objective", pricing_objective),
+    )
     
-    response = openai_client.responses.create(
+    return dict(
         model="o3-deep-research",
+        background=True,
         instructions=cashflow_analysis_prompt,
         input=input_data,
+        prompt_cache_key=prompt_cache_key("cashflow_analysis", product),
         tools=[
             {"type": "web_search_preview"},
             {
@@ -40,37 +29,44 @@ def agent(product_id=None, pricing_research=None, pricing_objective=None):
             }
         ]
     )
-    
-    return response.content[0].text
 
 
-def refinement_agent(product_id=None, experimental_pricing_research=None, positioning_analysis=None, persona_simulation=None, pricing_objective=None):
+def agent(product_id=None, pricing_research=None, pricing_objective=None):
     """
-    Cashflow Analyst Refinement Agent
-    Refines cashflow analysis based on positioning and persona simulation feedback
+    Cashflow Analyst Agent
+    Analyzes financial impact and cashflow implications of pricing strategies
     """
-    product = Product.objects.get(id=product_id)
-    input_data = f"""
-## Product
-{product.name}
+    response = create_response("cashflow_analysis", **build_request(product_id, pricing_research, pricing_objective))
+    return response.output_text
 
-## Experimental Pricing Research
-{experimental_pricing_research or "No experimental pricing provided"}
 
-## Positioning Analysis Feedback
-{positioning_analysis or "No positioning analysis provided"}
+async def agent_async(product_id=None, pricing_research=None, pricing_objective=None):
+    """Async variant of the Cashflow Analyst Agent"""
+    request = await asyncio.to_thread(build_request, product_id, pricing_research, pricing_objective)
+    response = await acreate_response("cashflow_analysis", **request)
+    return response.output_text
 
-## Persona Simulation Feedback
-{persona_simulation or "No persona simulation provided"}
-"""
-    
-    if pricing_objective:
-        input_data = f"{input_data}\n\n## Pricing Objective:\n{pricing_objective}"
+
+def build_refinement_request(product_id=None, experimental_pricing_research=None, positioning_analysis=None, persona_simulation=None, pricing_objective=None, previous_refinement=None):
+    product = Product.objects.get(id=product_id)
+    # The experimental pricing research is the same in every loop iteration, so
+    # it goes before the previous round's refinement and the feedback that
+    # change from one iteration to the next
+    input_data = compose_input(
+        product,
+        ("Experimental Pricing Research", experimental_pricing_research or "No experimental pricing provided"),
+        ("Previous Cashflow Refinement", previous_refinement),
+        ("Positioning Analysis Feedback", positioning_analysis or "No positioning analysis provided"),
+        ("Persona Simulation Feedback", persona_simulation or "No persona simulation provided"),
+        ("Pricing Objective", pricing_objective),
+    )
     
-    response = openai_client.responses.create(
+    return dict(
         model="o3-deep-research",
+        background=True,
         instructions="Refine cashflow analysis based on positioning and persona feedback. Focus on financial viability, revenue projections, and risk assessment of the proposed pricing model.",
         input=input_data,
+        prompt_cache_key=prompt_cache_key("cashflow_refinement", product),
         tools=[
             {"type": "web_search_preview"},
             {
@@ -81,5 +77,19 @@ def refinement_agent(product_id=None, experimental_pricing_research=None, positi
             }
         ]
     )
-    
-    return response.content[0].text
+
+
+def refinement_agent(product_id=None, experimental_pricing_research=None, positioning_analysis=None, persona_simulation=None, pricing_objective=None, previous_refinement=None):
+    """
+    Cashflow Analyst Refinement Agent
+    Refines cashflow analysis based on positioning and persona simulation feedback
+    """
+    response = create_response("cashflow_refinement", **build_refinement_request(product_id, experimental_pricing_research, positioning_analysis, persona_simulation, pricing_objective, previous_refinement))
+    return response.output_text
+
+
+async def refinement_agent_async(product_id=None, experimental_pricing_research=None, positioning_analysis=None, persona_simulation=None, pricing_objective=None, previous_refinement=None):
+    """Async variant of the Cashflow Analyst Refinement Agent"""
+    request = await asyncio.to_thread(build_refinement_request, product_id, experimental_pricing_research, positioning_analysis, persona_simulation, pricing_objective, previous_refinement)
+    response = await acreate_response("cashflow_refinement", **request)
+    return response.output_text
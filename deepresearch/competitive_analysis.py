@@ -1,17 +1,14 @@
+import asyncio
 from datastore.models import Product
-from utils.openai_client import openai_client
+from utils.openai_client import create_response, acreate_response
 from .prompts import competitive_analysis_prompt
+from .product_context import compose_input, prompt_cache_key
 
 
-def agent(product_id=None, pricing_objective=None):
-    """
-    Competitive Analysis Agent
-    Analyzes competitive landscape and pricing strategies
-    """
+def build_request(product_id=None, pricing_objective=None):
     product = Product.objects.get(id=product_id)
     competitor_info = ""
     if product.competitors:
-        competitor_info = "\n## Known Competitors\n"
         for i, competitor in enumerate(product.competitors, 1):
             competitor_info += f"\n### Competitor {i}: {competitor.competitor_name}\n"
             if competitor.website_url:
@@ -19,23 +16,11 @@ def agent(product_id=None, pricing_objective=None):
             if competitor.product_description:
                 competitor_info += f"Product Description: {competitor.product_description}\n"
     
-    input_data = f"""
-## Product
-{product.name}
-
-## Core Features
-{product.features_description_summary}
-
-## Ideal Customer Profile
-{product.icp_description}
-
-## Product Category
-{product.category}
-{competitor_info}
-"""
-    
-    if pricing_objective:
-        input_data = f"{input_data}\n\n## Pricing Objective:\n{pricing_objective}"
+    input_data = compose_input(
+        product,
+        ("Known Competitors", competitor_info),
+        ("Pricing Objective", pricing_objective),
+    )
     
     tools = [{"type": "web_search_preview"}]
     
@@ -52,11 +37,27 @@ def agent(product_id=None, pricing_objective=None):
             "vector_store_ids": vector_stores
         })
     
-    response = openai_client.responses.create(
+    return dict(
         model="o3-deep-research",
+        background=True,
         instructions=competitive_analysis_prompt,
         input=input_data,
+        prompt_cache_key=prompt_cache_key("competitive_analysis", product),
         tools=tools
     )
-    
-    return response.content[0].text
+
+
+def agent(product_id=None, pricing_objective=None):
+    """
+    Competitive Analysis Agent
+    Analyzes competitive landscape and pricing strategies
+    """
+    response = create_response("competitive_analysis", **build_request(product_id, pricing_objective))
+    return response.output_text
+
+
+async def agent_async(product_id=None, pricing_objective=None):
+    """Async variant of the Competitive Analysis Agent"""
+    request = await asyncio.to_thread(build_request, product_id, pricing_objective)
+    response = await acreate_response("competitive_analysis", **request)
+    return response.output_text
@@ -1,41 +1,26 @@
+import asyncio
 from datastore.models import Product
-from utils.openai_client import openai_client
+from utils.openai_client import create_response, acreate_response
 from .prompts import longterm_revenue_prompt
+from .product_context import compose_input, prompt_cache_key
 
 
-def agent(product_id=None, segment_research=None, pricing_research=None, product_research=None, pricing_objective=None):
-    """
-    Long-term Revenue Potential Agent
-    Analyzes customer lifetime value and long-term revenue potential
-    """
+def build_request(product_id=None, segment_research=None, pricing_research=None, product_research=None, pricing_objective=None):
     product = Product.objects.get(id=product_id)
-    input_data = f"""
-## Product
-{product.name}
-
-## Core Features
-{product.features_description_summary}
-
-## Ideal Customer Profile
-{product.icp_description}
-
-## Product Research Context
-{product_research or "No product research provided"}
-
-## Segment Research Context
-{segment_research or "No segment research provided"}
-
-## Pricing Research Context
-{pricing_research or "No pricing research provided"}
-"""
-    
-    if pricing_objective:
-        input_data = f"{input_data}\n\n## Pricing Objective:\n{pricing_objective}"
+    input_data = compose_input(
+        product,
+        ("Product Research Context", product_research or "No product research provided"),
+        ("Segment Research Context", segment_research or "No segment research provided"),
+        ("Pricing Research Context", pricing_research or "No pricing research provided"),
+        ("Pricing Objective", pricing_objective),
+    )
     
-    response = openai_client.responses.create(
+    return dict(
         model="o3-deep-research",
+        background=True,
         instructions=longterm_revenue_prompt,
         input=input_data,
+        prompt_cache_key=prompt_cache_key("longterm_revenue", product),
         tools=[
             {"type": "web_search_preview"},
             {
@@ -46,5 +31,19 @@ def agent(product_id=None, segment_research=None, pricing_research=None, product
             }
         ]
     )
-    
-    return response.content[0].text
+
+
+def agent(product_id=None, segment_research=None, pricing_research=None, product_research=None, pricing_objective=None):
+    """
+    Long-term Revenue Potential Agent
+    Analyzes customer lifetime value and long-term revenue potential
+    """
+    response = create_response("longterm_revenue", **build_request(product_id, segment_research, pricing_research, product_research, pricing_objective))
+    return response.output_text
+
+
+async def agent_async(product_id=None, segment_research=None, pricing_research=None, product_research=None, pricing_objective=None):
+    """Async variant of the Long-term Revenue Potential Agent"""
+    request = await asyncio.to_thread(build_request, product_id, segment_research, pricing_research, product_research, pricing_objective)
+    response = await acreate_response("longterm_revenue", **request)
+    return response.output_text
@@ -1,7 +1,8 @@
-from utils.openai_client import openai_client, litellm_client
+import asyncio
+from utils.openai_client import create_response, acreate_response, structured_text_format
 from typing import Optional, List
 from pydantic import BaseModel, Field
-from .prompts import experimental_pricing_recommendation_prompt, structured_parsing_system_prompt
+from .prompts import experimental_pricing_recommendation_prompt, structured_report_prompt
 from datetime import datetime
 from datastore.models import Product, ProductPricingModel, CustomerSegment, RecommendedPricingModel, TimeseriesData
 
@@ -28,16 +29,20 @@ class RecommendedPricingModelResponse(BaseModel):
     min_unit_count: int
     unit_calculation_logic: str
     min_unit_utilization_period: str
+
+class PricingRecommendationReport(BaseModel):
+    """The recommendation text and its pricing model, produced together in one structured-output call"""
+    analysis: str
+    structured: RecommendedPricingModelResponse
  
  
-def agent(product_id: str, value_capture_analysis: str, pricing_objective=None) -> RecommendedPricingModelResponse:
-    product = Product.objects.get(id=product_id)
-    new_ab_test_pricing_model = openai_client.responses.create(
+def build_request(value_capture_analysis: str, pricing_objective=None):
+    return dict(
         model="gpt-5",
         reasoning={"effort": "high"},
         input=[{
             "role": "system",
-            "content": experimental_pricing_recommendation_prompt,
+            "content": experimental_pricing_recommendation_prompt + structured_report_prompt,
         },
         {
             "role": "user",
@@ -48,18 +53,14 @@ def agent(product_id: str, value_capture_analysis: str, pricing_objective=None)
         ],
         tool_choice="auto",
         truncation="auto",
-        max_tool_calls=15
-    )
-    
-    pricing_response = litellm_client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": structured_parsing_system_prompt},
-            {"role": "user", "content": new_ab_test_pricing_model.output_text}
-        ],
-        response_model=RecommendedPricingModelResponse
+        max_tool_calls=15,
+        text={"format": structured_text_format(PricingRecommendationReport)}
     )
-    
+
+
+def persist_recommendation(product_id: str, pricing_response: RecommendedPricingModelResponse):
+    """Save the recommended pricing model, its segments and forecasts to MongoDB"""
+    product = Product.objects.get(id=product_id)
     pricing_model = ProductPricingModel(
         plan_name=pricing_response.plan_name,
         unit_price=pricing_response.unit_price,
@@ -125,4 +126,20 @@ def agent(product_id: str, value_capture_analysis: str, pricing_objective=None)
         'customer_segment_ids': created_customer_segment_ids,
         'recommended_pricing_id': first_recommended_pricing_id,
         'recommended_pricing_ids': created_recommended_pricing_ids
-    }
\ No newline at end of file
+    }
+
+
+def agent(product_id: str, value_capture_analysis: str, pricing_objective=None) -> RecommendedPricingModelResponse:
+    new_ab_test_pricing_model = create_response("experimental_pricing_recommendation", **build_request(value_capture_analysis, pricing_objective))
+    report = PricingRecommendationReport.model_validate_json(new_ab_test_pricing_model.output_text)
+    result = persist_recommendation(product_id, report.structured)
+    result['recommendation_text'] = report.analysis
+    return result
+
+
+async def agent_async(product_id: str, value_capture_analysis: str, pricing_objective=None) -> RecommendedPricingModelResponse:
+    new_ab_test_pricing_model = await acreate_response("experimental_pricing_recommendation", **build_request(value_capture_analysis, pricing_objective))
+    report = PricingRecommendationReport.model_validate_json(new_ab_test_pricing_model.output_text)
+    result = await asyncio.to_thread(persist_recommendation, product_id, report.structured)
+    result['recommendation_text'] = report.analysis
+    return result
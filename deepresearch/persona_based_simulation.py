@@ -1,35 +1,27 @@
+import asyncio
 from datastore.models import Product
-from utils.openai_client import openai_client
+from utils.openai_client import create_response, acreate_response
 from .prompts import persona_simulation_prompt
+from .product_context import compose_input, prompt_cache_key
 
 
-def agent(product_id=None, experimental_pricing_research=None, pricing_objective=None):
-    """
-    Persona-based Simulation Agent
-    Simulates customer personas and their response to pricing strategies
-    """
+def build_request(product_id=None, experimental_pricing_research=None, pricing_objective=None, previous_refinement=None):
     product = Product.objects.get(id=product_id)
-    input_data = f"""
-## Product
-{product.name}
-
-## Core Features
-{product.features_description_summary}
-
-## Ideal Customer Profile
-{product.icp_description}
-
-## Experimental Pricing Research
-{experimental_pricing_research or "No experimental pricing provided"}
-"""
-    
-    if pricing_objective:
-        input_data = f"{input_data}\n\n## Pricing Objective:\n{pricing_objective}"
+    # Later refinement rounds react to the previous round's cashflow findings;
+    # they come after the research that every round shares
+    input_data = compose_input(
+        product,
+        ("Experimental Pricing Research", experimental_pricing_research or "No experimental pricing provided"),
+        ("Previous Cashflow Refinement", previous_refinement),
+        ("Pricing Objective", pricing_objective),
+    )
     
-    response = openai_client.responses.create(
+    return dict(
         model="o3-deep-research",
+        background=True,
         instructions=persona_simulation_prompt,
         input=input_data,
+        prompt_cache_key=prompt_cache_key("persona_simulation", product),
         tools=[
             {"type": "web_search_preview"},
             {
@@ -40,5 +32,19 @@ def agent(product_id=None, experimental_pricing_research=None, pricing_objective
             }
         ]
     )
-    
-    return response.content[0].text
+
+
+def agent(product_id=None, experimental_pricing_research=None, pricing_objective=None, previous_refinement=None):
+    """
+    Persona-based Simulation Agent
+    Simulates customer personas and their response to pricing strategies
+    """
+    response = create_response("persona_simulation", **build_request(product_id, experimental_pricing_research, pricing_objective, previous_refinement))
+    return response.output_text
+
+
+async def agent_async(product_id=None, experimental_pricing_research=None, pricing_objective=None, previous_refinement=None):
+    """Async variant of the Persona-based Simulation Agent"""
+    request = await asyncio.to_thread(build_request, product_id, experimental_pricing_research, pricing_objective, previous_refinement)
+    response = await acreate_response("persona_simulation", **request)
+    return response.output_text
@@ -1,14 +1,17 @@
+import asyncio
 import logging
 import traceback
 from bson import ObjectId
+from pymongo import UpdateOne
 from datetime import datetime
 from typing import Optional, List
 from pydantic import BaseModel, Field
-from utils.openai_client import openai_client, litellm_client
+from utils.openai_client import create_response, acreate_response, structured_text_format
 from datastore.models import Product, CustomerSegment, ProductPricingModel
-from datastore.models import PricingPlanSegmentContribution, TimeseriesData
-from datastore.connectors import create_pricing_plan_segment_contribution
-from .prompts import pricing_analysis_system_prompt, structured_parsing_system_prompt
+from datastore.models import PricingPlanSegmentContribution
+from datastore.timeseries import series_update, latest_value
+from .prompts import pricing_analysis_system_prompt, structured_report_prompt
+from .product_context import compose_input, prompt_cache_key
 
 # Configure logging
 logging.basicConfig(
@@ -23,6 +26,10 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+class AnalysisInputError(Exception):
+    """Raised when the data needed for the pricing prompt cannot be gathered"""
+
+
 class RevenuePoint(BaseModel):
     date: str
     revenue: float
@@ -37,8 +44,38 @@ class SegmentPlanForecast(BaseModel):
 class PricingAnalysisResponse(BaseModel):
     forecasts: List[SegmentPlanForecast]
 
+class PricingAnalysisReport(BaseModel):
+    """The analysis text and its forecasts, produced together in one structured-output call"""
+    analysis: str
+    structured: PricingAnalysisResponse
+
+def _parse_forecast_date(value: str) -> datetime:
+    """ISO dates (with or without a trailing Z) or plain YYYY-MM-DD"""
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (ValueError, AttributeError):
+        return datetime.strptime(value, '%Y-%m-%d')
+
+
+def _forecast_series(points: List[RevenuePoint], label: str) -> tuple:
+    """Forecast points as (dates, values), skipping points with unreadable dates"""
+    dates, values = [], []
+    for j, point in enumerate(points):
+        try:
+            dates.append(_parse_forecast_date(point.date))
+            values.append(point.revenue)
+        except Exception as e:
+            logger.error(f"Error processing {label} point {j}: {e}")
+    return dates, values
+
+
 def save_pricing_forecasts(product_id: str, parsed_response: PricingAnalysisResponse):
-    """Save the parsed forecast data to PricingPlanSegmentContribution records"""
+    """Save the parsed forecast data to PricingPlanSegmentContribution records
+
+    The product's segments and contributions are read in two queries, every
+    forecast is matched in memory, and all contribution updates and inserts
+    go to the database in one bulk_write.
+    """
     try:
         logger.info(f"Starting to save pricing forecasts for product {product_id}")
         
@@ -66,242 +103,92 @@ def save_pricing_forecasts(product_id: str, parsed_response: PricingAnalysisResp
             logger.error(f"Invalid product_id format: {product_id}, error: {e}")
             logger.error(f"Full stack trace: {traceback.format_exc()}")
             return
-        
+
+        segment_collection = CustomerSegment._get_collection()
+        contribution_collection = PricingPlanSegmentContribution._get_collection()
+
+        # Prefetch: the product's segments by uid, and its contributions' keys
+        segment_ids = {}
+        for segment in segment_collection.find({"product": product_obj_id}, {"customer_segment_uid": 1}):
+            segment_ids.setdefault(segment.get("customer_segment_uid"), segment["_id"])
+        contributions = [
+            {"filter": {"_id": c["_id"]}, "customer_segment": c.get("customer_segment"), "pricing_plan": c.get("pricing_plan")}
+            for c in contribution_collection.find({"product": product_obj_id}, {"customer_segment": 1, "pricing_plan": 1})
+        ]
+        logger.info(f"Prefetched {len(segment_ids)} segments and {len(contributions)} contributions")
+
+        new_segments = []
+        resolved = []
         for i, forecast in enumerate(parsed_response.forecasts):
-            try:
-                logger.info(f"Processing forecast {i+1}/{len(parsed_response.forecasts)}")
-                
-                # Find the matching PricingPlanSegmentContribution record
-                filters = {"product": product_obj_id}
-                
-                if forecast.customer_segment_uid:
-                    try:
-                        segment = CustomerSegment.objects(
-                            product=product_obj_id,
-                            customer_segment_uid=forecast.customer_segment_uid
-                        ).first()
-                        if segment:
-                            filters["customer_segment"] = segment
-                        else:
-                            logger.info(f"No segment found for UID: {forecast.customer_segment_uid}, creating new segment")
-                            # Create new customer segment
-                            try:
-                                new_segment = CustomerSegment(
-                                    product=product_obj_id,
-                                    customer_segment_uid=forecast.customer_segment_uid,
-                                    customer_segment_name=f"Segment {forecast.customer_segment_uid}",
-                                    customer_segment_description=f"Auto-generated segment for UID: {forecast.customer_segment_uid}"
-                                )
-                                new_segment.save()
-                                filters["customer_segment"] = new_segment
-                                logger.info(f"Successfully created new customer segment: {forecast.customer_segment_uid}")
-                            except Exception as create_error:
-                                logger.error(f"Error creating new customer segment: {create_error}")
-                                logger.error(f"Full stack trace: {traceback.format_exc()}")
-                    except Exception as e:
-                        logger.error(f"Error finding customer segment: {e}")
-                        logger.error(f"Full stack trace: {traceback.format_exc()}")
-                
-                if forecast.pricing_plan_id:
-                    try:
-                        filters["pricing_plan"] = ObjectId(forecast.pricing_plan_id)
-                    except Exception as e:
-                        logger.error(f"Invalid pricing_plan_id format: {forecast.pricing_plan_id}, error: {e}")
-                        logger.error(f"Full stack trace: {traceback.format_exc()}")
-                
-                # Find existing record
+            logger.info(f"Processing forecast {i+1}/{len(parsed_response.forecasts)}")
+
+            segment_id = None
+            if forecast.customer_segment_uid:
+                segment_id = segment_ids.get(forecast.customer_segment_uid)
+                if segment_id is None:
+                    logger.info(f"No segment found for UID: {forecast.customer_segment_uid}, creating new segment")
+                    segment_id = ObjectId()
+                    segment_ids[forecast.customer_segment_uid] = segment_id
+                    new_segments.append({
+                        "_id": segment_id,
+                        "product": product_obj_id,
+                        "customer_segment_uid": forecast.customer_segment_uid,
+                        "customer_segment_name": f"Segment {forecast.customer_segment_uid}",
+                        "customer_segment_description": f"Auto-generated segment for UID: {forecast.customer_segment_uid}",
+                    })
+
+            plan_id = None
+            if forecast.pricing_plan_id:
                 try:
-                    existing_record = PricingPlanSegmentContribution.objects(**filters).first()
+                    plan_id = ObjectId(forecast.pricing_plan_id)
                 except Exception as e:
-                    logger.error(f"Error querying PricingPlanSegmentContribution: {e}")
-                    logger.error(f"Full stack trace: {traceback.format_exc()}")
-                    continue
-                
-                if existing_record:
-                    logger.info(f"Found existing record, updating forecasts")
-                    
-                    # Convert revenue forecast data
-                    if forecast.revenue_forecast_ts_data:
-                        try:
-                            revenue_ts_data = []
-                            for j, point in enumerate(forecast.revenue_forecast_ts_data):
-                                try:
-                                    # Try ISO format first
-                                    try:
-                                        date_obj = datetime.fromisoformat(point.date.replace('Z', '+00:00'))
-                                    except (ValueError, AttributeError):
-                                        # Fallback to simple date format
-                                        date_obj = datetime.strptime(point.date, '%Y-%m-%d')
-                                    
-                                    revenue_ts_data.append(TimeseriesData(
-                                        date=date_obj,
-                                        value=point.revenue
-                                    ))
-                                except Exception as e:
-                                    logger.error(f"Error processing revenue point {j}: {e}")
-                                    logger.error(f"Full stack trace: {traceback.format_exc()}")
-                                    continue
-                            
-                            existing_record.revenue_forecast_ts_data = revenue_ts_data
-                            logger.info(f"Updated {len(revenue_ts_data)} revenue forecast points")
-                            
-                        except Exception as e:
-                            logger.error(f"Error processing revenue forecast data: {e}")
-                            logger.error(f"Full stack trace: {traceback.format_exc()}")
-                    
-                    # Convert subscription forecast data
-                    if forecast.active_subscriptions_forecast:
-                        try:
-                            subscriptions_ts_data = []
-                            for j, point in enumerate(forecast.active_subscriptions_forecast):
-                                try:
-                                    # Try ISO format first
-                                    try:
-                                        date_obj = datetime.fromisoformat(point.date.replace('Z', '+00:00'))
-                                    except (ValueError, AttributeError):
-                                        # Fallback to simple date format
-                                        date_obj = datetime.strptime(point.date, '%Y-%m-%d')
-                                    
-                                    subscriptions_ts_data.append(TimeseriesData(
-                                        date=date_obj,
-                                        value=point.revenue
-                                    ))
-                                except Exception as e:
-                                    logger.error(f"Error processing subscription point {j}: {e}")
-                                    logger.error(f"Full stack trace: {traceback.format_exc()}")
-                                    continue
-                            
-                            existing_record.active_subscriptions_forecast = subscriptions_ts_data
-                            logger.info(f"Updated {len(subscriptions_ts_data)} subscription forecast points")
-                            
-                        except Exception as e:
-                            logger.error(f"Error processing subscription forecast data: {e}")
-                            logger.error(f"Full stack trace: {traceback.format_exc()}")
-                    
-                    # Save the updated record
-                    try:
-                        existing_record.save()
-                        logger.info(f"Successfully saved forecast data for record {i+1}")
-                    except Exception as e:
-                        logger.error(f"Error saving record: {e}")
-                        logger.error(f"Full stack trace: {traceback.format_exc()}")
-                        
-                else:
-                    logger.warning(f"No existing PricingPlanSegmentContribution record found for forecast {i+1}")
-                    # Create new PricingPlanSegmentContribution record
-                    try:
-                        logger.info(f"Creating new PricingPlanSegmentContribution record for forecast {i+1}")
-                        
-                        # Find customer segment
-                        segment = None
-                        if forecast.customer_segment_uid:
-                            try:
-                                segment = CustomerSegment.objects(
-                                    product=product_obj_id,
-                                    customer_segment_uid=forecast.customer_segment_uid
-                                ).first()
-                                if not segment:
-                                    logger.info(f"Creating new customer segment for UID: {forecast.customer_segment_uid}")
-                                    segment = CustomerSegment(
-                                        product=product_obj_id,
-                                        customer_segment_uid=forecast.customer_segment_uid,
-                                        customer_segment_name=f"Segment {forecast.customer_segment_uid}",
-                                        customer_segment_description=f"Auto-generated segment for UID: {forecast.customer_segment_uid}"
-                                    )
-                                    segment.save()
-                            except Exception as e:
-                                logger.error(f"Error finding/creating customer segment: {e}")
-                        
-                        # Find pricing plan
-                        pricing_plan = None
-                        if forecast.pricing_plan_id:
-                            try:
-                                pricing_plan = ProductPricingModel.objects(id=ObjectId(forecast.pricing_plan_id)).first()
-                            except Exception as e:
-                                logger.error(f"Error finding pricing plan: {e}")
-                        
-                        # If we have both segment and pricing plan, create the record
-                        if segment and pricing_plan:
-                            new_record = create_pricing_plan_segment_contribution(
-                                Product.objects(id=product_obj_id).first(), segment, pricing_plan
-                            )
-                            logger.info(f"Created new PricingPlanSegmentContribution record: {new_record.id}")
-                            
-                            # Now save forecast data to the new record
-                            # Convert revenue forecast data
-                            if forecast.revenue_forecast_ts_data:
-                                try:
-                                    revenue_ts_data = []
-                                    for j, point in enumerate(forecast.revenue_forecast_ts_data):
-                                        try:
-                                            # Try ISO format first
-                                            try:
-                                                date_obj = datetime.fromisoformat(point.date.replace('Z', '+00:00'))
-                                            except (ValueError, AttributeError):
-                                                # Fallback to simple date format
-                                                date_obj = datetime.strptime(point.date, '%Y-%m-%d')
-                                            
-                                            revenue_ts_data.append(TimeseriesData(
-                                                date=date_obj,
-                                                value=point.revenue
-                                            ))
-                                        except Exception as e:
-                                            logger.error(f"Error processing revenue point {j}: {e}")
-                                            continue
-                                    
-                                    new_record.revenue_forecast_ts_data = revenue_ts_data
-                                    logger.info(f"Updated {len(revenue_ts_data)} revenue forecast points")
-                                    
-                                except Exception as e:
-                                    logger.error(f"Error processing revenue forecast data: {e}")
-                            
-                            # Convert subscription forecast data
-                            if forecast.active_subscriptions_forecast:
-                                try:
-                                    subscriptions_ts_data = []
-                                    for j, point in enumerate(forecast.active_subscriptions_forecast):
-                                        try:
-                                            # Try ISO format first
-                                            try:
-                                                date_obj = datetime.fromisoformat(point.date.replace('Z', '+00:00'))
-                                            except (ValueError, AttributeError):
-                                                # Fallback to simple date format
-                                                date_obj = datetime.strptime(point.date, '%Y-%m-%d')
-                                            
-                                            subscriptions_ts_data.append(TimeseriesData(
-                                                date=date_obj,
-                                                value=point.revenue
-                                            ))
-                                        except Exception as e:
-                                            logger.error(f"Error processing subscription point {j}: {e}")
-                                            continue
-                                    
-                                    new_record.active_subscriptions_forecast = subscriptions_ts_data
-                                    logger.info(f"Updated {len(subscriptions_ts_data)} subscription forecast points")
-                                    
-                                except Exception as e:
-                                    logger.error(f"Error processing subscription forecast data: {e}")
-                            
-                            # Save the new record
-                            try:
-                                new_record.save()
-                                logger.info(f"Successfully saved forecast data for new record {i+1}")
-                            except Exception as e:
-                                logger.error(f"Error saving new record: {e}")
-                                logger.error(f"Full stack trace: {traceback.format_exc()}")
-                            
-                        else:
-                            logger.error(f"Cannot create record - missing segment ({segment is not None}) or pricing plan ({pricing_plan is not None}) for forecast {i+1}")
-                            
-                    except Exception as create_error:
-                        logger.error(f"Error creating new PricingPlanSegmentContribution record: {create_error}")
-                        logger.error(f"Full stack trace: {traceback.format_exc()}")
-                    
-            except Exception as e:
-                logger.error(f"Error processing forecast {i+1}: {e}")
-                logger.error(f"Full stack trace: {traceback.format_exc()}")
-                continue
-        
+                    logger.error(f"Invalid pricing_plan_id format: {forecast.pricing_plan_id}, error: {e}")
+
+            series = {}
+            if forecast.revenue_forecast_ts_data:
+                series["revenue_forecast_ts_data"] = _forecast_series(forecast.revenue_forecast_ts_data, "revenue")
+            if forecast.active_subscriptions_forecast:
+                series["active_subscriptions_forecast"] = _forecast_series(forecast.active_subscriptions_forecast, "subscription")
+            resolved.append((i, segment_id, plan_id, series))
+
+        # New contributions need a pricing plan that exists; check them all in one query
+        unknown_plans = {plan_id for _, _, plan_id, _ in resolved if plan_id} - {c.get("pricing_plan") for c in contributions}
+        known_plans = {plan["_id"] for plan in ProductPricingModel._get_collection().find({"_id": {"$in": list(unknown_plans)}}, {"_id": 1})} if unknown_plans else set()
+        known_plans |= {c.get("pricing_plan") for c in contributions}
+
+        operations = []
+        for i, segment_id, plan_id, series in resolved:
+            # Written in the configured TIMESERIES_BACKEND format
+            update = series_update(series)
+            # The forecast updates the first contribution matching whichever of segment and plan it names
+            existing = next((
+                c for c in contributions
+                if (segment_id is None or c.get("customer_segment") == segment_id)
+                and (plan_id is None or c.get("pricing_plan") == plan_id)
+            ), None)
+            if existing:
+                if update:
+                    operations.append(UpdateOne(existing["filter"], update))
+            elif segment_id and plan_id in known_plans:
+                logger.info(f"No existing PricingPlanSegmentContribution record found for forecast {i+1}, creating one")
+                key = {"product": product_obj_id, "customer_segment": segment_id, "pricing_plan": plan_id}
+                # New records start with empty history, as create_pricing_plan_segment_contribution makes them
+                on_insert = {"revenue_ts_data": [], **({} if "revenue_forecast_ts_data" in series else {"revenue_forecast_ts_data": []})}
+                operations.append(UpdateOne(key, {"$setOnInsert": on_insert, **update}, upsert=True))
+                # Later forecasts for the same segment and plan update the record this creates
+                contributions.append({"filter": key, "customer_segment": segment_id, "pricing_plan": plan_id})
+            else:
+                logger.error(f"Cannot create record - missing segment ({segment_id is not None}) or pricing plan ({plan_id in known_plans}) for forecast {i+1}")
+
+        if new_segments:
+            segment_collection.insert_many(new_segments, ordered=False)
+            logger.info(f"Created {len(new_segments)} customer segments")
+
+        if operations:
+            # Ordered, so a record created by an upsert exists for the updates after it
+            result = contribution_collection.bulk_write(operations, ordered=True)
+            logger.info(f"Saved forecasts: {result.modified_count} contributions updated, {result.upserted_count} created")
+
         logger.info("Completed saving pricing forecasts")
         
     except Exception as e:
@@ -309,187 +196,204 @@ def save_pricing_forecasts(product_id: str, parsed_response: PricingAnalysisResp
         logger.error(f"Full stack trace: {traceback.format_exc()}")
         return
 
-def agent(product_id: str, segment_ids: List[str]=None, pricing_objective=None):
+def build_request(product_id: str, segment_ids: List[str]=None, pricing_objective=None):
+    """Gather segment and plan contribution data and assemble the pricing analysis request"""
+    # Validate inputs
+    if not product_id:
+        logger.error("product_id is required")
+        raise AnalysisInputError("Error: Product ID is required")
+    
+    # Validate and convert product_id to ObjectId
     try:
-        logger.info(f"Starting pricing analysis for product {product_id}")
+        product_obj_id = ObjectId(product_id)
+    except Exception as e:
+        logger.error(f"Invalid product_id format: {product_id}, error: {e}")
+        logger.error(f"Full stack trace: {traceback.format_exc()}")
+        raise AnalysisInputError("Error: Invalid product ID format")
+
+    # Get product data
+    try:
+        product = Product.objects(id=product_obj_id).first()
+    except Exception as e:
+        logger.error(f"Error fetching product: {e}")
+        logger.error(f"Full stack trace: {traceback.format_exc()}")
+        raise AnalysisInputError("Error: Could not fetch product data")
+    if not product:
+        logger.error(f"Product not found with ID: {product_id}")
+        raise AnalysisInputError("Error: Product not found")
+    logger.info(f"Retrieved product: {product.name}")
+
+    # Get customer segments with error handling
+    try:
+        if segment_ids:
+            try:
+                # Validate segment_ids format
+                segment_obj_ids = []
+                for seg_id in segment_ids:
+                    try:
+                        segment_obj_ids.append(ObjectId(seg_id))
+                    except Exception as e:
+                        logger.warning(f"Invalid segment_id format: {seg_id}, skipping")
+                
+                all_segments = CustomerSegment.objects(
+                    product=product_obj_id,
+                    id__in=segment_obj_ids
+                ).all()
+            except Exception as e:
+                logger.error(f"Error processing segment_ids: {e}")
+                logger.error(f"Full stack trace: {traceback.format_exc()}")
+                # Fallback to all segments
+                all_segments = CustomerSegment.objects(product=product_obj_id).all()
+        else:
+            all_segments = CustomerSegment.objects(product=product_obj_id).all()
         
-        # Validate inputs
-        if not product_id:
-            logger.error("product_id is required")
-            return "Error: Product ID is required"
+        logger.info(f"Retrieved {len(all_segments)} customer segments")
+    except Exception as e:
+        logger.error(f"Error fetching customer segments: {e}")
+        logger.error(f"Full stack trace: {traceback.format_exc()}")
+        raise AnalysisInputError("Error: Could not fetch customer segments")
         
-        # Validate and convert product_id to ObjectId
-        try:
-            product_obj_id = ObjectId(product_id)
-        except Exception as e:
-            logger.error(f"Invalid product_id format: {product_id}, error: {e}")
-            logger.error(f"Full stack trace: {traceback.format_exc()}")
-            return "Error: Invalid product ID format"
+    # Get pricing plan contributions
+    try:
+        all_segment_pricing_plans = PricingPlanSegmentContribution.objects(
+            product=product_obj_id,
+            customer_segment__in=all_segments
+        ).all()
+        logger.info(f"Retrieved {len(all_segment_pricing_plans)} pricing plan contributions")
+    except Exception as e:
+        logger.error(f"Error fetching pricing plan contributions: {e}")
+        logger.error(f"Full stack trace: {traceback.format_exc()}")
+        raise AnalysisInputError("Error: Could not fetch pricing plan data")
 
-        # Get product data
-        try:
-            product = Product.objects(id=product_obj_id).first()
-            if not product:
-                logger.error(f"Product not found with ID: {product_id}")
-                return "Error: Product not found"
-            logger.info(f"Retrieved product: {product.name}")
-        except Exception as e:
-            logger.error(f"Error fetching product: {e}")
-            logger.error(f"Full stack trace: {traceback.format_exc()}")
-            return "Error: Could not fetch product data"
+    # Build markdown table for segmentwise usage/revenue
+    try:
+        table_rows = ["| Segment | Plan | Current Revenue | Current Subscriptions | Forecast Revenue | Forecast Subscriptions |"]
+        table_rows.append("|---------|------|-----------------|----------------------|------------------|------------------------|")
 
-        # Get customer segments with error handling
-        try:
-            if segment_ids:
+        for plan_contribution in all_segment_pricing_plans:
+            try:
+                # Safely access segment name
                 try:
-                    # Validate segment_ids format
-                    segment_obj_ids = []
-                    for seg_id in segment_ids:
-                        try:
-                            segment_obj_ids.append(ObjectId(seg_id))
-                        except Exception as e:
-                            logger.warning(f"Invalid segment_id format: {seg_id}, skipping")
-                    
-                    all_segments = CustomerSegment.objects(
-                        product=product_obj_id,
-                        id__in=segment_obj_ids
-                    ).all()
-                except Exception as e:
-                    logger.error(f"Error processing segment_ids: {e}")
-                    logger.error(f"Full stack trace: {traceback.format_exc()}")
-                    # Fallback to all segments
-                    all_segments = CustomerSegment.objects(product=product_obj_id).all()
-            else:
-                all_segments = CustomerSegment.objects(product=product_obj_id).all()
-            
-            logger.info(f"Retrieved {len(all_segments)} customer segments")
-        except Exception as e:
-            logger.error(f"Error fetching customer segments: {e}")
-            logger.error(f"Full stack trace: {traceback.format_exc()}")
-            return "Error: Could not fetch customer segments"
-            
-        # Get pricing plan contributions
-        try:
-            all_segment_pricing_plans = PricingPlanSegmentContribution.objects(
-                product=product_obj_id,
-                customer_segment__in=all_segments
-            ).all()
-            logger.info(f"Retrieved {len(all_segment_pricing_plans)} pricing plan contributions")
-        except Exception as e:
-            logger.error(f"Error fetching pricing plan contributions: {e}")
-            logger.error(f"Full stack trace: {traceback.format_exc()}")
-            return "Error: Could not fetch pricing plan data"
+                    segment_name = plan_contribution.customer_segment.customer_segment_name or "N/A"
+                except AttributeError:
+                    segment_name = "N/A"
+                
+                # Safely access plan name
+                try:
+                    plan_name = (plan_contribution.pricing_plan.plan_name or 
+                               plan_contribution.pricing_plan.unit_calculation_logic or 
+                               f"Plan {str(plan_contribution.pricing_plan.id)}")
+                except AttributeError:
+                    plan_name = "N/A"
 
-        # Build markdown table for segmentwise usage/revenue
-        try:
-            table_rows = ["| Segment | Plan | Current Revenue | Current Subscriptions | Forecast Revenue | Forecast Subscriptions |"]
-            table_rows.append("|---------|------|-----------------|----------------------|------------------|------------------------|")
+                # Get latest revenue and subscriptions data safely
+                try:
+                    current_revenue = latest_value(plan_contribution, "revenue_ts_data")
+                except (IndexError, AttributeError):
+                    current_revenue = 0
+                
+                try:
+                    current_subs = latest_value(plan_contribution, "active_subscriptions")
+                except (IndexError, AttributeError):
+                    current_subs = 0
 
-            for plan_contribution in all_segment_pricing_plans:
+                # Get latest forecast data safely
                 try:
-                    # Safely access segment name
-                    try:
-                        segment_name = plan_contribution.customer_segment.customer_segment_name or "N/A"
-                    except AttributeError:
-                        segment_name = "N/A"
-                    
-                    # Safely access plan name
-                    try:
-                        plan_name = (plan_contribution.pricing_plan.plan_name or 
-                                   plan_contribution.pricing_plan.unit_calculation_logic or 
-                                   f"Plan {str(plan_contribution.pricing_plan.id)}")
-                    except AttributeError:
-                        plan_name = "N/A"
+                    forecast_revenue = latest_value(plan_contribution, "revenue_forecast_ts_data")
+                except (IndexError, AttributeError):
+                    forecast_revenue = 0
+                
+                try:
+                    forecast_subs = latest_value(plan_contribution, "active_subscriptions_forecast")
+                except (IndexError, AttributeError):
+                    forecast_subs = 0
 
-                    # Get latest revenue and subscriptions data safely
-                    try:
-                        current_revenue = plan_contribution.revenue_ts_data[-1].value if plan_contribution.revenue_ts_data else 0
-                    except (IndexError, AttributeError):
-                        current_revenue = 0
-                    
-                    try:
-                        current_subs = plan_contribution.active_subscriptions[-1].value if plan_contribution.active_subscriptions else 0
-                    except (IndexError, AttributeError):
-                        current_subs = 0
+                table_rows.append(f"| {segment_name} | {plan_name} | ${current_revenue:,.0f} | {current_subs:,.0f} | ${forecast_revenue:,.0f} | {forecast_subs:,.0f} |")
+                
+            except Exception as e:
+                logger.error(f"Error processing plan contribution: {e}")
+                logger.error(f"Full stack trace: {traceback.format_exc()}")
+                table_rows.append("| Error | Error | Error | Error | Error | Error |")
 
-                    # Get latest forecast data safely
-                    try:
-                        forecast_revenue = plan_contribution.revenue_forecast_ts_data[-1].value if plan_contribution.revenue_forecast_ts_data else 0
-                    except (IndexError, AttributeError):
-                        forecast_revenue = 0
-                    
-                    try:
-                        forecast_subs = plan_contribution.active_subscriptions_forecast[-1].value if plan_contribution.active_subscriptions_forecast else 0
-                    except (IndexError, AttributeError):
-                        forecast_subs = 0
+        table_content = "\n".join(table_rows)
+        logger.info("Successfully built pricing table")
+        
+    except Exception as e:
+        logger.error(f"Error building pricing table: {e}")
+        logger.error(f"Full stack trace: {traceback.format_exc()}")
+        table_content = "Error: Could not generate pricing table"
 
-                    table_rows.append(f"| {segment_name} | {plan_name} | ${current_revenue:,.0f} | {current_subs:,.0f} | ${forecast_revenue:,.0f} | {forecast_subs:,.0f} |")
-                    
-                except Exception as e:
-                    logger.error(f"Error processing plan contribution: {e}")
-                    logger.error(f"Full stack trace: {traceback.format_exc()}")
-                    table_rows.append("| Error | Error | Error | Error | Error | Error |")
+    # Prepare prompt
+    try:
+        prompt = compose_input(
+            product,
+            ("Pricing Content", table_content),
+            ("Pricing Objective", pricing_objective),
+        )
+    except Exception as e:
+        logger.error(f"Error preparing prompt: {e}")
+        logger.error(f"Full stack trace: {traceback.format_exc()}")
+        raise AnalysisInputError("Error: Could not prepare analysis prompt")
 
-            table_content = "\n".join(table_rows)
-            logger.info("Successfully built pricing table")
-            
-        except Exception as e:
-            logger.error(f"Error building pricing table: {e}")
-            logger.error(f"Full stack trace: {traceback.format_exc()}")
-            table_content = "Error: Could not generate pricing table"
+    tools = [
+        {"type": "web_search_preview"},
+        {
+            "type": "code_interpreter",
+            "container": {"type": "auto"}
+        }
+    ]
+    
+    # Add file_search tool if vector store exists
+    try:
+        if hasattr(product, 'vector_store_id') and product.vector_store_id:
+            tools.append({
+                "type": "file_search",
+                "vector_store_ids": [product.vector_store_id]
+            })
+    except Exception as e:
+        logger.warning(f"Could not add file_search tool: {e}")
 
-        # Prepare prompt
-        try:
-            prompt = f"""
-## Product Name:
-{getattr(product, 'name', 'Unknown')}
+    return dict(
+        model="gpt-5",
+        reasoning={"effort": "low"},
+        truncation="auto",
+        tool_choice="auto",
+        max_tool_calls=10,
+        tools=tools,
+        prompt_cache_key=prompt_cache_key("pricing_analysis", product),
+        text={"format": structured_text_format(PricingAnalysisReport)},
+        input=[
+            {"role": "system", "content": pricing_analysis_system_prompt + structured_report_prompt},
+            {"role": "user", "content": prompt}
+        ]
+    )
 
-## Product Description:
-{getattr(product, 'features_description_summary', 'No description available')}
 
-## Pricing Content:
-{table_content}
-"""
-            
-            if pricing_objective:
-                prompt = f"{prompt}\n\n## Pricing Objective:\n{pricing_objective}"
-        except Exception as e:
-            logger.error(f"Error preparing prompt: {e}")
-            logger.error(f"Full stack trace: {traceback.format_exc()}")
-            return "Error: Could not prepare analysis prompt"
-        
+def log_parsed_forecasts(parsed):
+    logger.info("Successfully read structured pricing analysis")
+    logger.info(f"Parsed response type: {type(parsed)}")
+    logger.info(f"Parsed response has forecasts: {hasattr(parsed, 'forecasts')}")
+    if hasattr(parsed, 'forecasts'):
+        logger.info(f"Number of forecasts: {len(parsed.forecasts) if parsed.forecasts else 0}")
+        if parsed.forecasts:
+            for i, forecast in enumerate(parsed.forecasts):
+                logger.info(f"Forecast {i}: segment_uid={forecast.customer_segment_uid}, plan_id={forecast.pricing_plan_id}")
+    else:
+        logger.warning("Parsed response does not have forecasts attribute")
+
+
+def agent(product_id: str, segment_ids: List[str]=None, pricing_objective=None):
+    try:
+        logger.info(f"Starting pricing analysis for product {product_id}")
+
+        try:
+            request = build_request(product_id, segment_ids, pricing_objective)
+        except AnalysisInputError as e:
+            return str(e)
+
         # Call OpenAI API
         try:
-            tools = [
-                {"type": "web_search_preview"},
-                {
-                    "type": "code_interpreter",
-                    "container": {"type": "auto"}
-                }
-            ]
-            
-            # Add file_search tool if vector store exists
-            try:
-                if hasattr(product, 'vector_store_id') and product.vector_store_id:
-                    tools.append({
-                        "type": "file_search",
-                        "vector_store_ids": [product.vector_store_id]
-                    })
-            except Exception as e:
-                logger.warning(f"Could not add file_search tool: {e}")
-            
-            draft = openai_client.responses.create(
-                model="gpt-5",
-                reasoning={"effort": "low"},
-                truncation="auto",
-                tool_choice="auto",
-                max_tool_calls=10,
-                tools=tools,
-                input=[
-                    {"role": "system", "content": pricing_analysis_system_prompt},
-                    {"role": "user", "content": prompt}
-                ]
-            )
+            response = create_response("pricing_analysis", **request)
             logger.info("Successfully completed OpenAI pricing analysis")
             
         except Exception as e:
@@ -497,32 +401,17 @@ def agent(product_id: str, segment_ids: List[str]=None, pricing_objective=None):
             logger.error(f"Full stack trace: {traceback.format_exc()}")
             return "Error: Could not complete AI analysis. Please try again later."
 
-        # Parse the response with LiteLLM
+        # Read the analysis and its forecasts from the structured output
         try:
-            parsed = litellm_client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": structured_parsing_system_prompt},
-                    {"role": "user", "content": draft.output_text}
-                ],
-                response_model=PricingAnalysisResponse
-            )
-            logger.info("Successfully parsed response with LiteLLM")
-            logger.info(f"Parsed response type: {type(parsed)}")
-            logger.info(f"Parsed response has forecasts: {hasattr(parsed, 'forecasts')}")
-            if hasattr(parsed, 'forecasts'):
-                logger.info(f"Number of forecasts: {len(parsed.forecasts) if parsed.forecasts else 0}")
-                if parsed.forecasts:
-                    for i, forecast in enumerate(parsed.forecasts):
-                        logger.info(f"Forecast {i}: segment_uid={forecast.customer_segment_uid}, plan_id={forecast.pricing_plan_id}")
-            else:
-                logger.warning("Parsed response does not have forecasts attribute")
+            report = PricingAnalysisReport.model_validate_json(response.output_text)
+            parsed = report.structured
+            log_parsed_forecasts(parsed)
         except Exception as e:
-            logger.error(f"Error parsing response with LiteLLM: {e}")
+            logger.error(f"Error reading structured pricing analysis: {e}")
             logger.error(f"Full stack trace: {traceback.format_exc()}")
-            logger.error(f"Draft output text sample (first 500 chars): {draft.output_text[:500]}")
-            # Return the draft without parsing
-            return draft.output_text
+            logger.error(f"Output text sample (first 500 chars): {response.output_text[:500]}")
+            # Return the raw output without forecasts
+            return response.output_text
 
         # Save pricing forecasts
         try:
@@ -532,9 +421,41 @@ def agent(product_id: str, segment_ids: List[str]=None, pricing_objective=None):
             logger.error(f"Full stack trace: {traceback.format_exc()}")
             # Continue and return the analysis even if save fails
 
-        return draft.output_text
+        return report.analysis
         
     except Exception as e:
         logger.error(f"Unexpected error in pricing analysis agent: {e}")
         logger.error(f"Full stack trace: {traceback.format_exc()}")
-        return "Error: An unexpected error occurred during analysis"
\ No newline at end of file
+        return "Error: An unexpected error occurred during analysis"
+
+
+async def agent_async(product_id: str, segment_ids: List[str]=None, pricing_objective=None):
+    logger.info(f"Starting pricing analysis for product {product_id}")
+
+    try:
+        request = await asyncio.to_thread(build_request, product_id, segment_ids, pricing_objective)
+    except AnalysisInputError as e:
+        return str(e)
+
+    # API errors, including CircuitOpenError, propagate so the orchestrator
+    # fails the step and --resume runs it again
+    response = await acreate_response("pricing_analysis", **request)
+    logger.info("Successfully completed OpenAI pricing analysis")
+
+    try:
+        report = PricingAnalysisReport.model_validate_json(response.output_text)
+        parsed = report.structured
+        log_parsed_forecasts(parsed)
+    except Exception as e:
+        logger.error(f"Error reading structured pricing analysis: {e}")
+        logger.error(f"Full stack trace: {traceback.format_exc()}")
+        logger.error(f"Output text sample (first 500 chars): {response.output_text[:500]}")
+        return response.output_text
+
+    try:
+        await asyncio.to_thread(save_pricing_forecasts, product_id, parsed)
+    except Exception as e:
+        logger.error(f"Error saving pricing forecasts: {e}")
+        logger.error(f"Full stack trace: {traceback.format_exc()}")
+
+    return report.analysis
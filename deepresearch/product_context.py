@@ -0,0 +1,45 @@
+# Every agent's request starts with a stable prefix so the provider's prompt
+# cache can reuse it: the agent's static instructions (and tools) first, then
+# this product block rendered identically for every agent and run, and only
+# then the step's variable input. Keep anything run- or step-specific out of it.
+# The instructions differ per agent, so the cached prefix is per agent and
+# product; prompt_cache_key routes on exactly that. Bump
+# PRODUCT_CONTEXT_VERSION whenever the template changes so requests stop being
+# routed to caches warmed with the old prefix.
+PRODUCT_CONTEXT_VERSION = 1
+PRODUCT_CONTEXT_TEMPLATE = """## Product
+{name}
+
+## Product Category
+{category}
+
+## Core Features
+{features}
+
+## Ideal Customer Profile
+{icp}
+"""
+
+
+def product_context(product):
+    """Canonical product block that follows the static instructions in every agent's input"""
+    return PRODUCT_CONTEXT_TEMPLATE.format(
+        name=getattr(product, "name", None) or "Unknown",
+        category=getattr(product, "category", None) or "Not specified",
+        features=getattr(product, "features_description_summary", None) or "No description available",
+        icp=getattr(product, "icp_description", None) or "Not specified",
+    )
+
+
+def compose_input(product, *sections):
+    """Product block followed by the step's (title, body) sections; sections with an empty body are left out"""
+    parts = [product_context(product)]
+    for title, body in sections:
+        if body:
+            parts.append(f"## {title}\n{body}\n")
+    return "\n".join(parts)
+
+
+def prompt_cache_key(agent_name, product):
+    """Routing hint that keeps one agent's requests for one product on the same prompt cache"""
+    return f"{agent_name}:v{PRODUCT_CONTEXT_VERSION}:{getattr(product, 'id', None) or 'unknown'}"
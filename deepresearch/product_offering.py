@@ -1,31 +1,25 @@
+import asyncio
 from datastore.models import Product
-from utils.openai_client import openai_client
+from utils.openai_client import create_response, acreate_response
 from .prompts import product_deep_research_prompt
+from .product_context import compose_input, prompt_cache_key
 
 
 
-def agent(product_id=None, usage_scope="", pricing_objective=None):
+def build_request(product_id=None, usage_scope="", pricing_objective=None):
     product = Product.objects.get(id=product_id)
-    input_data = f"""
-## Product
-{product.name}
-
-## Core Features
-{product.features_description_summary}
-
-## Ideal Customer Profile
-{product.icp_description}
-"""
-    if usage_scope:
-        input_data = f"{input_data}\n\n## Usage Scope:\n{usage_scope}"
-    
-    if pricing_objective:
-        input_data = f"{input_data}\n\n## Pricing Objective:\n{pricing_objective}"
+    input_data = compose_input(
+        product,
+        ("Usage Scope", usage_scope),
+        ("Pricing Objective", pricing_objective),
+    )
     
-    response = openai_client.responses.create(
+    return dict(
         model="o3-deep-research",
+        background=True,
         instructions=product_deep_research_prompt,
         input=input_data,
+        prompt_cache_key=prompt_cache_key("product_offering", product),
         tools=[
             {"type": "web_search_preview"},
             {
@@ -43,5 +37,14 @@ def agent(product_id=None, usage_scope="", pricing_objective=None):
         truncation="auto",
         max_tool_calls=10
     )
-    
-    return response.output_text
\ No newline at end of file
+
+
+def agent(product_id=None, usage_scope="", pricing_objective=None):
+    response = create_response("product_offering", **build_request(product_id, usage_scope, pricing_objective))
+    return response.output_text
+
+
+async def agent_async(product_id=None, usage_scope="", pricing_objective=None):
+    request = await asyncio.to_thread(build_request, product_id, usage_scope, pricing_objective)
+    response = await acreate_response("product_offering", **request)
+    return response.output_text
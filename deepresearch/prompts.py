@@ -620,54 +620,18 @@ You are a Senior Pricing Performance Analyst specializing in diagnostic analysis
 - Maintain analytical objectivity while incorporating market context
 - Ensure forecasts are realistic and defensible considering competitive dynamics
 - Validate competitive pricing research with multiple sources where possible
-- Format output for downstream structured parsing with competitive insights integrated
+- Integrate competitive insights into both the written report and the structured forecasts
 </quality_assurance>
 """
 
-structured_parsing_system_prompt = """
-<role>
-You are a Data Parsing Specialist with expertise in structured data extraction and schema validation. Your function is to accurately transform AI-generated analysis into well-defined structured formats for systematic processing.
-</role>
+structured_report_prompt = """
+<output_format>
+Respond with a single JSON object that follows the provided schema:
+- `analysis`: your complete written report in markdown, exactly as you would otherwise present it
+- `structured`: the recommendations and forecasts from that report, mapped onto the schema's fields
 
-<parsing_mandate>
-**Primary Function**: Transform analytical content into structured format while preserving insights and business logic
-
-**Quality Standards**:
-- Maintain analytical integrity during transformation
-- Preserve key insights and recommendations from source content
-- Handle ambiguous or incomplete information gracefully
-- Ensure output is properly structured and logically consistent
-- Validate data point accuracy and business logic preservation
-</parsing_mandate>
-
-<parsing_protocol>
-**Step 1: Input Analysis & Context Recognition**
-- Examine AI-generated analysis content and structure
-- Identify target structure based on content type and analytical purpose
-- Extract key data elements and business insights
-- Note any data quality issues or missing information
-
-**Step 2: Structured Transformation**
-- Map analytical insights to appropriate structured format
-- Apply consistent data formatting and type conversion
-- Preserve business relationships and logical connections
-- Maintain accuracy of financial and numerical data
-
-**Step 3: Quality Assurance & Output**
-- Validate logical consistency of structured output
-- Ensure all critical insights are captured
-- Verify data integrity and business logic preservation
-- Return properly formatted output ready for system integration
-</parsing_protocol>
-
-<handling_instructions>
-**Missing Data**: Use appropriate null values or reasonable defaults
-**Data Type Mismatches**: Apply intelligent conversion with validation
-**Ambiguous Content**: Make reasonable interpretations and note assumptions
-**Invalid Input**: Provide partial parsing with clear error documentation
-</handling_instructions>
-
-**BEHAVIORAL INSTRUCTION**: Transform the provided analytical content into the specified structured format while preserving all insights and business logic.
+Every value in `structured` must agree with the report. Use null for optional values the report does not determine, and keep dates in YYYY-MM-DD format.
+</output_format>
 """
 
 competitive_analysis_prompt = """
@@ -1,13 +1,38 @@
+import os
+import math
+import heapq
 import random
+import hashlib
+import asyncio
 import logging
 import traceback
 from .prompts import roi_prompt
 from bson.objectid import ObjectId
-from utils.openai_client import openai_client
-from datastore.models import CustomerSegment, CustomerUsageAnalysis, PricingPlanSegmentContribution
+from utils.openai_client import create_response, acreate_response
+from datastore.models import Product, CustomerSegment, CustomerUsageAnalysis, PricingPlanSegmentContribution
+from datastore.timeseries import get_series
+from utils.token_budget import Section, count_tokens, fit_sections
+from .product_context import compose_input, product_context, prompt_cache_key
 
 logger = logging.getLogger(__name__)
 
+# Token budget for the ROI request's input. Usage analyses can run to hundreds
+# of thousands of rows per product, so the usage section falls back from the
+# full table to a per-segment rollup with a stratified sample, or the rollup
+# alone, to stay within it instead of relying on truncation="auto".
+ROI_INPUT_TOKEN_BUDGET = int(os.getenv("ROI_INPUT_TOKEN_BUDGET", "100000"))
+# Largest stratified sample drawn per customer segment
+USAGE_SAMPLE_PER_SEGMENT = int(os.getenv("USAGE_SAMPLE_PER_SEGMENT", "40"))
+# Lower bound on the tokens one usage table row takes, to skip building a full
+# table that cannot fit
+USAGE_ROW_TOKEN_ESTIMATE = 40
+# Most frequent tasks listed in the usage rollup
+TOP_TASKS_IN_ROLLUP = 20
+
+
+class AnalysisInputError(Exception):
+    """Raised when the data needed for the ROI prompt cannot be gathered"""
+
 
 def format_segments_table(segments):
     try:
@@ -87,15 +112,20 @@ def format_usage_analysis_table(usage_analyses):
         return "Error: Could not format usage analysis table"
 
 
-def sample_user_tasks(usage_analyses, sample_size=10):
-    """Sample user tasks for analysis, prioritizing diverse and high-value tasks"""
+def sample_user_tasks(usage_analyses, sample_size=10, seed=None):
+    """Sample user tasks for analysis, prioritizing diverse and high-value tasks
+
+    The same seed and analyses always give the same sample, so the request
+    (and its cache key and replay cassette) repeats between runs.
+    """
     try:
+        rng = random.Random(seed)
         if not usage_analyses:
             return []
 
-        # Convert to list if it's a queryset
+        # Convert to list if it's a queryset, in a fixed order for the seeded draw
         try:
-            usage_list = list(usage_analyses)
+            usage_list = sorted(usage_analyses, key=lambda task: str(task.id))
         except Exception as e:
             logger.error(f"Error converting usage_analyses to list: {e}")
             logger.error(f"Full stack trace: {traceback.format_exc()}")
@@ -124,7 +154,7 @@ def sample_user_tasks(usage_analyses, sample_size=10):
             try:
                 scored_sample_size = min(len(scored_tasks), int(sample_size * 0.7))
                 if scored_sample_size > 0:
-                    sampled_tasks.extend(random.sample(scored_tasks, scored_sample_size))
+                    sampled_tasks.extend(rng.sample(scored_tasks, scored_sample_size))
             except ValueError as e:
                 logger.error(f"Error sampling scored tasks: {e}")
                 logger.error(f"Full stack trace: {traceback.format_exc()}")
@@ -137,7 +167,7 @@ def sample_user_tasks(usage_analyses, sample_size=10):
                 remaining_slots = sample_size - len(sampled_tasks)
                 if remaining_slots > 0 and unscored_tasks:
                     unscored_sample_size = min(len(unscored_tasks), remaining_slots)
-                    sampled_tasks.extend(random.sample(unscored_tasks, unscored_sample_size))
+                    sampled_tasks.extend(rng.sample(unscored_tasks, unscored_sample_size))
             except ValueError as e:
                 logger.error(f"Error sampling unscored tasks: {e}")
                 logger.error(f"Full stack trace: {traceback.format_exc()}")
@@ -174,7 +204,8 @@ def get_segment_cost_revenue_data(product_id):
             return {}
 
         try:
-            contributions = PricingPlanSegmentContribution.objects(product=product_obj_id).all()
+            # select_related fetches the segments and plans in one query each instead of one per row
+            contributions = PricingPlanSegmentContribution.objects(product=product_obj_id).order_by("id").select_related()
         except Exception as e:
             logger.error(f"Error querying PricingPlanSegmentContribution for product {product_id}: {e}")
             logger.error(f"Full stack trace: {traceback.format_exc()}")
@@ -214,36 +245,20 @@ def get_segment_cost_revenue_data(product_id):
                         'min_unit_count': min_unit_count
                     }
 
-                # Aggregate revenue data
+                # Aggregate revenue and subscription data; the histories
+                # hold each contribution's series as (dates, values) arrays
                 try:
-                    for revenue_point in contribution.revenue_ts_data or []:
-                        try:
-                            segment_data[segment_uid]['total_revenue'] += revenue_point.value
-                            segment_data[segment_uid]['revenue_history'].append({
-                                'date': revenue_point.date,
-                                'value': revenue_point.value
-                            })
-                        except (AttributeError, TypeError) as e:
-                            logger.error(f"Error processing revenue point: {e}")
-                            logger.error(f"Full stack trace: {traceback.format_exc()}")
-                            continue
+                    dates, values = get_series(contribution, "revenue_ts_data")
+                    segment_data[segment_uid]['total_revenue'] += float(values.sum())
+                    segment_data[segment_uid]['revenue_history'].append((dates, values))
                 except Exception as e:
                     logger.error(f"Error processing revenue data: {e}")
                     logger.error(f"Full stack trace: {traceback.format_exc()}")
 
-                # Aggregate subscription data
                 try:
-                    for sub_point in contribution.active_subscriptions or []:
-                        try:
-                            segment_data[segment_uid]['total_subscriptions'] += sub_point.value
-                            segment_data[segment_uid]['subscription_history'].append({
-                                'date': sub_point.date,
-                                'value': sub_point.value
-                            })
-                        except (AttributeError, TypeError) as e:
-                            logger.error(f"Error processing subscription point: {e}")
-                            logger.error(f"Full stack trace: {traceback.format_exc()}")
-                            continue
+                    dates, values = get_series(contribution, "active_subscriptions")
+                    segment_data[segment_uid]['total_subscriptions'] += float(values.sum())
+                    segment_data[segment_uid]['subscription_history'].append((dates, values))
                 except Exception as e:
                     logger.error(f"Error processing subscription data: {e}")
                     logger.error(f"Full stack trace: {traceback.format_exc()}")
@@ -312,127 +327,260 @@ def format_cost_revenue_table(segment_data):
         return "Error: Could not format cost/revenue table"
 
 
-def agent(product_id, product_research, pricing_objective=None):
+def get_usage_rollup(product_obj_id):
+    """Per-segment satisfaction statistics and the most frequent tasks, computed in MongoDB"""
+    usage = CustomerUsageAnalysis.objects(product=product_obj_id)
+    score = "$predicted_customer_satisfaction_response"
+    by_segment = list(usage.aggregate([
+        {"$group": {
+            "_id": "$customer_segment",
+            "analyses": {"$sum": 1},
+            "scored": {"$sum": {"$cond": [{"$gt": [score, None]}, 1, 0]}},
+            "avg_score": {"$avg": score},
+            "min_score": {"$min": score},
+            "max_score": {"$max": score},
+            "sum_sq_score": {"$sum": {"$multiply": [score, score]}},
+        }},
+        # Ties broken by id so the rollup text, and with it the cache key, is stable
+        {"$sort": {"analyses": -1, "_id": 1}},
+    ]))
+    for row in by_segment:
+        # Population standard deviation from the running sums
+        row["std_score"] = math.sqrt(max(row["sum_sq_score"] / row["scored"] - row["avg_score"] ** 2, 0)) if row["scored"] else None
+    top_tasks = list(usage.aggregate([
+        {"$group": {
+            "_id": {"segment": "$customer_segment", "task": "$customer_task_to_agent"},
+            "count": {"$sum": 1},
+            "avg_score": {"$avg": score},
+        }},
+        {"$sort": {"count": -1, "_id.segment": 1, "_id.task": 1}},
+        {"$limit": TOP_TASKS_IN_ROLLUP},
+    ]))
+    return by_segment, top_tasks
+
+
+def _score(value):
+    return f"{value:.2f}" if isinstance(value, (int, float)) else "N/A"
+
+
+def format_usage_rollup(rollup, segment_names, total_analyses):
+    """Render get_usage_rollup() as markdown tables"""
+    by_segment, top_tasks = rollup
+    lines = [
+        f"Rollup of all {total_analyses:,} usage analyses.",
+        "",
+        "| Segment | Analyses | Scored | Avg Satisfaction | Min | Max | Std Dev |",
+        "|---------|----------|--------|------------------|-----|-----|---------|",
+    ]
+    for row in by_segment:
+        name = segment_names.get(row["_id"], "Unassigned")
+        lines.append(
+            f"| {name} | {row['analyses']:,} | {row['scored']:,} | {_score(row['avg_score'])} | "
+            f"{_score(row['min_score'])} | {_score(row['max_score'])} | {_score(row['std_score'])} |"
+        )
+    if top_tasks:
+        lines += [
+            "",
+            f"Most frequent tasks (top {len(top_tasks)}):",
+            "",
+            "| Segment | Task Description | Count | Avg Satisfaction |",
+            "|---------|------------------|-------|------------------|",
+        ]
+        for row in top_tasks:
+            name = segment_names.get(row["_id"].get("segment"), "Unassigned")
+            task = str(row["_id"].get("task") or "N/A")
+            task = task[:80] + "..." if len(task) > 80 else task
+            lines.append(f"| {name} | {task} | {row['count']:,} | {_score(row['avg_score'])} |")
+    return "\n".join(lines) + "\n"
+
+
+def _sample_rank(product_obj_id, segment_id, doc_id):
+    """A stable pseudo-random rank for one usage analysis within its segment"""
+    key = f"{product_obj_id}:{segment_id}:{doc_id}".encode()
+    return hashlib.blake2b(key, digest_size=8).digest()
+
+
+def get_stratified_usage_sample(product_obj_id, segment_ids, per_segment=USAGE_SAMPLE_PER_SEGMENT):
+    """Up to per_segment usage analyses from each segment and from unassigned rows, in a stable pseudo-random order
+
+    Rows are ranked by a hash of product, segment and id rather than drawn
+    with $sample, so the same data always gives the same sample and the
+    request can be cached and replayed. Only ids are streamed to rank them.
+    Returns {segment id: [CustomerUsageAnalysis]}, with segment references resolved in one query.
+    """
+    sampled_ids = {}
+    for segment_id in list(segment_ids) + [None]:
+        stratum = CustomerUsageAnalysis.objects(product=product_obj_id, customer_segment=segment_id)
+        ids = (doc["_id"] for doc in stratum.aggregate([{"$project": {"_id": 1}}]))
+        sampled_ids[segment_id] = heapq.nsmallest(per_segment, ids, key=lambda doc_id: _sample_rank(product_obj_id, segment_id, doc_id))
+    all_ids = [doc_id for ids in sampled_ids.values() for doc_id in ids]
+    docs = {doc.id: doc for doc in CustomerUsageAnalysis.objects(id__in=all_ids).select_related()} if all_ids else {}
+    return {segment_id: [docs[doc_id] for doc_id in ids if doc_id in docs] for segment_id, ids in sampled_ids.items()}
+
+
+def render_full_usage_table(product_obj_id, total_analyses, max_tokens):
+    """The complete usage analysis table, or None when it cannot fit in max_tokens"""
+    if total_analyses * USAGE_ROW_TOKEN_ESTIMATE > max_tokens:
+        return None
+    usage = CustomerUsageAnalysis.objects(product=product_obj_id).order_by("id").select_related()
+    return f"Complete usage analysis data ({total_analyses:,} analyses).\n\n" + format_usage_analysis_table(usage)
+
+
+def render_sampled_usage(stratified_sample, rollup_text, max_tokens):
+    """The usage rollup followed by as large an even slice of the stratified sample as fits in max_tokens"""
+    strata = [rows for rows in stratified_sample.values() if rows]
+    if not strata:
+        return None
+    available = max_tokens - count_tokens(rollup_text, "gpt-5")
+    per_segment = min(available // (USAGE_ROW_TOKEN_ESTIMATE * len(strata)), max(len(rows) for rows in strata))
+    # The row estimate is a lower bound, so halve the slice until it really fits
+    while per_segment >= 1:
+        rows = [row for stratum in strata for row in stratum[:per_segment]]
+        text = (
+            rollup_text
+            + f"\nStratified sample (up to {per_segment} analyses per segment, {len(rows)} in total):\n\n"
+            + format_usage_analysis_table(rows)
+        )
+        if count_tokens(text, "gpt-5") <= max_tokens:
+            return text
+        per_segment //= 2
+    return None
+
+
+def build_request(product_id, product_research, pricing_objective=None):
+    """Gather segment, usage and revenue data and assemble the ROI analysis request"""
+    # Validate inputs
+    if not product_id:
+        logger.error("product_id is required")
+        raise AnalysisInputError("Error: Product ID is required")
+    
+    if not product_research:
+        logger.warning("product_research is empty, proceeding with analysis")
+    
+    # Get all required data with error handling
     try:
-        logger.info(f"Starting segmentwise ROI analysis for product {product_id}")
-        
-        # Validate inputs
-        if not product_id:
-            logger.error("product_id is required")
-            return "Error: Product ID is required"
-        
-        if not product_research:
-            logger.warning("product_research is empty, proceeding with analysis")
-        
-        # Get all required data with error handling
-        try:
-            product_obj_id = ObjectId(product_id)
-            all_segments = CustomerSegment.objects(product=product_obj_id).all()
-            logger.info(f"Retrieved {len(all_segments)} customer segments")
-        except Exception as e:
-            logger.error(f"Error fetching customer segments for product {product_id}: {e}")
-            logger.error(f"Full stack trace: {traceback.format_exc()}")
-            return "Error: Could not fetch customer segments"
+        product_obj_id = ObjectId(product_id)
+        product = Product.objects(id=product_obj_id).first()
+        # Every query feeding the prompt has an explicit order, so unchanged
+        # data gives an identical request and the response cache hits
+        all_segments = CustomerSegment.objects(product=product_obj_id).order_by("id")
+        logger.info(f"Retrieved {len(all_segments)} customer segments")
+    except Exception as e:
+        logger.error(f"Error fetching customer segments for product {product_id}: {e}")
+        logger.error(f"Full stack trace: {traceback.format_exc()}")
+        raise AnalysisInputError("Error: Could not fetch customer segments")
 
-        try:
-            all_usage_analysis = CustomerUsageAnalysis.objects(product=product_obj_id).all()
-            logger.info(f"Retrieved {len(all_usage_analysis)} usage analyses")
-        except Exception as e:
-            logger.error(f"Error fetching usage analysis for product {product_id}: {e}")
-            logger.error(f"Full stack trace: {traceback.format_exc()}")
-            return "Error: Could not fetch usage analysis data"
+    # Only bounded summaries of the usage analyses are loaded; the full table is read later if it fits the budget
+    try:
+        total_analyses = CustomerUsageAnalysis.objects(product=product_obj_id).count()
+        usage_rollup = get_usage_rollup(product_obj_id)
+        stratified_sample = get_stratified_usage_sample(product_obj_id, [segment.id for segment in all_segments])
+        logger.info(f"Summarized {total_analyses} usage analyses")
+    except Exception as e:
+        logger.error(f"Error fetching usage analysis for product {product_id}: {e}")
+        logger.error(f"Full stack trace: {traceback.format_exc()}")
+        raise AnalysisInputError("Error: Could not fetch usage analysis data")
 
-        # Get cost and revenue data
-        try:
-            segment_cost_revenue = get_segment_cost_revenue_data(product_id)
-            logger.info(f"Retrieved cost/revenue data for {len(segment_cost_revenue)} segments")
-        except Exception as e:
-            logger.error(f"Error getting cost/revenue data: {e}")
-            logger.error(f"Full stack trace: {traceback.format_exc()}")
-            segment_cost_revenue = {}
+    # Get cost and revenue data
+    try:
+        segment_cost_revenue = get_segment_cost_revenue_data(product_id)
+        logger.info(f"Retrieved cost/revenue data for {len(segment_cost_revenue)} segments")
+    except Exception as e:
+        logger.error(f"Error getting cost/revenue data: {e}")
+        logger.error(f"Full stack trace: {traceback.format_exc()}")
+        segment_cost_revenue = {}
 
-        # Sample user tasks for detailed analysis
-        try:
-            sampled_tasks = sample_user_tasks(all_usage_analysis, sample_size=15)
-            logger.info(f"Sampled {len(sampled_tasks)} tasks for analysis")
-        except Exception as e:
-            logger.error(f"Error sampling user tasks: {e}")
-            logger.error(f"Full stack trace: {traceback.format_exc()}")
-            sampled_tasks = []
+    # Sample user tasks for detailed analysis
+    try:
+        sampled_tasks = sample_user_tasks([row for rows in stratified_sample.values() for row in rows], sample_size=15, seed=product_id)
+        logger.info(f"Sampled {len(sampled_tasks)} tasks for analysis")
+    except Exception as e:
+        logger.error(f"Error sampling user tasks: {e}")
+        logger.error(f"Full stack trace: {traceback.format_exc()}")
+        sampled_tasks = []
 
-        # Format tables with error handling
-        try:
-            segments_table = format_segments_table(all_segments)
-        except Exception as e:
-            logger.error(f"Error formatting segments table: {e}")
-            logger.error(f"Full stack trace: {traceback.format_exc()}")
-            segments_table = "Error: Could not format segments table"
+    # Format tables with error handling
+    try:
+        segments_table = format_segments_table(all_segments)
+    except Exception as e:
+        logger.error(f"Error formatting segments table: {e}")
+        logger.error(f"Full stack trace: {traceback.format_exc()}")
+        segments_table = "Error: Could not format segments table"
 
-        try:
-            full_usage_table = format_usage_analysis_table(all_usage_analysis)
-        except Exception as e:
-            logger.error(f"Error formatting full usage table: {e}")
-            logger.error(f"Full stack trace: {traceback.format_exc()}")
-            full_usage_table = "Error: Could not format usage analysis table"
+    try:
+        segment_names = {segment.id: segment.customer_segment_name or "N/A" for segment in all_segments}
+        rollup_text = format_usage_rollup(usage_rollup, segment_names, total_analyses)
+    except Exception as e:
+        logger.error(f"Error formatting usage rollup: {e}")
+        logger.error(f"Full stack trace: {traceback.format_exc()}")
+        rollup_text = "Error: Could not format usage rollup"
 
-        try:
-            sampled_usage_table = format_usage_analysis_table(sampled_tasks)
-        except Exception as e:
-            logger.error(f"Error formatting sampled usage table: {e}")
-            logger.error(f"Full stack trace: {traceback.format_exc()}")
-            sampled_usage_table = "Error: Could not format sampled usage table"
+    try:
+        sampled_usage_table = format_usage_analysis_table(sampled_tasks)
+    except Exception as e:
+        logger.error(f"Error formatting sampled usage table: {e}")
+        logger.error(f"Full stack trace: {traceback.format_exc()}")
+        sampled_usage_table = "Error: Could not format sampled usage table"
 
-        try:
-            cost_revenue_table = format_cost_revenue_table(segment_cost_revenue)
-        except Exception as e:
-            logger.error(f"Error formatting cost/revenue table: {e}")
-            logger.error(f"Full stack trace: {traceback.format_exc()}")
-            cost_revenue_table = "Error: Could not format cost/revenue table"
+    try:
+        cost_revenue_table = format_cost_revenue_table(segment_cost_revenue)
+    except Exception as e:
+        logger.error(f"Error formatting cost/revenue table: {e}")
+        logger.error(f"Full stack trace: {traceback.format_exc()}")
+        cost_revenue_table = "Error: Could not format cost/revenue table"
 
-        # Prepare input text
+    # Prepare input text
+    try:
+        section_budget = ROI_INPUT_TOKEN_BUDGET - count_tokens(roi_prompt + product_context(product), "gpt-5")
+        # Usage data gets the largest share of the budget, most detailed rendering first.
+        # The full table is read and rendered once; fit_sections drops it if it outgrows its share
+        full_usage_table = render_full_usage_table(product_obj_id, total_analyses, section_budget) if total_analyses else None
+        usage_candidates = [candidate for candidate in (
+            full_usage_table,
+            lambda max_tokens: render_sampled_usage(stratified_sample, rollup_text, max_tokens),
+            rollup_text,
+        ) if candidate is not None] if total_analyses else ["No usage analyses found."]
+        sections = fit_sections([
+            Section("Product Research Context", [product_research or "No product research provided"], 3),
+            Section("Customer Segments Overview", [segments_table], 1),
+            Section("Cost & Revenue Analysis by Segment", [cost_revenue_table], 1),
+            Section("Usage Analysis Data", usage_candidates, 6),
+            Section("Sampled User Tasks Analysis (15 representative tasks)", [sampled_usage_table], 1),
+            Section("Pricing Objective", [pricing_objective] if pricing_objective else [], 1),
+        ], section_budget, model="gpt-5")
+        input_text = compose_input(product, *sections)
+    except Exception as e:
+        logger.error(f"Error preparing input text: {e}")
+        logger.error(f"Full stack trace: {traceback.format_exc()}")
+        raise AnalysisInputError("Error: Could not prepare analysis input")
+
+    return dict(
+        model="gpt-5",
+        instructions=roi_prompt,
+        input=input_text,
+        prompt_cache_key=prompt_cache_key("segmentwise_roi", product),
+        reasoning={"effort": "high"},
+        truncation="auto",
+        tools=[
+            {"type": "code_interpreter", "container": {"type": "auto"}}
+        ],
+        tool_choice="auto",
+        max_tool_calls=10
+    )
+
+
+def agent(product_id, product_research, pricing_objective=None):
+    try:
+        logger.info(f"Starting segmentwise ROI analysis for product {product_id}")
+        
         try:
-            input_text = f"""
-## Product Research Context
-{product_research}
-
----
-## Customer Segments Overview
-{segments_table}
-
----
-## Cost & Revenue Analysis by Segment
-{cost_revenue_table}
-
----
-## Sampled User Tasks Analysis (15 representative tasks)
-{sampled_usage_table}
-
----
-## Complete Usage Analysis Data
-{full_usage_table}
-"""
-            
-            if pricing_objective:
-                input_text = f"{input_text}\n\n---\n## Pricing Objective\n{pricing_objective}"
-        except Exception as e:
-            logger.error(f"Error preparing input text: {e}")
-            logger.error(f"Full stack trace: {traceback.format_exc()}")
-            return "Error: Could not prepare analysis input"
+            request = build_request(product_id, product_research, pricing_objective)
+        except AnalysisInputError as e:
+            return str(e)
 
         # Call OpenAI API with error handling
         try:
-            thoughts = openai_client.responses.create(
-                model="gpt-5",
-                instructions=roi_prompt,
-                input=input_text,
-                reasoning={"effort": "high"},
-                truncation="auto",
-                tools=[
-                    {"type": "code_interpreter", "container": {"type": "auto"}}
-                ],
-                tool_choice="auto",
-                max_tool_calls=10
-            )
+            thoughts = create_response("segmentwise_roi", **request)
             
             logger.info("Successfully completed OpenAI analysis")
             return thoughts.output_text
@@ -445,4 +593,19 @@ def agent(product_id, product_research, pricing_objective=None):
     except Exception as e:
         logger.error(f"Unexpected error in segmentwise ROI agent: {e}")
         logger.error(f"Full stack trace: {traceback.format_exc()}")
-        return "Error: An unexpected error occurred during analysis"
\ No newline at end of file
+        return "Error: An unexpected error occurred during analysis"
+
+
+async def agent_async(product_id, product_research, pricing_objective=None):
+    logger.info(f"Starting segmentwise ROI analysis for product {product_id}")
+
+    try:
+        request = await asyncio.to_thread(build_request, product_id, product_research, pricing_objective)
+    except AnalysisInputError as e:
+        return str(e)
+
+    # API errors, including CircuitOpenError, propagate so the orchestrator
+    # fails the step and --resume runs it again
+    thoughts = await acreate_response("segmentwise_roi", **request)
+    logger.info("Successfully completed OpenAI analysis")
+    return thoughts.output_text
@@ -1,4 +1,4 @@
-from utils.openai_client import openai_client, litellm_client
+from utils.openai_client import create_response, acreate_response
 from .prompts import rabbithole_think_prompt, value_capture_analysis_prompt
  
 
@@ -21,7 +21,8 @@ tools = [
 ]
 
 def go_down_rabbithole(hypothesis: str):
-    thoughts = openai_client.responses.create(
+    thoughts = create_response(
+        "rabbithole",
         model="gpt-5",
         instructions=rabbithole_think_prompt,
         input=hypothesis,
@@ -29,11 +30,11 @@ def go_down_rabbithole(hypothesis: str):
     )
     return thoughts.output_text
 
-def agent(segment_roi_analysis, pricing_analysis, product_research, pricing_objective=None):
-    thoughts = openai_client.responses.create(
+def build_request(segment_roi_analysis, pricing_analysis, product_research, pricing_objective=None):
+    return dict(
         model="gpt-5",
         instructions=value_capture_analysis_prompt,
-        input=f"## Product Research Context\n{product_research}\n\n----------------------------------\n\n## Segment-wise ROI analysis for customer\n{segment_roi_analysis}\n\n----------------------------------\n\n## Pricing Analysis Report\n{pricing_analysis}" + (f"\n\n----------------------------------\n\n## Pricing Objective\n{pricing_objective}" if pricing_objective else ""),
+        input=f"## Product Research Context\n{product_research or 'No product research provided'}\n\n----------------------------------\n\n## Segment-wise ROI analysis for customer\n{segment_roi_analysis}\n\n----------------------------------\n\n## Pricing Analysis Report\n{pricing_analysis}" + (f"\n\n----------------------------------\n\n## Pricing Objective\n{pricing_objective}" if pricing_objective else ""),
         reasoning={"effort": "high", "summary": "detailed"},
         truncation="auto",
         tools=[
@@ -43,4 +44,11 @@ def agent(segment_roi_analysis, pricing_analysis, product_research, pricing_obje
             }
         ]
     )
-    return thoughts.output_text
\ No newline at end of file
+
+def agent(segment_roi_analysis, pricing_analysis, product_research, pricing_objective=None):
+    thoughts = create_response("value_capture_analysis", **build_request(segment_roi_analysis, pricing_analysis, product_research, pricing_objective))
+    return thoughts.output_text
+
+async def agent_async(segment_roi_analysis, pricing_analysis, product_research, pricing_objective=None):
+    thoughts = await acreate_response("value_capture_analysis", **build_request(segment_roi_analysis, pricing_analysis, product_research, pricing_objective))
+    return thoughts.output_text
@@ -2,25 +2,33 @@ import os
 import sys
 import json
 import argparse
-from orchestrator import final_agent
+from orchestrator import final_agent, resume_agent, fleet_agent, watch_orchestration
+from utils.response_cache import set_cache_enabled
+from utils.batch import set_batch_mode
+from utils.routing import ROUTING_PROFILES, set_profile
 from datastore.connectors import (
     connect_db,
-    create_from_json_file,
+    bulk_load_json_file,
+    format_load_report,
     delete_one,
     delete_many,
     get_one,
     list_all_ids,
     list_one_markdown,
     list_all_markdown,
+    ensure_indexes,
+    explain_queries,
+    format_index_report,
 )
+from datastore.timeseries import TIMESERIES_BACKENDS, migrate_timeseries, format_migration_report
 from dotenv import load_dotenv
 
 load_dotenv()
 connect_db()
 
 
-def process_json_file(path):
-    return create_from_json_file(path)
+def process_json_file(path, batch_size=None, stream=False):
+    return bulk_load_json_file(path, batch_size, stream)
 
  
 
@@ -73,6 +81,28 @@ Examples:
   # Run pricing analysis
   python main.py --orchestrator --product-id PROD123 --use-case "SaaS optimization"
   
+  # Run pricing analysis for several products (or the whole catalogue) in one process
+  python main.py --orchestrator --product-ids PROD123,PROD456 --max-concurrent-products 2
+  python main.py --orchestrator --all-products
+  
+  # Cap each step at 20 minutes and the whole run at 2 hours
+  python main.py --orchestrator --product-id PROD123 --step-timeout 1200 --run-budget 7200
+  
+  # Overnight run: send the eligible model calls through the Batch API at about half the cost
+  python main.py --orchestrator --all-products --mode batch
+  
+  # Quick what-if pass with mini models and low reasoning effort
+  python main.py --orchestrator --product-id PROD123 --profile fast --pricing-objective "..."
+  
+  # Re-run the analysis without serving agent responses from the cache
+  python main.py --orchestrator --product-id PROD123 --no-cache
+  
+  # Resume an interrupted analysis, skipping its completed steps
+  python main.py --resume 3f2b6c1e-...-invocation-id
+  
+  # Follow a running analysis from another terminal
+  python main.py --watch 3f2b6c1e-...-invocation-id
+  
   # List all products
   python main.py --listall products
   
@@ -81,6 +111,12 @@ Examples:
   
   # Delete a customer segment
   python main.py --delete customer_segments SEG789
+
+  # Build indexes and check that lookups use them
+  python main.py --ensure-indexes --product-id PROD123
+
+  # Move time series to packed columnar storage, then set TIMESERIES_BACKEND=columnar
+  python main.py --migrate-timeseries columnar
     """
     
     parser = argparse.ArgumentParser(
@@ -101,6 +137,16 @@ Examples:
         action="store_true",
         help="Run comprehensive pricing analysis and generate recommendations"
     )
+    mode.add_argument(
+        "--resume",
+        metavar="INVOCATION_ID",
+        help="Resume an orchestration from its last checkpoint, re-running only incomplete steps"
+    )
+    mode.add_argument(
+        "--watch",
+        metavar="INVOCATION_ID",
+        help="Follow a running orchestration's step status and streamed partial output"
+    )
     mode.add_argument(
         "--delete", 
         nargs=2, 
@@ -126,6 +172,17 @@ Examples:
         metavar=("collection",),
         help="List all documents in the specified collection"
     )
+    mode.add_argument(
+        "--ensure-indexes",
+        action="store_true",
+        help="Build the datastore indexes and show the query plans of the agents' hot-path lookups (uses --product-id if given)"
+    )
+    mode.add_argument(
+        "--migrate-timeseries",
+        choices=TIMESERIES_BACKENDS,
+        metavar="BACKEND",
+        help="Convert stored pricing plan/segment time series to the columnar (packed arrays) or embedded (sub-documents) format; limited to --product-id if given"
+    )
 
     # Input/Output options
     io_group = parser.add_mutually_exclusive_group(required=False)
@@ -135,6 +192,17 @@ Examples:
         metavar="FILE",
         help="Input JSON file path (required with --create)"
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        metavar="N",
+        help="Documents per bulk write when importing with --create (default: BULK_BATCH_SIZE or 1000) or migrating time series (default 500)"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Parse the --create JSON file incrementally so memory stays flat for very large files (.ndjson/.jsonl files are always streamed)"
+    )
     
 
     # Additional parameters
@@ -143,6 +211,22 @@ Examples:
         metavar="ID",
         help="Product ID for orchestrator analysis (required with --orchestrator)"
     )
+    parser.add_argument(
+        "--product-ids",
+        metavar="IDS",
+        help="Comma-separated product IDs to analyse in one fleet run (with --orchestrator)"
+    )
+    parser.add_argument(
+        "--all-products",
+        action="store_true",
+        help="Analyse every product in the database in one fleet run (with --orchestrator)"
+    )
+    parser.add_argument(
+        "--max-concurrent-products",
+        type=int,
+        metavar="N",
+        help="Maximum number of products orchestrated at once in a fleet run (default: FLEET_MAX_CONCURRENT_PRODUCTS or 4)"
+    )
     parser.add_argument(
         "--use-case",
         metavar="DESCRIPTION",
@@ -153,6 +237,33 @@ Examples:
         metavar="OBJECTIVE",
         help="Optional pricing objective to guide the analysis (e.g., 'maximize revenue', 'increase market share', 'optimize for retention')"
     )
+    parser.add_argument(
+        "--step-timeout",
+        type=float,
+        metavar="SECONDS",
+        help="Cancel any pipeline step still running after this many seconds (default: STEP_TIMEOUT_SECONDS or 3600; 0 disables)"
+    )
+    parser.add_argument(
+        "--run-budget",
+        type=float,
+        metavar="SECONDS",
+        help="Wall-clock budget for a whole orchestration run; steps still running when it is spent are cancelled (default: RUN_BUDGET_SECONDS, off)"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["interactive", "batch"],
+        help="Execution mode for orchestrations: batch submits the segment ROI, value capture, pricing analysis and pricing recommendation calls through the OpenAI Batch API, finishing within 24h (default: LLM_EXECUTION_MODE or interactive)"
+    )
+    parser.add_argument(
+        "--profile",
+        choices=sorted(ROUTING_PROFILES),
+        help="Model routing profile: fast uses mini models, low reasoning effort and fewer tool calls for quick what-if runs, thorough raises effort and tool calls (default: LLM_ROUTING_PROFILE or standard; --resume keeps the run's profile)"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Bypass the agent response cache and call every model afresh"
+    )
     
     return parser
 
@@ -162,22 +273,57 @@ Examples:
 parser = build_parser()
 args = parser.parse_args()
 
+if args.no_cache:
+    set_cache_enabled(False)
+
+if args.mode:
+    set_batch_mode(args.mode == "batch")
+
+if args.profile:
+    set_profile(args.profile)
+
 if args.create:
     if not args.input_json:
         parser.error("--json is required with --create")
 
-    product, pricing_models, segments = process_json_file(args.input_json)
+    product, pricing_models, segments, load_stats = process_json_file(args.input_json, args.batch_size, args.stream)
 
     print_creation_results(product, pricing_models, segments)
+    print(format_load_report(load_stats))
 
+elif args.orchestrator and (args.product_ids or args.all_products):
+    if args.all_products:
+        product_ids = list_all_ids("products")
+    else:
+        product_ids = [x.strip() for x in args.product_ids.split(",") if x.strip()]
+    if not product_ids:
+        parser.error("no products to analyse")
+    results = fleet_agent(product_ids, args.use_case, args.pricing_objective, args.max_concurrent_products, args.step_timeout, args.run_budget)
+    if any(result["status"] != "completed" for result in results):
+        sys.exit(1)
 elif args.orchestrator:
     if not args.product_id:
-        parser.error("--product-id is required with --orchestrator")
+        parser.error("--product-id, --product-ids or --all-products is required with --orchestrator")
     try:
-        final_agent(str(args.product_id), args.use_case, None, args.pricing_objective)
+        final_agent(str(args.product_id), args.use_case, None, args.pricing_objective, args.step_timeout, args.run_budget)
         print("Orchestrator run complete")
     except Exception as e:
         print(f"Error running orchestrator.final_agent: {e}")
+elif args.resume:
+    try:
+        resume_agent(args.resume, args.step_timeout, args.run_budget)
+        print("Orchestrator run complete")
+    except Exception as e:
+        print(f"Error resuming orchestration {args.resume}: {e}")
+        sys.exit(1)
+elif args.watch:
+    try:
+        watch_orchestration(args.watch)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(f"Error watching orchestration {args.watch}: {e}")
+        sys.exit(1)
 elif args.delete:
     collection, doc_id = args.delete
     try:
@@ -200,6 +346,20 @@ elif args.list_one:
     except Exception as e:
         print(f"Error fetching {collection} {doc_id}: {e}")
         sys.exit(1)
+elif args.ensure_indexes:
+    try:
+        built = ensure_indexes()
+        print(format_index_report(built, explain_queries(args.product_id)))
+    except Exception as e:
+        print(f"Error ensuring indexes: {e}")
+        sys.exit(1)
+elif args.migrate_timeseries:
+    try:
+        stats = migrate_timeseries(args.migrate_timeseries, args.batch_size or 500, args.product_id)
+        print(format_migration_report(stats))
+    except Exception as e:
+        print(f"Error migrating time series: {e}")
+        sys.exit(1)
 elif args.listall:
     collection = args.listall[0]
     try:
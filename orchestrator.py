@@ -1,23 +1,33 @@
+import os
+import time
 import uuid
+from datetime import datetime
 import json
-from deepresearch.product_offering import agent as product_offering_agent
-from deepresearch.competitive_analysis import agent as competitive_analysis_agent
-from deepresearch.cashflow_analyst import agent as cashflow_analysis_agent, refinement_agent as cashflow_refinement_agent
-from deepresearch.customer_longterm_revenue_potential import agent as longterm_revenue_agent
-from deepresearch.segmentwise_roi import agent as segmentwise_roi_agent
-from deepresearch.pricing_analysis import agent as pricing_analysis_agent
-from deepresearch.value_capture_analysis import agent as value_capture_analysis_agent
-from deepresearch.experimental_pricing_recommendation import agent as experimental_pricing_recommendation_agent
-from deepresearch.analyse_positioning_material import agent as positioning_analysis_agent
-from deepresearch.persona_based_simulation import agent as persona_simulation_agent
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
+from deepresearch.product_offering import agent_async as product_offering_agent
+from deepresearch.competitive_analysis import agent_async as competitive_analysis_agent
+from deepresearch.cashflow_analyst import agent_async as cashflow_analysis_agent, refinement_agent_async as cashflow_refinement_agent
+from deepresearch.customer_longterm_revenue_potential import agent_async as longterm_revenue_agent
+from deepresearch.segmentwise_roi import agent_async as segmentwise_roi_agent
+from deepresearch.pricing_analysis import agent_async as pricing_analysis_agent
+from deepresearch.value_capture_analysis import agent_async as value_capture_analysis_agent
+from deepresearch.experimental_pricing_recommendation import agent_async as experimental_pricing_recommendation_agent
+from deepresearch.analyse_positioning_material import agent_async as positioning_analysis_agent
+from deepresearch.persona_based_simulation import agent_async as persona_simulation_agent
 from datastore.models import OrchestrationResult
-from datastore.orchestration_state import OrchestrationState, PricingAnalysisResponse, RecommendedPricingModelResponse
+from datastore.orchestration_state import OrchestrationState, OrchestrationStateManager, StepStatus, LLMCallUsage, PricingAnalysisResponse, RecommendedPricingModelResponse, STEP_DEPENDENCIES, SOFT_DEPENDENCIES, to_serializable
 from utils.pdf_generator import generate_pdf_report
+from utils.convergence import assess_convergence
+from utils.step_context import bind_step
+from utils.openai_client import acancel_background_responses, aclose_async_clients
+from utils.batch import is_batched, BATCH_STEP_TIMEOUT_SECONDS
+from utils import routing
+from utils.usage import format_usage_breakdown
+from utils.http_pool import format_connection_stats
 from tqdm import tqdm
 
 
-def save_orchestration_step(invocation_id, step_name, step_order, product_id, step_input, step_output):
+def save_orchestration_step(invocation_id, step_name, step_order, product_id, step_input, step_output, llm_calls=None):
     """Helper function to save orchestration step results to MongoDB"""
     try:
         # Convert step_input to serializable format
@@ -46,7 +56,8 @@ def save_orchestration_step(invocation_id, step_name, step_order, product_id, st
             step_order=step_order,
             product_id=str(product_id),
             step_input=serializable_input,
-            step_output=serializable_output
+            step_output=serializable_output,
+            llm_usage=[call.model_dump() if hasattr(call, 'model_dump') else call for call in llm_calls or []]
         )
         result.save()
         print(f"Saved step {step_name} (order: {step_order}) for invocation {invocation_id}")
@@ -54,15 +65,99 @@ def save_orchestration_step(invocation_id, step_name, step_order, product_id, st
         print(f"Error saving step {step_name}: {e}")
 
 
-def run_competitive_analysis(product_id, invocation_id, state):
+_checkpoint_locks = {}
+
+
+async def checkpoint_state(state):
+    """
+    Persist the full orchestration state so an interrupted run can be resumed.
+    Checkpoints for one invocation are serialized and the snapshot is taken
+    under the lock, so a slower write never overwrites a newer checkpoint.
+    """
+    lock = _checkpoint_locks.setdefault(state.invocation_id, asyncio.Lock())
+    async with lock:
+        try:
+            state_dict = state.to_orchestration_result_dict()
+            await asyncio.to_thread(OrchestrationStateManager.save_state_to_mongodb, state, state_dict)
+        except Exception as e:
+            print(f"Error checkpointing state for invocation {state.invocation_id}: {e}")
+
+
+# How often streamed partial output is written to the checkpoint
+STREAM_FLUSH_SECONDS = float(os.getenv("STREAM_FLUSH_SECONDS", "5"))
+
+
+def stream_into_step(state, step_name):
+    """Return a handler that appends streamed text to the step's output, checkpointing every STREAM_FLUSH_SECONDS"""
+    parts = []
+    last_flush = time.monotonic()
+
+    async def on_partial(delta):
+        nonlocal last_flush
+        parts.append(delta)
+        now = time.monotonic()
+        if now - last_flush >= STREAM_FLUSH_SECONDS:
+            last_flush = now
+            step = state.steps.get(step_name)
+            if step is not None and step.status == StepStatus.IN_PROGRESS:
+                step.step_output = "".join(parts)
+                await checkpoint_state(state)
+
+    return on_partial
+
+
+def record_llm_calls(step):
+    """Return a handler that appends each model call's usage record to the step"""
+    def on_usage(call):
+        step.llm_calls.append(LLMCallUsage(**call))
+
+    return on_usage
+
+
+def track_background_jobs(state, step_name):
+    """Bind step_name as the current task's step: background response ids, batch ids, streamed output and token usage are recorded on it"""
+    step = state.steps[step_name]
+    bind_step(
+        step.background_jobs,
+        lambda: checkpoint_state(state),
+        stream_into_step(state, step_name),
+        step.batch_jobs,
+        record_llm_calls(step),
+    )
+
+
+async def run_product_offering(product_id, invocation_id, state):
+    """Run product offering step"""
+    product_offering_input = {
+        "product_id": product_id,
+        "usage_scope": state.usage_scope
+    }
+    state.start_step("product_offering", 1, product_offering_input)
+    track_background_jobs(state, "product_offering")
+    try:
+        result = await product_offering_agent(product_id, state.usage_scope, state.pricing_objective)
+        state.product_research = result
+        state.complete_step("product_offering", result)
+        await checkpoint_state(state)
+        await asyncio.to_thread(save_orchestration_step, invocation_id, "product_offering", 1, product_id, product_offering_input, result, state.steps["product_offering"].llm_calls)
+        return result
+    except Exception as e:
+        error_msg = f"Error in product offering analysis: {str(e)}"
+        state.fail_step("product_offering", error_msg)
+        raise e
+
+
+async def run_competitive_analysis(product_id, invocation_id, state):
     """Run competitive analysis step"""
     competitive_input = {"product_id": product_id}
     state.start_step("competitive_analysis", 2, competitive_input)
+    track_background_jobs(state, "competitive_analysis")
     try:
-        result = competitive_analysis_agent(product_id, state.pricing_objective)
+        result = await competitive_analysis_agent(product_id, state.pricing_objective)
         state.competitive_analysis_research = result
         state.complete_step("competitive_analysis", result)
-        save_orchestration_step(invocation_id, "competitive_analysis", 2, product_id, competitive_input, result)
+        await checkpoint_state(state)
+        await asyncio.to_thread(save_orchestration_step, invocation_id, "competitive_analysis", 2, product_id, competitive_input, result, state.steps["competitive_analysis"].llm_calls)
         return result
     except Exception as e:
         error_msg = f"Error in competitive analysis: {str(e)}"
@@ -70,15 +165,17 @@ def run_competitive_analysis(product_id, invocation_id, state):
         raise e
 
 
-def run_cashflow_analysis(product_id, invocation_id, state):
+async def run_cashflow_analysis(product_id, invocation_id, state):
     """Run cashflow analysis step"""
     cashflow_input = {"product_id": product_id}
     state.start_step("cashflow_analysis", 2, cashflow_input)
+    track_background_jobs(state, "cashflow_analysis")
     try:
-        result = cashflow_analysis_agent(product_id, None, state.pricing_objective)
+        result = await cashflow_analysis_agent(product_id, None, state.pricing_objective)
         state.cashflow_analysis_research = result
         state.complete_step("cashflow_analysis", result)
-        save_orchestration_step(invocation_id, "cashflow_analysis", 2, product_id, cashflow_input, result)
+        await checkpoint_state(state)
+        await asyncio.to_thread(save_orchestration_step, invocation_id, "cashflow_analysis", 2, product_id, cashflow_input, result, state.steps["cashflow_analysis"].llm_calls)
         return result
     except Exception as e:
         error_msg = f"Error in cashflow analysis: {str(e)}"
@@ -86,18 +183,20 @@ def run_cashflow_analysis(product_id, invocation_id, state):
         raise e
 
 
-def run_segment_roi(product_id, product_research, invocation_id, state):
+async def run_segment_roi(product_id, invocation_id, state):
     """Run segmentwise ROI analysis step"""
     segment_roi_input = {
         "product_id": product_id,
-        "product_research": product_research
+        "product_research": state.product_research
     }
     state.start_step("segmentwise_roi", 3, segment_roi_input)
+    track_background_jobs(state, "segmentwise_roi")
     try:
-        result = segmentwise_roi_agent(product_id, product_research, state.pricing_objective)
+        result = await segmentwise_roi_agent(product_id, state.product_research, state.pricing_objective)
         state.segment_research = result
         state.complete_step("segmentwise_roi", result)
-        save_orchestration_step(invocation_id, "segmentwise_roi", 3, product_id, segment_roi_input, result)
+        await checkpoint_state(state)
+        await asyncio.to_thread(save_orchestration_step, invocation_id, "segmentwise_roi", 3, product_id, segment_roi_input, result, state.steps["segmentwise_roi"].llm_calls)
         return result
     except Exception as e:
         error_msg = f"Error in segmentwise ROI analysis: {str(e)}"
@@ -105,17 +204,19 @@ def run_segment_roi(product_id, product_research, invocation_id, state):
         raise e
 
 
-def run_pricing_analysis(product_id, invocation_id, state):
+async def run_pricing_analysis(product_id, invocation_id, state):
     """Run pricing analysis step"""
     pricing_analysis_input = {
         "product_id": product_id
     }
     state.start_step("pricing_analysis", 4, pricing_analysis_input)
+    track_background_jobs(state, "pricing_analysis")
     try:
-        result = pricing_analysis_agent(product_id, None, state.pricing_objective)
+        result = await pricing_analysis_agent(product_id, None, state.pricing_objective)
         state.pricing_research = result
         state.complete_step("pricing_analysis", result)
-        save_orchestration_step(invocation_id, "pricing_analysis", 4, product_id, pricing_analysis_input, result)
+        await checkpoint_state(state)
+        await asyncio.to_thread(save_orchestration_step, invocation_id, "pricing_analysis", 4, product_id, pricing_analysis_input, result, state.steps["pricing_analysis"].llm_calls)
         return result
     except Exception as e:
         error_msg = f"Error in pricing analysis: {str(e)}"
@@ -123,105 +224,264 @@ def run_pricing_analysis(product_id, invocation_id, state):
         raise e
 
 
-def run_positioning_analysis(product_id, experimental_pricing_research, iteration, invocation_id, state):
+async def run_longterm_revenue(product_id, invocation_id, state):
+    """Run long-term revenue analysis step"""
+    longterm_revenue_input = {
+        "product_id": product_id,
+        "segment_research": state.segment_research,
+        "pricing_research": state.pricing_research,
+        "product_research": state.product_research
+    }
+    state.start_step("longterm_revenue", 5, longterm_revenue_input)
+    track_background_jobs(state, "longterm_revenue")
+    try:
+        result = await longterm_revenue_agent(product_id, state.segment_research, state.pricing_research, state.product_research, state.pricing_objective)
+        state.longterm_revenue_research = result
+        state.complete_step("longterm_revenue", result)
+        await checkpoint_state(state)
+        await asyncio.to_thread(save_orchestration_step, invocation_id, "longterm_revenue", 5, product_id, longterm_revenue_input, result, state.steps["longterm_revenue"].llm_calls)
+        return result
+    except Exception as e:
+        error_msg = f"Error in long-term revenue analysis: {str(e)}"
+        state.fail_step("longterm_revenue", error_msg)
+        raise e
+
+
+async def run_value_capture_analysis(product_id, invocation_id, state):
+    """Run value capture analysis step"""
+    value_capture_input = {
+        "segment_research": state.segment_research,
+        "pricing_research": state.pricing_research,
+        "product_research": state.product_research
+    }
+    state.start_step("value_capture_analysis", 6, value_capture_input)
+    track_background_jobs(state, "value_capture_analysis")
+    try:
+        result = await value_capture_analysis_agent(state.segment_research, state.pricing_research, state.product_research, state.pricing_objective)
+        state.value_capture_research = result
+        state.complete_step("value_capture_analysis", result)
+        await checkpoint_state(state)
+        await asyncio.to_thread(save_orchestration_step, invocation_id, "value_capture_analysis", 6, product_id, value_capture_input, result, state.steps["value_capture_analysis"].llm_calls)
+        return result
+    except Exception as e:
+        error_msg = f"Error in value capture analysis: {str(e)}"
+        state.fail_step("value_capture_analysis", error_msg)
+        raise e
+
+
+async def run_experimental_pricing_recommendation(product_id, invocation_id, state):
+    """Run experimental pricing recommendation step"""
+    experimental_pricing_input = {
+        "product_id": product_id,
+        "value_capture_research": state.value_capture_research
+    }
+    state.start_step("experimental_pricing_recommendation", 7, experimental_pricing_input)
+    track_background_jobs(state, "experimental_pricing_recommendation")
+    try:
+        result = await experimental_pricing_recommendation_agent(product_id, state.value_capture_research, state.pricing_objective)
+
+        # Store both raw result and structured data
+        state.experimental_pricing_research = json.dumps(to_serializable(result)) if isinstance(result, dict) else str(result)
+
+        # Extract structured data if available
+        if isinstance(result, dict):
+            pricing_response = result.get('pricing_response')
+            if pricing_response:
+                if hasattr(pricing_response, 'model_dump'):
+                    state.experimental_pricing_structured = RecommendedPricingModelResponse(**pricing_response.model_dump())
+                elif isinstance(pricing_response, dict):
+                    state.experimental_pricing_structured = RecommendedPricingModelResponse(**pricing_response)
+
+            # Store generated IDs
+            state.pricing_model_id = result.get('pricing_model_id')
+            state.customer_segment_ids = result.get('customer_segment_ids', [])
+            state.recommended_pricing_id = result.get('recommended_pricing_id')
+            state.recommended_pricing_ids = result.get('recommended_pricing_ids', [])
+
+        state.complete_step("experimental_pricing_recommendation", result)
+
+        await checkpoint_state(state)
+        await asyncio.to_thread(save_orchestration_step, invocation_id, "experimental_pricing_recommendation", 7, product_id, experimental_pricing_input, result, state.steps["experimental_pricing_recommendation"].llm_calls)
+        return result
+    except Exception as e:
+        error_msg = f"Error in experimental pricing recommendation: {str(e)}"
+        state.fail_step("experimental_pricing_recommendation", error_msg)
+        raise e
+
+
+def find_reusable_output(state, step_prefix, step_input, iteration):
+    """Return the output of an earlier iteration of this step that ran on identical input, if any"""
+    for earlier in range(iteration - 1, 0, -1):
+        earlier_step = state.steps.get(f"{step_prefix}_iter_{earlier}")
+        if earlier_step and earlier_step.status == StepStatus.COMPLETED and earlier_step.step_input == step_input:
+            return earlier_step.step_output
+    return None
+
+
+async def run_positioning_analysis(product_id, experimental_pricing_research, iteration, invocation_id, state, previous_refinement=None):
     """Run positioning analysis for iterative loop"""
     positioning_input = {
         "product_id": product_id,
-        "experimental_pricing_research": experimental_pricing_research
+        "experimental_pricing_research": experimental_pricing_research,
+        "previous_refinement": previous_refinement
     }
     step_name = f"positioning_analysis_iter_{iteration}"
+    if state.is_step_completed(step_name):
+        return state.steps[step_name].step_output
     state.start_step(step_name, 70 + iteration * 10, positioning_input)
+    track_background_jobs(state, step_name)
     
-    result = positioning_analysis_agent(product_id, experimental_pricing_research, state.pricing_objective)
-    state.positioning_analysis_research = result
-    state.complete_step(step_name, result)
-    save_orchestration_step(invocation_id, step_name, 70 + iteration * 10, product_id, positioning_input, result)
-    return result
+    try:
+        result = find_reusable_output(state, "positioning_analysis", positioning_input, iteration)
+        if result is not None:
+            print("Reusing positioning analysis from an earlier iteration (identical input)")
+        else:
+            result = await positioning_analysis_agent(product_id, experimental_pricing_research, state.pricing_objective, previous_refinement)
+        state.positioning_analysis_research = result
+        state.complete_step(step_name, result)
+        await checkpoint_state(state)
+        await asyncio.to_thread(save_orchestration_step, invocation_id, step_name, 70 + iteration * 10, product_id, positioning_input, result, state.steps[step_name].llm_calls)
+        return result
+    except Exception as e:
+        error_msg = f"Error in positioning analysis: {str(e)}"
+        state.fail_step(step_name, error_msg)
+        raise e
 
 
-def run_persona_simulation(product_id, experimental_pricing_research, iteration, invocation_id, state):
+async def run_persona_simulation(product_id, experimental_pricing_research, iteration, invocation_id, state, previous_refinement=None):
     """Run persona simulation for iterative loop"""
     persona_input = {
         "product_id": product_id,
-        "experimental_pricing_research": experimental_pricing_research
+        "experimental_pricing_research": experimental_pricing_research,
+        "previous_refinement": previous_refinement
     }
     step_name = f"persona_simulation_iter_{iteration}"
+    if state.is_step_completed(step_name):
+        return state.steps[step_name].step_output
     state.start_step(step_name, 71 + iteration * 10, persona_input)
+    track_background_jobs(state, step_name)
     
-    result = persona_simulation_agent(product_id, experimental_pricing_research, state.pricing_objective)
-    state.persona_simulation_research = result
-    state.complete_step(step_name, result)
-    save_orchestration_step(invocation_id, step_name, 71 + iteration * 10, product_id, persona_input, result)
-    return result
+    try:
+        result = find_reusable_output(state, "persona_simulation", persona_input, iteration)
+        if result is not None:
+            print("Reusing persona simulation from an earlier iteration (identical input)")
+        else:
+            result = await persona_simulation_agent(product_id, experimental_pricing_research, state.pricing_objective, previous_refinement)
+        state.persona_simulation_research = result
+        state.complete_step(step_name, result)
+        await checkpoint_state(state)
+        await asyncio.to_thread(save_orchestration_step, invocation_id, step_name, 71 + iteration * 10, product_id, persona_input, result, state.steps[step_name].llm_calls)
+        return result
+    except Exception as e:
+        error_msg = f"Error in persona simulation: {str(e)}"
+        state.fail_step(step_name, error_msg)
+        raise e
 
 
-def run_iterative_loop(product_id, invocation_id, state):
+async def run_iterative_loop(product_id, invocation_id, state):
     """Run the iterative refinement loop with positioning analysis, persona simulation, and cashflow refinement"""
     max_retries = state.max_iterations
+    previous_refinement = None
     
     for iteration in range(1, max_retries + 1):
+        step_name = f"cashflow_refinement_iter_{iteration}"
+        if state.is_step_completed(step_name):
+            # Already refined in an earlier (resumed) run
+            previous_refinement = state.steps[step_name].step_output
+            continue
         state.current_iteration = iteration
         print(f"\n--- Iteration {iteration}/{max_retries} ---")
         
         try:
             # Step 7a: Positioning Analysis + Persona Simulation (parallel)
-            with ThreadPoolExecutor(max_workers=2) as executor:
-                positioning_future = executor.submit(
-                    run_positioning_analysis, 
+            branches = {
+                f"positioning_analysis_iter_{iteration}": asyncio.create_task(run_positioning_analysis(
                     product_id, 
                     state.experimental_pricing_research, 
                     iteration, 
                     invocation_id, 
-                    state
-                )
-                persona_future = executor.submit(
-                    run_persona_simulation, 
+                    state,
+                    previous_refinement
+                )),
+                f"persona_simulation_iter_{iteration}": asyncio.create_task(run_persona_simulation(
                     product_id, 
                     state.experimental_pricing_research, 
                     iteration, 
                     invocation_id, 
-                    state
-                )
-                
-                positioning_result = positioning_future.result()
-                persona_result = persona_future.result()
+                    state,
+                    previous_refinement
+                )),
+            }
+            try:
+                positioning_result, persona_result = await asyncio.gather(*branches.values())
+            except Exception as e:
+                # Stop the other branch rather than leave it running, and writing
+                # to state, in the background past this iteration and its deadline
+                for task in branches.values():
+                    task.cancel()
+                await asyncio.gather(*branches.values(), return_exceptions=True)
+                await fail_in_progress_steps(state, branches, f"Cancelled: a parallel step failed ({str(e)})")
+                raise e
             
             # Step 7b: Cashflow Analyst Refinement
             cashflow_refinement_input = {
                 "product_id": product_id,
                 "experimental_pricing_research": state.experimental_pricing_research,
                 "positioning_analysis": positioning_result,
-                "persona_simulation": persona_result
+                "persona_simulation": persona_result,
+                "previous_refinement": previous_refinement
             }
             
-            step_name = f"cashflow_refinement_iter_{iteration}"
             state.start_step(step_name, 72 + iteration * 10, cashflow_refinement_input)
+            track_background_jobs(state, step_name)
             
-            cashflow_refinement_result = cashflow_refinement_agent(
-                product_id, 
-                state.experimental_pricing_research,
-                positioning_result, 
-                persona_result,
-                state.pricing_objective
-            )
+            cashflow_refinement_result = find_reusable_output(state, "cashflow_refinement", cashflow_refinement_input, iteration)
+            if cashflow_refinement_result is not None:
+                print("Reusing cashflow refinement from an earlier iteration (identical input)")
+            else:
+                cashflow_refinement_result = await cashflow_refinement_agent(
+                    product_id, 
+                    state.experimental_pricing_research,
+                    positioning_result, 
+                    persona_result,
+                    state.pricing_objective,
+                    previous_refinement
+                )
             
             state.cashflow_refinement_research = cashflow_refinement_result
             state.complete_step(step_name, cashflow_refinement_result)
-            save_orchestration_step(invocation_id, step_name, 72 + iteration * 10, product_id, cashflow_refinement_input, cashflow_refinement_result)
             
-            # Evaluate if we should continue iterating
-            # For now, we'll run the maximum iterations, but this could be enhanced 
-            # with logic to determine if the refinement is converging
-            print(f"Iteration {iteration} completed successfully")
+            # Stop early once consecutive refinements agree: further rounds
+            # would only restate the same figures at the cost of more calls
+            if previous_refinement is not None:
+                convergence = assess_convergence(previous_refinement, cashflow_refinement_result)
+                state.loop_convergence.append({"iteration": iteration, **convergence})
+                if convergence["converged"]:
+                    state.loop_completed = True
+                    state.loop_stop_reason = "converged"
+            previous_refinement = cashflow_refinement_result
             
-            # If this is the last iteration, mark loop as completed
-            if iteration == max_retries:
+            if iteration == max_retries and not state.loop_completed:
                 state.loop_completed = True
-                print(f"Iterative loop completed after {iteration} iterations")
+                state.loop_stop_reason = "max_iterations"
+            
+            await checkpoint_state(state)
+            await asyncio.to_thread(save_orchestration_step, invocation_id, step_name, 72 + iteration * 10, product_id, cashflow_refinement_input, cashflow_refinement_result, state.steps[step_name].llm_calls)
+            print(f"Iteration {iteration} completed successfully")
+            
+            if state.loop_completed:
+                if state.loop_stop_reason == "converged":
+                    print(f"Refinement converged after {iteration} iterations ({state.loop_convergence[-1]['method']} comparison)")
+                else:
+                    print(f"Iterative loop completed after {iteration} iterations")
                 break
                 
         except Exception as e:
             print(f"Error in iteration {iteration}: {str(e)}")
+            # The refinement itself raised; the parallel steps fail themselves
+            if state.get_step_status(step_name) == StepStatus.IN_PROGRESS:
+                state.fail_step(step_name, f"Error in cashflow refinement: {str(e)}")
+            await checkpoint_state(state)
             # Continue to next iteration if possible
             if iteration < max_retries:
                 print(f"Continuing to iteration {iteration + 1}")
@@ -229,172 +489,219 @@ def run_iterative_loop(product_id, invocation_id, state):
             else:
                 print("Max iterations reached, stopping loop")
                 state.loop_completed = True
+                state.loop_stop_reason = "max_iterations"
+                await checkpoint_state(state)
                 break
 
 
-def final_agent(product_id, usage_scope=None, customer_segment_id=None, pricing_objective=None):
-    # Initialize orchestration state
-    invocation_id = str(uuid.uuid4())
-    state = OrchestrationState(
-        invocation_id=invocation_id,
-        product_id=product_id,
-        usage_scope=usage_scope,
-        customer_segment_id=customer_segment_id,
-        pricing_objective=pricing_objective,
-        total_steps=8
-    )
-    
-    print(f"Starting orchestration with invocation ID: {invocation_id}")
-    
-    # Initialize progress bar for 8 main steps + iterative loop
-    progress = tqdm(total=8, desc="Orchestration Progress", unit="step")
-    
+async def run_iterative_refinement(product_id, invocation_id, state):
+    """Run the iterative refinement loop as a single pipeline step"""
     try:
-        # Step 1: Run product offering agent (must be first)
-        progress.set_description("Step 1: Product offering analysis")
-        product_offering_input = {
-            "product_id": product_id,
-            "usage_scope": usage_scope
-        }
-        
-        state.start_step("product_offering", 1, product_offering_input)
-        try:
-            product_research = product_offering_agent(product_id, usage_scope, state.pricing_objective)
-            state.product_research = product_research
-            state.complete_step("product_offering", product_research)
-            save_orchestration_step(invocation_id, "product_offering", 1, product_id, product_offering_input, product_research)
-            progress.update(1)
-        except Exception as e:
-            error_msg = f"Error in product offering analysis: {str(e)}"
-            state.fail_step("product_offering", error_msg)
-            print(error_msg)
-            return state
-
-        # Step 2: Run competitive analysis and cashflow analysis in parallel
-        progress.set_description("Step 2: Competitive & cashflow analysis (parallel)")
-
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            competitive_future = executor.submit(run_competitive_analysis, product_id, invocation_id, state)
-            cashflow_future = executor.submit(run_cashflow_analysis, product_id, invocation_id, state)
-
+        await run_iterative_loop(product_id, invocation_id, state)
+    except Exception as e:
+        print(f"Error in iterative refinement loop: {str(e)}")
+        state.loop_completed = True  # Mark as completed even if failed
+        state.loop_stop_reason = "failed"
+
+
+STEP_RUNNERS = {
+    "product_offering": run_product_offering,
+    "competitive_analysis": run_competitive_analysis,
+    "cashflow_analysis": run_cashflow_analysis,
+    "pricing_analysis": run_pricing_analysis,
+    "segmentwise_roi": run_segment_roi,
+    "longterm_revenue": run_longterm_revenue,
+    "value_capture_analysis": run_value_capture_analysis,
+    "experimental_pricing_recommendation": run_experimental_pricing_recommendation,
+    "iterative_refinement": run_iterative_refinement,
+}
+
+PIPELINE = {
+    **STEP_DEPENDENCIES,
+    "iterative_refinement": ["experimental_pricing_recommendation"],
+}
+
+
+def is_pipeline_step_completed(state, step_name):
+    """Whether a pipeline step already finished, e.g. in the run being resumed"""
+    if step_name == "iterative_refinement":
+        return state.loop_completed
+    return state.is_step_completed(step_name)
+
+
+def _parse_step_seconds(value):
+    """Parse "competitive_analysis=1200,iterative_refinement=7200" into {step: seconds}"""
+    overrides = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            name, seconds = item.split("=", 1)
             try:
-                competitive_research = competitive_future.result()
-                cashflow_research = cashflow_future.result()
-            except Exception as e:
-                print(f"Error in parallel execution of step 2: {str(e)}")
-                return state
-
-        progress.update(1)
-
-        # Step 3: Run segmentwise ROI and pricing analysis in parallel
-        progress.set_description("Step 3: Segmentwise ROI & pricing analysis (parallel)")
-
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            segment_future = executor.submit(run_segment_roi, product_id, product_research, invocation_id, state)
-            pricing_future = executor.submit(run_pricing_analysis, product_id, invocation_id, state)
-
+                overrides[name.strip()] = float(seconds)
+            except ValueError:
+                print(f"Ignoring invalid step timeout: {item}")
+    return overrides
+
+
+# Wall-clock deadline per pipeline step (0 disables it). The iterative loop
+# gets one deadline per iteration unless overridden in STEP_TIMEOUTS.
+STEP_TIMEOUT_SECONDS = float(os.getenv("STEP_TIMEOUT_SECONDS", "3600"))
+STEP_TIMEOUTS = _parse_step_seconds(os.getenv("STEP_TIMEOUTS"))
+# Wall-clock budget for a whole orchestration run (0 disables it)
+RUN_BUDGET_SECONDS = float(os.getenv("RUN_BUDGET_SECONDS", "0"))
+
+
+def get_step_timeout(step_name, state, step_timeout=None):
+    """Deadline in seconds for one pipeline step, or None for no deadline"""
+    if step_name in STEP_TIMEOUTS:
+        timeout = STEP_TIMEOUTS[step_name]
+    elif is_batched(step_name, "response") or is_batched(step_name, "parse"):
+        # Batched steps wait on the Batch API's completion window, not a live call
+        timeout = BATCH_STEP_TIMEOUT_SECONDS
+    else:
+        timeout = STEP_TIMEOUT_SECONDS if step_timeout is None else step_timeout
+        if step_name == "iterative_refinement":
+            timeout *= state.max_iterations
+    return timeout or None
+
+
+async def fail_in_progress_steps(state, step_names, reason):
+    """Mark the named steps that are still in progress failed and cancel their background jobs"""
+    response_ids = []
+    for name in step_names:
+        step = state.steps.get(name)
+        if step is None or step.status != StepStatus.IN_PROGRESS:
+            continue
+        response_ids.extend(step.background_jobs.values())
+        step.background_jobs.clear()
+        # Batches are shared with other steps and runs, so only stop waiting on them
+        step.batch_jobs.clear()
+        state.fail_step(name, reason)
+    await acancel_background_responses(response_ids)
+    await checkpoint_state(state)
+
+
+async def abort_step(state, step_name, reason):
+    """Mark a cancelled pipeline step (and its loop sub-steps) failed and cancel its background jobs"""
+    if step_name == "iterative_refinement":
+        owned = [name for name in state.steps if "_iter_" in name]
+        state.loop_stop_reason = "timed_out"
+    else:
+        owned = [step_name]
+    await fail_in_progress_steps(state, owned, reason)
+
+
+async def run_pipeline(product_id, invocation_id, state, progress=None, pipeline=PIPELINE, step_timeout=None, run_budget=None):
+    """
+    Execute the pipeline as a dependency graph. Every step is submitted the
+    moment all of its dependencies have finished, so a slow step only delays
+    the steps that actually consume its output. Steps already completed in
+    state (a resumed run) are not executed again.
+
+    A step that misses its deadline (or is still running when the run budget
+    is spent) is cancelled along with its background model jobs. Dependents
+    that list the failed step in SOFT_DEPENDENCIES still run without that
+    input; the others are skipped. Returns the names of steps that failed,
+    timed out or were skipped.
+    """
+    loop = asyncio.get_running_loop()
+    run_budget = RUN_BUDGET_SECONDS if run_budget is None else run_budget
+    run_deadline = loop.time() + run_budget if run_budget else None
+
+    completed = {name for name in pipeline if is_pipeline_step_completed(state, name)}
+    pending = {name: set(dependencies) for name, dependencies in pipeline.items() if name not in completed}
+    failed = set()
+    running = {}
+    deadlines = {}
+
+    def mark_failed(name):
+        failed.add(name)
+        for dependent, dependencies in pipeline.items():
+            if name not in dependencies or dependent not in pending:
+                continue
+            if name in SOFT_DEPENDENCIES.get(dependent, []):
+                pending[dependent].discard(name)
+                state.degraded_steps.setdefault(dependent, []).append(name)
+                print(f"Step {dependent} will run without {name}")
+            else:
+                del pending[dependent]
+                print(f"Skipping step {dependent}: dependency {name} failed")
+                mark_failed(dependent)
+
+    while pending or running:
+        budget_spent = run_deadline is not None and loop.time() >= run_deadline
+        ready = [] if budget_spent else [name for name, dependencies in pending.items() if dependencies <= completed]
+        for name in ready:
+            del pending[name]
+            task = asyncio.create_task(STEP_RUNNERS[name](product_id, invocation_id, state), name=name)
+            running[task] = name
+            timeout = get_step_timeout(name, state, step_timeout)
+            deadline = loop.time() + timeout if timeout else None
+            if run_deadline is not None:
+                deadline = min(deadline, run_deadline) if deadline else run_deadline
+            deadlines[task] = deadline
+        if progress is not None and running:
+            progress.set_description(f"Running: {', '.join(sorted(running.values()))}")
+
+        if not running:
+            # Nothing in flight and nothing runnable: remaining steps are blocked
+            break
+
+        active_deadlines = [deadlines[task] for task in running if deadlines[task] is not None]
+        wait_for = max(0.0, min(active_deadlines) - loop.time()) if active_deadlines else None
+        finished, _ = await asyncio.wait(running, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+        for task in finished:
+            name = running.pop(task)
             try:
-                segment_research = segment_future.result()
-                pricing_research = pricing_future.result()
+                task.result()
+                completed.add(name)
             except Exception as e:
-                print(f"Error in parallel execution of step 3: {str(e)}")
-                return state
+                print(f"Error in step {name}: {str(e)}")
+                mark_failed(name)
+            if progress is not None:
+                progress.update(1)
+
+        now = loop.time()
+        for task in [task for task in running if deadlines[task] is not None and deadlines[task] <= now]:
+            name = running.pop(task)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            if run_deadline is not None and deadlines[task] >= run_deadline:
+                reason = "Cancelled: run budget exhausted"
+            else:
+                reason = f"Cancelled: exceeded step deadline of {get_step_timeout(name, state, step_timeout):g}s"
+            print(f"{reason} ({name})")
+            await abort_step(state, name, reason)
+            mark_failed(name)
+            if progress is not None:
+                progress.update(1)
 
-        progress.update(1)
+    failed.update(pending)
+    return failed
 
-        # Step 4: Long-term revenue analysis
-        progress.set_description("Step 4: Long-term revenue analysis")
-        longterm_revenue_input = {
-            "product_id": product_id,
-            "segment_research": segment_research,
-            "pricing_research": pricing_research,
-            "product_research": product_research
-        }
-        
-        state.start_step("longterm_revenue", 5, longterm_revenue_input)
-        try:
-            longterm_revenue_research = longterm_revenue_agent(product_id, segment_research, pricing_research, product_research, state.pricing_objective)
-            state.longterm_revenue_research = longterm_revenue_research
-            state.complete_step("longterm_revenue", longterm_revenue_research)
-            save_orchestration_step(invocation_id, "longterm_revenue", 5, product_id, longterm_revenue_input, longterm_revenue_research)
-            progress.update(1)
-        except Exception as e:
-            error_msg = f"Error in long-term revenue analysis: {str(e)}"
-            state.fail_step("longterm_revenue", error_msg)
-            print(error_msg)
-            return state
 
-        # Step 5: Value capture analysis
-        progress.set_description("Step 5: Value capture analysis")
-        value_capture_input = {
-            "segment_research": segment_research,
-            "pricing_research": pricing_research,
-            "product_research": product_research,
-            "longterm_revenue_research": longterm_revenue_research
-        }
-        
-        state.start_step("value_capture_analysis", 6, value_capture_input)
-        try:
-            value_capture_research = value_capture_analysis_agent(segment_research, pricing_research, product_research, state.pricing_objective)
-            state.value_capture_research = value_capture_research
-            state.complete_step("value_capture_analysis", value_capture_research)
-            save_orchestration_step(invocation_id, "value_capture_analysis", 6, product_id, value_capture_input, value_capture_research)
-            progress.update(1)
-        except Exception as e:
-            error_msg = f"Error in value capture analysis: {str(e)}"
-            state.fail_step("value_capture_analysis", error_msg)
-            print(error_msg)
-            return state
+async def run_orchestration(state, step_timeout=None, run_budget=None):
+    """Run every pipeline step that is not yet completed in state, then report"""
+    invocation_id = state.invocation_id
+    product_id = state.product_id
 
-        # Step 6: Experimental pricing recommendation
-        progress.set_description("Step 6: Experimental pricing recommendation")
-        experimental_pricing_input = {
-            "product_id": product_id,
-            "value_capture_research": value_capture_research
-        }
-        
-        state.start_step("experimental_pricing_recommendation", 7, experimental_pricing_input)
-        try:
-            experimental_pricing_research = experimental_pricing_recommendation_agent(product_id, value_capture_research, state.pricing_objective)
-            
-            # Store both raw result and structured data
-            state.experimental_pricing_research = json.dumps(experimental_pricing_research) if isinstance(experimental_pricing_research, dict) else str(experimental_pricing_research)
-            
-            # Extract structured data if available
-            if isinstance(experimental_pricing_research, dict):
-                pricing_response = experimental_pricing_research.get('pricing_response')
-                if pricing_response:
-                    if hasattr(pricing_response, 'model_dump'):
-                        state.experimental_pricing_structured = RecommendedPricingModelResponse(**pricing_response.model_dump())
-                    elif isinstance(pricing_response, dict):
-                        state.experimental_pricing_structured = RecommendedPricingModelResponse(**pricing_response)
-                
-                # Store generated IDs
-                state.pricing_model_id = experimental_pricing_research.get('pricing_model_id')
-                state.customer_segment_ids = experimental_pricing_research.get('customer_segment_ids', [])
-                state.recommended_pricing_id = experimental_pricing_research.get('recommended_pricing_id')
-                state.recommended_pricing_ids = experimental_pricing_research.get('recommended_pricing_ids', [])
-            
-            state.complete_step("experimental_pricing_recommendation", experimental_pricing_research)
-            save_orchestration_step(invocation_id, "experimental_pricing_recommendation", 7, product_id, experimental_pricing_input, experimental_pricing_research)
-            progress.update(1)
-        except Exception as e:
-            error_msg = f"Error in experimental pricing recommendation: {str(e)}"
-            state.fail_step("experimental_pricing_recommendation", error_msg)
-            print(error_msg)
-            return state
+    # One progress unit per pipeline step (8 agent steps + iterative loop)
+    progress = tqdm(total=len(PIPELINE), desc=f"Orchestration {product_id}", unit="step")
+    progress.update(sum(1 for name in PIPELINE if is_pipeline_step_completed(state, name)))
+    
+    try:
+        failed_steps = await run_pipeline(product_id, invocation_id, state, progress, step_timeout=step_timeout, run_budget=run_budget)
+        await checkpoint_state(state)
+        if failed_steps:
+            print(f"Failed, timed out or skipped steps: {', '.join(sorted(failed_steps))}")
+            print(f"Resume with: python main.py --resume {invocation_id}")
+            if not state.is_step_completed("experimental_pricing_recommendation"):
+                print("Orchestration stopped before a pricing recommendation was produced")
+                progress.close()
+                return state
+        if state.degraded_steps:
+            degraded = "; ".join(f"{name} without {', '.join(missing)}" for name, missing in state.degraded_steps.items())
+            print(f"Reporting with degraded inputs: {degraded}")
 
-        # Step 7: Iterative Refinement Loop (2-3 retries max)
-        progress.set_description("Step 7: Iterative refinement loop")
-        
-        # Execute the iterative loop
-        try:
-            run_iterative_loop(product_id, invocation_id, state)
-            progress.update(1)
-        except Exception as e:
-            print(f"Error in iterative refinement loop: {str(e)}")
-            state.loop_completed = True  # Mark as completed even if failed
-            
         # Display results if available
         try:
             if state.experimental_pricing_structured:
@@ -404,7 +711,7 @@ def final_agent(product_id, usage_scope=None, customer_segment_id=None, pricing_
 
         # Generate PDF report
         try:
-            pdf_path = generate_pdf_report(state)
+            pdf_path = await asyncio.to_thread(generate_pdf_report, state)
             print(f"PDF report generated: {pdf_path}")
         except Exception as e:
             print(f"Error generating PDF report: {str(e)}")
@@ -413,7 +720,11 @@ def final_agent(product_id, usage_scope=None, customer_segment_id=None, pricing_
         progress.close()
         print(f"Orchestration completed. Invocation ID: {invocation_id}")
         print(f"Progress: {state.get_progress_percentage():.1f}% ({len(state.get_completed_steps())}/{state.total_steps} steps completed)")
-        print(f"Iterative loop: {state.current_iteration}/{state.max_iterations} iterations completed")
+        print(f"Iterative loop: {state.current_iteration}/{state.max_iterations} iterations completed (stopped: {state.loop_stop_reason or 'n/a'})")
+        llm_calls = state.get_llm_calls()
+        if llm_calls:
+            print(f"Model usage for {invocation_id} (latency is summed call time):")
+            print(format_usage_breakdown(llm_calls))
         
         return state
         
@@ -421,6 +732,167 @@ def final_agent(product_id, usage_scope=None, customer_segment_id=None, pricing_
         print(f"Unexpected error in orchestration: {str(e)}")
         progress.close()
         return state
+    finally:
+        _checkpoint_locks.pop(invocation_id, None)
+
+
+async def final_agent_async(product_id, usage_scope=None, customer_segment_id=None, pricing_objective=None, step_timeout=None, run_budget=None):
+    # Initialize orchestration state
+    invocation_id = str(uuid.uuid4())
+    state = OrchestrationState(
+        invocation_id=invocation_id,
+        product_id=product_id,
+        usage_scope=usage_scope,
+        customer_segment_id=customer_segment_id,
+        pricing_objective=pricing_objective,
+        routing_profile=routing.ROUTING_PROFILE,
+        total_steps=8
+    )
+    
+    print(f"Starting orchestration with invocation ID: {invocation_id} (routing profile: {state.routing_profile})")
+    await checkpoint_state(state)
+    return await run_orchestration(state, step_timeout, run_budget)
+
+
+async def resume_agent_async(invocation_id, step_timeout=None, run_budget=None):
+    """Resume an orchestration from its last checkpoint, skipping completed steps"""
+    state = await asyncio.to_thread(OrchestrationStateManager.load_state_from_mongodb, invocation_id)
+    if state is None:
+        raise ValueError(f"No checkpoint found for invocation {invocation_id}")
+    
+    # Finish the run with the models it started with
+    if state.routing_profile and state.routing_profile != routing.ROUTING_PROFILE:
+        try:
+            routing.set_profile(state.routing_profile)
+        except ValueError as e:
+            print(f"Keeping routing profile {routing.ROUTING_PROFILE}: {e}")
+    
+    completed = state.get_completed_steps()
+    print(f"Resuming orchestration {invocation_id} for product {state.product_id} ({len(completed)} steps already completed, routing profile: {routing.ROUTING_PROFILE})")
+    return await run_orchestration(state, step_timeout, run_budget)
+
+
+# How many products a fleet run orchestrates at once; their model calls also
+# share the global LLM_MAX_CONCURRENCY budget and per-model caps
+FLEET_MAX_CONCURRENT_PRODUCTS = int(os.getenv("FLEET_MAX_CONCURRENT_PRODUCTS", "4"))
+
+
+async def fleet_agent_async(product_ids, usage_scope=None, pricing_objective=None, max_concurrent_products=None, step_timeout=None, run_budget=None):
+    """Orchestrate many products in one event loop, returning one outcome dict per product"""
+    limit = max(1, max_concurrent_products or FLEET_MAX_CONCURRENT_PRODUCTS)
+    product_slots = asyncio.Semaphore(limit)
+    print(f"Fleet run: {len(product_ids)} products, up to {limit} at a time")
+
+    async def run_one(product_id):
+        async with product_slots:
+            started = time.monotonic()
+            outcome = {"product_id": product_id, "invocation_id": None, "status": "error", "detail": "", "cost_usd": 0.0}
+            try:
+                state = await final_agent_async(product_id, usage_scope, None, pricing_objective, step_timeout, run_budget)
+                outcome["invocation_id"] = state.invocation_id
+                outcome["cost_usd"] = sum(step.cost_usd for step in state.steps.values())
+                failed = state.get_failed_steps()
+                if state.is_orchestration_complete():
+                    outcome["status"] = "completed"
+                    outcome["detail"] = f"loop stopped: {state.loop_stop_reason or 'n/a'}"
+                else:
+                    outcome["status"] = "incomplete"
+                    outcome["detail"] = f"failed: {', '.join(failed)}" if failed else "not all steps ran"
+            except Exception as e:
+                outcome["detail"] = str(e)
+            outcome["duration_seconds"] = time.monotonic() - started
+            return outcome
+
+    return await asyncio.gather(*(run_one(product_id) for product_id in product_ids))
+
+
+def format_fleet_summary(results):
+    """Render fleet outcomes as a markdown table"""
+    lines = [
+        "| Product | Invocation | Outcome | Duration | Cost (USD) | Detail |",
+        "|---|---|---|---|---|---|",
+    ]
+    for result in results:
+        minutes, seconds = divmod(int(result["duration_seconds"]), 60)
+        detail = (result["detail"] or "").replace("|", "\\|").replace("\n", " ")
+        lines.append(
+            f"| {result['product_id']} | {result['invocation_id'] or '-'} | {result['status']} | {minutes}m {seconds:02d}s | ${result.get('cost_usd') or 0:.2f} | {detail} |"
+        )
+    completed = sum(1 for result in results if result["status"] == "completed")
+    lines.append("")
+    lines.append(f"{completed}/{len(results)} products completed, ${sum(result.get('cost_usd') or 0 for result in results):.2f} in model calls")
+    return "\n".join(lines)
+
+
+async def _closing_model_clients(coro):
+    """Run coro, then close the event loop's model API clients before asyncio.run closes the loop"""
+    try:
+        return await coro
+    finally:
+        await aclose_async_clients()
+
+
+def final_agent(product_id, usage_scope=None, customer_segment_id=None, pricing_objective=None, step_timeout=None, run_budget=None):
+    """Synchronous entry point: runs final_agent_async on a fresh event loop"""
+    state = asyncio.run(_closing_model_clients(final_agent_async(product_id, usage_scope, customer_segment_id, pricing_objective, step_timeout, run_budget)))
+    print(format_connection_stats())
+    return state
+
+
+def resume_agent(invocation_id, step_timeout=None, run_budget=None):
+    """Synchronous entry point for resume_agent_async"""
+    state = asyncio.run(_closing_model_clients(resume_agent_async(invocation_id, step_timeout, run_budget)))
+    print(format_connection_stats())
+    return state
+
+
+def fleet_agent(product_ids, usage_scope=None, pricing_objective=None, max_concurrent_products=None, step_timeout=None, run_budget=None):
+    """Synchronous entry point for fleet_agent_async; prints and returns the per-product outcomes"""
+    results = asyncio.run(_closing_model_clients(fleet_agent_async(product_ids, usage_scope, pricing_objective, max_concurrent_products, step_timeout, run_budget)))
+    print("\n" + format_fleet_summary(results))
+    print(format_connection_stats())
+    return results
+
+
+def format_state_progress(state):
+    """One line per step with its status, elapsed time and a preview of any (partial) output"""
+    now = datetime.utcnow()
+    lines = [f"[{now:%H:%M:%S}] {state.invocation_id} product {state.product_id}: "
+             f"{len(state.get_completed_steps())} steps completed, loop {state.current_iteration}/{state.max_iterations}"]
+    for step in sorted(state.steps.values(), key=lambda step: step.step_order):
+        status = step.status.value if isinstance(step.status, StepStatus) else str(step.status)
+        elapsed = ""
+        if step.started_at:
+            minutes, seconds = divmod(int(((step.completed_at or now) - step.started_at).total_seconds()), 60)
+            elapsed = f"{minutes}m{seconds:02d}s"
+        line = f"  {step.step_name:<40} {status:<12} {elapsed:>8}"
+        if status == StepStatus.IN_PROGRESS.value and isinstance(step.step_output, str) and step.step_output:
+            preview = " ".join(step.step_output[-80:].split())
+            line += f"  {len(step.step_output):,} chars  ...{preview}"
+        elif status == StepStatus.FAILED.value and step.error_message:
+            line += f"  {step.error_message[:80]}"
+        elif step.input_tokens:
+            line += f"  {step.input_tokens:,} input tokens, {step.cached_tokens / step.input_tokens:.0%} cached"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def watch_orchestration(invocation_id, interval=5.0):
+    """Print the checkpointed progress of a (possibly running) orchestration until it stops changing"""
+    idle_polls = 0
+    while True:
+        state = OrchestrationStateManager.load_state_from_mongodb(invocation_id)
+        if state is None:
+            raise ValueError(f"No checkpoint found for invocation {invocation_id}")
+        print(format_state_progress(state) + "\n")
+        if state.is_orchestration_complete():
+            return state
+        running = any(step.status == StepStatus.IN_PROGRESS for step in state.steps.values())
+        idle_polls = 0 if running else idle_polls + 1
+        if idle_polls >= 2:
+            # Nothing in flight twice in a row: the run has stopped
+            return state
+        time.sleep(interval)
 
 
 def display_pricing_recommendations(pricing_response: RecommendedPricingModelResponse):
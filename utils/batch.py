@@ -0,0 +1,208 @@
+import os
+import json
+import asyncio
+import logging
+import weakref
+from utils import step_context, resilience
+
+logger = logging.getLogger(__name__)
+
+# Model calls that may go through the OpenAI Batch API, by agent name and call
+# kind ("response" for the Responses API, "parse" for structured completions).
+# Batched calls cost about half as much but finish within the batch completion
+# window instead of seconds, so batch mode is only for non-interactive runs.
+# Only the async wrappers used by the orchestrator batch; sync calls stay direct.
+BATCH_ELIGIBLE = {
+    "segmentwise_roi": {"response"},
+    "value_capture_analysis": {"response"},
+    "pricing_analysis": {"response"},
+    "experimental_pricing_recommendation": {"response"},
+}
+BATCH_ENDPOINTS = {"response": "/v1/responses", "parse": "/v1/chat/completions"}
+
+BATCH_MODE = os.getenv("LLM_EXECUTION_MODE", "interactive").strip().lower() == "batch"
+
+# Requests queued within this many seconds of the first pending one are
+# submitted together, so a fleet run sends a few large batches
+BATCH_COALESCE_SECONDS = float(os.getenv("BATCH_COALESCE_SECONDS", "30"))
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "1000"))
+BATCH_POLL_INTERVAL_SECONDS = float(os.getenv("BATCH_POLL_INTERVAL_SECONDS", "60"))
+BATCH_COMPLETION_WINDOW = "24h"
+
+# Deadline for steps that wait on batches: the completion window plus headroom
+BATCH_STEP_TIMEOUT_SECONDS = float(os.getenv("BATCH_STEP_TIMEOUT_SECONDS", str(26 * 3600)))
+
+# "expired" batches still return the requests that finished in time
+_RESULT_STATUSES = {"completed", "expired"}
+_FAILED_STATUSES = {"failed", "cancelled"}
+
+
+class BatchError(RuntimeError):
+    """A batch, or one request in it, finished without a usable result"""
+
+
+def set_batch_mode(enabled):
+    """Turn batch execution on or off for this process (e.g. from --mode batch)"""
+    global BATCH_MODE
+    BATCH_MODE = bool(enabled)
+
+
+def is_batched(agent_name, kind):
+    return BATCH_MODE and kind in BATCH_ELIGIBLE.get(agent_name, ())
+
+
+class BatchSubmitter:
+    """Collects requests for one endpoint and submits them together as Batch API jobs"""
+
+    def __init__(self, client, endpoint):
+        self.client = client
+        self.endpoint = endpoint
+        self.pending = {}
+        self.flush_task = None
+        self.submissions = set()
+
+    async def enqueue(self, custom_id, body):
+        """Queue a request and return the id of the batch it was submitted in"""
+        if custom_id in self.pending:
+            # The same request from another run shares one batch line
+            return await asyncio.shield(self.pending[custom_id][1])
+        future = asyncio.get_running_loop().create_future()
+        self.pending[custom_id] = (body, future)
+        if len(self.pending) >= BATCH_MAX_REQUESTS:
+            task = asyncio.create_task(self._submit(self._take_pending()))
+            self.submissions.add(task)
+            task.add_done_callback(self.submissions.discard)
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+        return await asyncio.shield(future)
+
+    def _take_pending(self):
+        pending, self.pending = self.pending, {}
+        if self.flush_task is not None and self.flush_task is not asyncio.current_task():
+            self.flush_task.cancel()
+        self.flush_task = None
+        return pending
+
+    async def _flush_later(self):
+        await asyncio.sleep(BATCH_COALESCE_SECONDS)
+        await self._submit(self._take_pending())
+
+    async def _submit(self, pending):
+        if not pending:
+            return
+        lines = "\n".join(
+            json.dumps({"custom_id": custom_id, "method": "POST", "url": self.endpoint, "body": body}, default=str)
+            for custom_id, (body, _) in pending.items()
+        )
+        try:
+            # A repeated upload at worst leaves an unused file; a repeated batch would run every request twice
+            input_file = await resilience.acall(None, self.client.files.create, file=("batch_input.jsonl", lines.encode("utf-8")), purpose="batch")
+            batch = await resilience.acall(
+                None,
+                self.client.batches.create,
+                idempotent=False,
+                input_file_id=input_file.id,
+                endpoint=self.endpoint,
+                completion_window=BATCH_COMPLETION_WINDOW,
+            )
+        except Exception as e:
+            logger.error(f"Could not submit batch of {len(pending)} {self.endpoint} requests: {e}")
+            for _, future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        logger.info(f"Submitted batch {batch.id} with {len(pending)} {self.endpoint} requests")
+        for _, future in pending.values():
+            if not future.done():
+                future.set_result(batch.id)
+
+
+_submitters: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = weakref.WeakKeyDictionary()
+_pollers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = weakref.WeakKeyDictionary()
+
+
+def get_submitter(client, endpoint):
+    """Return the submitter for endpoint bound to the running event loop"""
+    submitters = _submitters.setdefault(asyncio.get_running_loop(), {})
+    if endpoint not in submitters:
+        submitters[endpoint] = BatchSubmitter(client, endpoint)
+    return submitters[endpoint]
+
+
+async def _read_lines(client, file_id):
+    content = await resilience.acall(None, client.files.content, file_id)
+    return [json.loads(line) for line in content.text.splitlines() if line.strip()]
+
+
+async def _poll_batch(client, batch_id):
+    """Wait for a batch to finish and return its result lines keyed by custom_id"""
+    while True:
+        try:
+            batch = await resilience.acall(None, client.batches.retrieve, batch_id)
+            if batch.status in _RESULT_STATUSES:
+                break
+            if batch.status in _FAILED_STATUSES:
+                errors = getattr(batch.errors, "data", None) or []
+                detail = "; ".join(error.message for error in errors if error.message) or batch.status
+                raise BatchError(f"Batch {batch_id} {batch.status}: {detail}")
+        except Exception as e:
+            if not resilience.is_retryable(e):
+                raise
+            # The batch keeps running server-side; just try again on the next poll
+            logger.warning(f"Polling batch {batch_id} failed: {e}")
+        await asyncio.sleep(BATCH_POLL_INTERVAL_SECONDS)
+
+    counts = batch.request_counts
+    if counts is not None:
+        logger.info(f"Batch {batch_id} {batch.status}: {counts.completed} completed, {counts.failed} failed")
+    results = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            for item in await _read_lines(client, file_id):
+                results[item["custom_id"]] = item
+    return results
+
+
+async def get_batch_result(client, batch_id, custom_id):
+    """Wait for batch_id to finish and return the response body of one of its requests"""
+    pollers = _pollers.setdefault(asyncio.get_running_loop(), {})
+    task = pollers.get(batch_id)
+    if task is None:
+        # One poller per batch, however many steps wait on it
+        task = asyncio.ensure_future(_poll_batch(client, batch_id))
+        pollers[batch_id] = task
+        task.add_done_callback(lambda _: pollers.pop(batch_id, None))
+    results = await asyncio.shield(task)
+
+    item = results.get(custom_id)
+    if item is None:
+        raise BatchError(f"Batch {batch_id} returned no result for request {custom_id[:12]}")
+    response = item.get("response") or {}
+    if item.get("error") or response.get("status_code") != 200:
+        error = item.get("error") or (response.get("body") or {}).get("error") or {}
+        message = error.get("message") if isinstance(error, dict) else str(error)
+        raise BatchError(f"Batched request {custom_id[:12]} in {batch_id} failed: {message or response.get('status_code')}")
+    return response["body"]
+
+
+async def arun_batched(client, fingerprint, kind, body):
+    """Submit (or re-attach to) one request through the Batch API and return its response body"""
+    batch_id = step_context.find_batch_job(fingerprint)
+    if batch_id:
+        try:
+            logger.info(f"Re-attached to batch {batch_id} for request {fingerprint[:12]}")
+            return await get_batch_result(client, batch_id, fingerprint)
+        except BatchError as e:
+            logger.warning(f"{e}; resubmitting")
+            step_context.forget_batch_job(fingerprint)
+
+    batch_id = await get_submitter(client, BATCH_ENDPOINTS[kind]).enqueue(fingerprint, body)
+    on_change = step_context.record_batch_job(fingerprint, batch_id)
+    if on_change:
+        # Persist the batch id right away so a restarted process can pick the result up
+        await on_change()
+    try:
+        return await get_batch_result(client, batch_id, fingerprint)
+    except BatchError:
+        step_context.forget_batch_job(fingerprint)
+        raise
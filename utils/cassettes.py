@@ -0,0 +1,38 @@
+import os
+import json
+import logging
+from utils.response_cache import request_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# Where record mode writes and replay mode reads model interactions: one JSON
+# file per request under <dir>/<agent_name>/<fingerprint>.json
+CASSETTE_DIR = os.getenv("LLM_CASSETTE_DIR", "cassettes")
+
+
+class CassetteMissError(LookupError):
+    """Replay mode found no recorded response for a request"""
+
+
+def cassette_path(agent_name, kind, request):
+    fingerprint = request_fingerprint(f"{agent_name}:{kind}", request)
+    return os.path.join(CASSETTE_DIR, agent_name or "unnamed", f"{fingerprint}.json")
+
+
+def save_interaction(agent_name, kind, request, payload):
+    """Write one request/response pair to the cassette store"""
+    path = cassette_path(agent_name, kind, request)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"agent": agent_name, "kind": kind, "request": request, "response": payload}, f, ensure_ascii=False, indent=2, default=str)
+    logger.info(f"Recorded {kind} for {agent_name} to {path}")
+
+
+def load_interaction(agent_name, kind, request):
+    """Return the recorded response payload for a request, or raise CassetteMissError"""
+    path = cassette_path(agent_name, kind, request)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)["response"]
+    except FileNotFoundError:
+        raise CassetteMissError(f"No recorded {kind} for {agent_name} at {path}; record it first with LLM_TRANSPORT=record")
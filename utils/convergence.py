@@ -0,0 +1,85 @@
+import os
+import re
+
+# Two consecutive cashflow refinements are considered converged when the
+# figures they quote (prices, projections, percentages) agree, or, if they
+# quote too few figures to compare, when their wording barely changes.
+FIGURE_AGREEMENT_THRESHOLD = float(os.getenv("LOOP_CONVERGENCE_FIGURE_THRESHOLD", "0.9"))
+TEXT_SIMILARITY_THRESHOLD = float(os.getenv("LOOP_CONVERGENCE_TEXT_THRESHOLD", "0.85"))
+# Relative difference under which two figures count as the same number
+FIGURE_TOLERANCE = float(os.getenv("LOOP_CONVERGENCE_TOLERANCE", "0.02"))
+# Below this many figures per text, fall back to text similarity
+MIN_FIGURES = 5
+
+_FIGURE_PATTERN = re.compile(
+    r"(?P<currency>[$€£])?\s?(?P<number>\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:\.\d+)?)\s?(?P<suffix>%|[kKmMbB]\b|million\b|billion\b|thousand\b)?"
+)
+_SCALE = {"k": 1e3, "thousand": 1e3, "m": 1e6, "million": 1e6, "b": 1e9, "billion": 1e9}
+
+
+def extract_figures(text):
+    """Pull the numeric figures (prices, amounts, percentages) out of a report"""
+    figures = []
+    for match in _FIGURE_PATTERN.finditer(text or ""):
+        value = float(match.group("number").replace(",", ""))
+        suffix = (match.group("suffix") or "").lower()
+        # Bare four-digit years and list numbering say nothing about the pricing
+        if not match.group("currency") and not suffix:
+            if value.is_integer() and (1900 <= value <= 2100 or value < 10):
+                continue
+        figures.append(value * _SCALE.get(suffix, 1))
+    return figures
+
+
+def figure_agreement(previous_figures, current_figures, tolerance=FIGURE_TOLERANCE):
+    """Fraction of figures that appear, within tolerance, in both lists"""
+    if not previous_figures or not current_figures:
+        return 0.0
+    remaining = sorted(previous_figures)
+    matched = 0
+    for value in sorted(current_figures):
+        for index, candidate in enumerate(remaining):
+            if abs(candidate - value) <= tolerance * max(abs(candidate), abs(value), 1e-9):
+                matched += 1
+                del remaining[index]
+                break
+    return matched / max(len(previous_figures), len(current_figures))
+
+
+def _shingles(text, size=3):
+    words = re.findall(r"\w+", (text or "").lower())
+    if len(words) < size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def text_similarity(previous_text, current_text):
+    """Jaccard similarity of word 3-grams, cheap enough for long research reports"""
+    previous, current = _shingles(previous_text), _shingles(current_text)
+    if not previous or not current:
+        return 0.0
+    return len(previous & current) / len(previous | current)
+
+
+def assess_convergence(previous_text, current_text):
+    """Compare two consecutive refinement outputs and decide whether the loop has converged"""
+    previous_figures = extract_figures(previous_text)
+    current_figures = extract_figures(current_text)
+    similarity = text_similarity(previous_text, current_text)
+
+    if len(previous_figures) >= MIN_FIGURES and len(current_figures) >= MIN_FIGURES:
+        agreement = figure_agreement(previous_figures, current_figures)
+        converged = agreement >= FIGURE_AGREEMENT_THRESHOLD
+        method = "figures"
+    else:
+        agreement = None
+        converged = similarity >= TEXT_SIMILARITY_THRESHOLD
+        method = "text"
+
+    return {
+        "converged": converged,
+        "method": method,
+        "figure_agreement": round(agreement, 4) if agreement is not None else None,
+        "text_similarity": round(similarity, 4),
+        "figures_compared": [len(previous_figures), len(current_figures)],
+    }
@@ -0,0 +1,162 @@
+import os
+import asyncio
+import logging
+import weakref
+import threading
+import importlib.util
+import httpx
+from openai import DefaultHttpxClient, DefaultAsyncHttpxClient
+
+logger = logging.getLogger(__name__)
+
+# One connection pool per process (per event loop for async calls) for every
+# model call, shared by the OpenAI SDK clients and LiteLLM, so parallel agents
+# and fleet runs reuse warm TLS connections instead of each client opening its own
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", "100"))
+LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS", "40"))
+LLM_HTTP_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY_SECONDS", "120"))
+# HTTP/2 multiplexes concurrent requests over one connection; needs the h2
+# package, installed with httpx[http2] from requirements.txt
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "true").strip().lower() not in ("0", "false", "no")
+
+
+class ConnectionStats:
+    """Counts requests and newly opened connections, to show how often connections are reused"""
+
+    def __init__(self):
+        self.requests = 0
+        self.connections_opened = 0
+        self.tls_handshakes = 0
+        self.http_versions = {}
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_event(self, event_name):
+        with self._lock:
+            if event_name == "connection.connect_tcp.complete":
+                self.connections_opened += 1
+            elif event_name == "connection.start_tls.complete":
+                self.tls_handshakes += 1
+
+    def record_response(self, http_version):
+        with self._lock:
+            self.http_versions[http_version] = self.http_versions.get(http_version, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            reused = max(self.requests - self.connections_opened, 0)
+            return {
+                "requests": self.requests,
+                "connections_opened": self.connections_opened,
+                "tls_handshakes": self.tls_handshakes,
+                "reused_requests": reused,
+                "reuse_ratio": round(reused / self.requests, 3) if self.requests else 0.0,
+                "http_versions": dict(self.http_versions),
+            }
+
+
+connection_stats = ConnectionStats()
+
+
+def http2_enabled():
+    """HTTP/2 when configured and the h2 package is installed, otherwise HTTP/1.1"""
+    if not LLM_HTTP2:
+        return False
+    if importlib.util.find_spec("h2") is None:
+        logger.warning("h2 is not installed; model calls use HTTP/1.1 (pip install 'httpx[http2]' for HTTP/2)")
+        return False
+    return True
+
+
+def pool_limits():
+    return httpx.Limits(
+        max_connections=LLM_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=LLM_HTTP_KEEPALIVE_EXPIRY_SECONDS,
+    )
+
+
+# httpcore reports connection setup through the "trace" request extension,
+# only for requests that had to open a new connection
+def _trace(event_name, info):
+    connection_stats.record_event(event_name)
+
+
+async def _atrace(event_name, info):
+    connection_stats.record_event(event_name)
+
+
+def _on_request(request):
+    connection_stats.record_request()
+    request.extensions["trace"] = _trace
+
+
+def _on_response(response):
+    connection_stats.record_response(response.http_version)
+
+
+async def _aon_request(request):
+    connection_stats.record_request()
+    request.extensions["trace"] = _atrace
+
+
+async def _aon_response(response):
+    connection_stats.record_response(response.http_version)
+
+
+_http_client = None
+# httpx async connections belong to the event loop that opened them, so each
+# loop (each asyncio.run) gets its own async client
+_async_http_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+
+def get_http_client():
+    """The process-wide synchronous httpx client"""
+    global _http_client
+    with _clients_lock:
+        if _http_client is None:
+            _http_client = DefaultHttpxClient(
+                limits=pool_limits(),
+                http2=http2_enabled(),
+                event_hooks={"request": [_on_request], "response": [_on_response]},
+            )
+        return _http_client
+
+
+def get_async_http_client():
+    """The asynchronous httpx client bound to the running event loop"""
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        client = _async_http_clients.get(loop)
+        if client is None:
+            client = DefaultAsyncHttpxClient(
+                limits=pool_limits(),
+                http2=http2_enabled(),
+                event_hooks={"request": [_aon_request], "response": [_aon_response]},
+            )
+            _async_http_clients[loop] = client
+        return client
+
+
+async def aclose_async_http_client():
+    """Close the running loop's client and its connections; call before the loop ends"""
+    with _clients_lock:
+        client = _async_http_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def format_connection_stats():
+    """One line summarising connection reuse, e.g. for the end of a run"""
+    stats = connection_stats.snapshot()
+    if not stats["requests"]:
+        return "HTTP connections: no model API requests"
+    versions = ", ".join(f"{version} x{count}" for version, count in sorted(stats["http_versions"].items()))
+    return (
+        f"HTTP connections: {stats['requests']} requests over {stats['connections_opened']} new connections "
+        f"({stats['reuse_ratio']:.0%} reused, {stats['tls_handshakes']} TLS handshakes; {versions or 'no responses'})"
+    )
@@ -1,7 +1,459 @@
 import os
+import time
+import asyncio
+import logging
+import weakref
+import contextlib
+import litellm
 import instructor
-from openai import OpenAI
-from litellm import completion
+from openai import OpenAI, AsyncOpenAI
+from openai.types.responses import Response
+from openai.types.chat import ChatCompletion
+from litellm import completion, acompletion
+from utils import response_cache, step_context, rate_limiter, cassettes, batch, usage, routing, resilience, http_pool
 
-openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'), timeout=3600)
+logger = logging.getLogger(__name__)
+
+# Transport for every model call made through the wrappers below:
+#   live   - call the API (default)
+#   record - call the API and write every request/response to the cassette store
+#   replay - answer only from the cassette store, never touching the network
+#   stub   - call the local stub server (python -m utils.stub_server)
+LLM_TRANSPORT = os.getenv("LLM_TRANSPORT", "live").strip().lower()
+LLM_STUB_URL = os.getenv("LLM_STUB_URL", "http://127.0.0.1:8765/v1")
+
+if LLM_TRANSPORT == "stub":
+    _api_key, _base_url = "stub", LLM_STUB_URL
+else:
+    _api_key, _base_url = os.getenv('OPENAI_API_KEY'), None
+
+# Retries are handled by utils.resilience (backoff, idempotency, circuit breakers).
+# All clients, LiteLLM's included, share the connection pools in utils.http_pool.
+litellm.client_session = http_pool.get_http_client()
+
+openai_client = OpenAI(api_key=_api_key, base_url=_base_url, timeout=3600, max_retries=0, http_client=http_pool.get_http_client())
 litellm_client = instructor.from_litellm(completion)
+
+async_litellm_client = instructor.from_litellm(acompletion)
+
+_async_openai_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncOpenAI]" = weakref.WeakKeyDictionary()
+
+
+def get_async_openai_client():
+    """The AsyncOpenAI client for the running event loop, on that loop's connection pool"""
+    loop = asyncio.get_running_loop()
+    client = _async_openai_clients.get(loop)
+    if client is None:
+        client = AsyncOpenAI(api_key=_api_key, base_url=_base_url, timeout=3600, max_retries=0, http_client=http_pool.get_async_http_client())
+        _async_openai_clients[loop] = client
+    return client
+
+
+async def aclose_async_clients():
+    """Close the running loop's async clients; await this at the end of each asyncio.run"""
+    _async_openai_clients.pop(asyncio.get_running_loop(), None)
+    litellm.aclient_session = None
+    await http_pool.aclose_async_http_client()
+
+# Global budget of in-flight model calls per event loop. Every async call made
+# through acreate_response/aparse_completion holds one slot while it runs, so
+# many concurrent orchestrations share one bounded pool instead of one thread
+# per call.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+
+
+def _parse_model_limits(value):
+    """Parse "o3-deep-research=4,gpt-5=8" into {"o3-deep-research": 4, "gpt-5": 8}"""
+    limits = {}
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        model, limit = item.split("=", 1)
+        try:
+            limits[model.strip()] = max(1, int(limit))
+        except ValueError:
+            continue
+    return limits
+
+
+# Per-model caps inside the global budget, so a fleet of runs cannot flood a
+# single model's quota (deep research calls are the slowest and most limited)
+LLM_MODEL_CONCURRENCY = _parse_model_limits(os.getenv("LLM_MODEL_CONCURRENCY", "o3-deep-research=8"))
+
+# Background-mode requests (background=True) return immediately with a response
+# id and are polled until they reach a terminal status
+BACKGROUND_POLL_INTERVAL_SECONDS = float(os.getenv("BACKGROUND_POLL_INTERVAL_SECONDS", "10"))
+_PENDING_STATUSES = {"queued", "in_progress"}
+
+# Stream non-background responses so partial text reaches the running step
+# (and its checkpoint) while the model is still writing
+LLM_STREAMING = os.getenv("LLM_STREAMING", "true").strip().lower() not in ("0", "false", "no")
+
+_llm_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+_model_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = weakref.WeakKeyDictionary()
+
+
+def get_llm_semaphore():
+    """Return the concurrency semaphore bound to the running event loop"""
+    loop = asyncio.get_running_loop()
+    semaphore = _llm_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+        _llm_semaphores[loop] = semaphore
+    return semaphore
+
+
+def get_model_semaphore(model):
+    """Return the per-model semaphore bound to the running event loop, or None if the model is uncapped"""
+    limit = LLM_MODEL_CONCURRENCY.get(model)
+    if limit is None:
+        return None
+    loop = asyncio.get_running_loop()
+    semaphores = _model_semaphores.setdefault(loop, {})
+    if model not in semaphores:
+        semaphores[model] = asyncio.Semaphore(limit)
+    return semaphores[model]
+
+
+@contextlib.asynccontextmanager
+async def llm_slot(model):
+    """Hold a per-model slot (if capped) and a global slot for the duration of one call"""
+    # Wait on the model cap first so a queued deep-research call does not hold
+    # a global slot that calls to other models could use
+    model_semaphore = get_model_semaphore(model)
+    async with model_semaphore or contextlib.nullcontext():
+        async with get_llm_semaphore():
+            yield
+
+
+def _check_background_result(response, fingerprint):
+    if response.status in ("failed", "cancelled"):
+        step_context.forget_background_job(fingerprint)
+        error = getattr(response.error, "message", None) or response.status
+        raise RuntimeError(f"Background response {response.id} {response.status}: {error}")
+    return response
+
+
+def _accept_attached(fingerprint, response_id, response):
+    """Keep a re-attached background response unless it already failed"""
+    if response is None or response.status in ("failed", "cancelled"):
+        step_context.forget_background_job(fingerprint)
+        return None
+    logger.info(f"Re-attached to background response {response_id} ({response.status})")
+    return response
+
+
+def _run_background(fingerprint, request):
+    """Submit (or re-attach to) a background response and poll it to a terminal status"""
+    response = None
+    response_id = step_context.find_background_job(fingerprint)
+    if response_id:
+        try:
+            response = resilience.call(None, openai_client.responses.retrieve, response_id)
+        except Exception as e:
+            logger.warning(f"Could not re-attach to background response {response_id}: {e}")
+        response = _accept_attached(fingerprint, response_id, response)
+    ticket = None
+    if response is None:
+        ticket = rate_limiter.acquire(request.get("model"), request)
+        # Not idempotent: a repeated create could start a second background job
+        response = resilience.call(request.get("model"), openai_client.responses.create, idempotent=False, **request)
+        step_context.record_background_job(fingerprint, response.id)
+    while response.status in _PENDING_STATUSES:
+        time.sleep(BACKGROUND_POLL_INTERVAL_SECONDS)
+        try:
+            response = resilience.call(None, openai_client.responses.retrieve, response.id)
+        except Exception as e:
+            if not resilience.is_retryable(e):
+                raise
+            # The job keeps running server-side; just try again on the next poll
+            logger.warning(f"Polling background response {response.id} failed: {e}")
+    rate_limiter.reconcile(ticket, response)
+    return _check_background_result(response, fingerprint)
+
+
+async def _arun_background(fingerprint, request):
+    """Async variant of _run_background that checkpoints the response id as soon as it is known"""
+    response = None
+    response_id = step_context.find_background_job(fingerprint)
+    if response_id:
+        try:
+            response = await resilience.acall(None, get_async_openai_client().responses.retrieve, response_id)
+        except Exception as e:
+            logger.warning(f"Could not re-attach to background response {response_id}: {e}")
+        response = _accept_attached(fingerprint, response_id, response)
+    ticket = None
+    if response is None:
+        # Wait for rate-limit budget before taking a concurrency slot
+        ticket = await rate_limiter.aacquire(request.get("model"), request)
+    async with llm_slot(request.get("model")):
+        if response is None:
+            response = await resilience.acall(request.get("model"), get_async_openai_client().responses.create, idempotent=False, **request)
+            on_change = step_context.record_background_job(fingerprint, response.id)
+            if on_change:
+                # Persist the id right away so a restarted process can pick the job up
+                await on_change()
+        while response.status in _PENDING_STATUSES:
+            await asyncio.sleep(BACKGROUND_POLL_INTERVAL_SECONDS)
+            try:
+                response = await resilience.acall(None, get_async_openai_client().responses.retrieve, response.id)
+            except Exception as e:
+                if not resilience.is_retryable(e):
+                    raise
+                logger.warning(f"Polling background response {response.id} failed: {e}")
+    await asyncio.to_thread(rate_limiter.reconcile, ticket, response)
+    return _check_background_result(response, fingerprint)
+
+
+async def _astream_response(request, on_partial):
+    """Create a response with stream=True, passing text deltas to on_partial, and return the final response"""
+    final = None
+    # Only opening the stream is retried; once text has been passed on, a retry would repeat it
+    stream = await resilience.acall(request.get("model"), get_async_openai_client().responses.create, **request, stream=True)
+    async for event in stream:
+        if event.type == "response.output_text.delta":
+            await on_partial(event.delta)
+        elif event.type in ("response.completed", "response.incomplete", "response.failed"):
+            final = event.response
+        elif event.type == "error":
+            raise RuntimeError(f"Response stream error: {getattr(event, 'message', event)}")
+    if final is None:
+        raise RuntimeError("Response stream ended without a final response")
+    if final.status == "failed":
+        error = getattr(final.error, "message", None) or final.status
+        raise RuntimeError(f"Response {final.id} failed: {error}")
+    return final
+
+
+async def acancel_background_responses(response_ids):
+    """Cancel background responses server-side, e.g. for a step that missed its deadline"""
+    for response_id in response_ids:
+        try:
+            await resilience.acall(None, get_async_openai_client().responses.cancel, response_id)
+            logger.info(f"Cancelled background response {response_id}")
+        except Exception as e:
+            logger.warning(f"Could not cancel background response {response_id}: {e}")
+
+
+def _strict_schema(schema, defs):
+    """A pydantic JSON schema node in the form strict structured outputs accept
+
+    Objects are closed and list every property as required, "default" is
+    dropped (every field is required anyway), a single-entry allOf is
+    unwrapped and a $ref with sibling keywords is inlined, since strict mode
+    rejects both. Kept here rather than borrowed from the OpenAI SDK's private
+    helpers so an SDK upgrade cannot change the schemas we send.
+    """
+    if isinstance(schema, list):
+        return [_strict_schema(item, defs) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    if "$ref" in schema and len(schema) > 1:
+        target = defs[schema["$ref"].rsplit("/", 1)[-1]]
+        schema = {**target, **{key: value for key, value in schema.items() if key != "$ref"}}
+    if len(schema.get("allOf", ())) == 1:
+        schema = {**schema["allOf"][0], **{key: value for key, value in schema.items() if key != "allOf"}}
+    strict = {}
+    for key, value in schema.items():
+        if key == "default":
+            continue
+        if key in ("properties", "$defs"):
+            # Keys here are field/definition names, not schema keywords
+            strict[key] = {name: _strict_schema(prop, defs) for name, prop in value.items()}
+        else:
+            strict[key] = _strict_schema(value, defs)
+    if strict.get("type") == "object":
+        strict.setdefault("additionalProperties", False)
+        if "properties" in strict:
+            strict["required"] = list(strict["properties"])
+    return strict
+
+
+def structured_text_format(model):
+    """Responses API text format that makes a response's output text a JSON instance of a pydantic model"""
+    schema = model.model_json_schema()
+    return {
+        "type": "json_schema",
+        "name": model.__name__,
+        "schema": _strict_schema(schema, schema.get("$defs", {})),
+        "strict": True,
+    }
+
+
+def _load_response(payload):
+    # Rebuild the way the SDK itself does (construct, not validate): stored
+    # payloads may lack fields that newer SDK versions declare as required
+    return Response.construct(**payload)
+
+
+def _record_call(agent_name, kind, request, result, started, batched=False):
+    """Pass a fresh call's tokens, tool calls, wall time and cost to the current step"""
+    step_context.record_usage(usage.call_usage(agent_name, kind, request.get("model"), result, time.monotonic() - started, batched))
+
+
+def _response_cache_key(agent_name, request):
+    # Only live runs use the response cache: record mode must reach the
+    # transport to write cassettes, and replay/stub runs must stay offline
+    if LLM_TRANSPORT != "live":
+        return None
+    return response_cache.cache_key_for(agent_name, request)
+
+
+def _use_batch(agent_name, kind):
+    # The stub server has no Files or Batch API, and replay never reaches here
+    return batch.is_batched(agent_name, kind) and LLM_TRANSPORT in ("live", "record")
+
+
+def _batch_body(kind, request):
+    """Turn a wrapper request into the body of one Batch API request line"""
+    if kind == "response":
+        return {key: value for key, value in request.items() if key not in ("background", "stream")}
+    # Structured completions ask for the response model's JSON schema directly
+    # instead of going through instructor's tool call
+    response_model = request["response_model"]
+    body = {key: value for key, value in request.items() if key not in ("response_model", "max_retries")}
+    body["response_format"] = {
+        "type": "json_schema",
+        "json_schema": {"name": response_model.__name__, "schema": response_model.model_json_schema()},
+    }
+    return body
+
+
+def _parsed_from_batch(response_model, body):
+    completion = ChatCompletion.construct(**body)
+    parsed = response_model.model_validate_json(completion.choices[0].message.content)
+    parsed._raw_response = completion
+    return parsed
+
+
+def _litellm_request(request):
+    if LLM_TRANSPORT == "stub":
+        return {**request, "api_base": LLM_STUB_URL, "api_key": "stub"}
+    return request
+
+
+def create_response(agent_name, **request):
+    """Create a Responses API response synchronously, served from the agent cache when possible"""
+    request = routing.route(agent_name, "response", request)
+    if LLM_TRANSPORT == "replay":
+        return _load_response(cassettes.load_interaction(agent_name, "response", request))
+    cache_key = _response_cache_key(agent_name, request)
+    if cache_key:
+        cached = response_cache.get_cached(cache_key, agent_name)
+        if cached is not None:
+            return _load_response(cached)
+
+    started = time.monotonic()
+    if request.get("background"):
+        response = _run_background(response_cache.request_fingerprint(agent_name, request), request)
+    else:
+        ticket = rate_limiter.acquire(request.get("model"), request)
+        response = resilience.call(request.get("model"), openai_client.responses.create, **request)
+        rate_limiter.reconcile(ticket, response)
+    _record_call(agent_name, "response", request, response, started)
+
+    if LLM_TRANSPORT == "record":
+        cassettes.save_interaction(agent_name, "response", request, response.model_dump(mode="json"))
+    if cache_key and response.status == "completed":
+        response_cache.put_cached(cache_key, agent_name, request.get("model"), response.model_dump(mode="json"))
+    return response
+
+
+async def acreate_response(agent_name, **request):
+    """Create a Responses API response inside the global concurrency budget, served from the agent cache when possible"""
+    request = routing.route(agent_name, "response", request)
+    if LLM_TRANSPORT == "replay":
+        return _load_response(cassettes.load_interaction(agent_name, "response", request))
+    cache_key = _response_cache_key(agent_name, request)
+    if cache_key:
+        cached = await asyncio.to_thread(response_cache.get_cached, cache_key, agent_name)
+        if cached is not None:
+            return _load_response(cached)
+
+    started = time.monotonic()
+    batched = _use_batch(agent_name, "response")
+    if batched:
+        # Batched calls wait in the Batch API's queue, not in a concurrency slot
+        fingerprint = response_cache.request_fingerprint(f"{agent_name}:response", request)
+        response = _load_response(await batch.arun_batched(get_async_openai_client(), fingerprint, "response", _batch_body("response", request)))
+    elif request.get("background"):
+        # Takes its own slot, after any rate-limit wait
+        response = await _arun_background(response_cache.request_fingerprint(agent_name, request), request)
+    else:
+        # A call throttled by its model's window waits here, without holding a
+        # concurrency slot that calls to other models could use
+        ticket = await rate_limiter.aacquire(request.get("model"), request)
+        async with llm_slot(request.get("model")):
+            on_partial = step_context.get_partial_handler()
+            if on_partial and LLM_STREAMING and LLM_TRANSPORT in ("live", "record"):
+                response = await _astream_response(request, on_partial)
+            else:
+                response = await resilience.acall(request.get("model"), get_async_openai_client().responses.create, **request)
+        await asyncio.to_thread(rate_limiter.reconcile, ticket, response)
+    _record_call(agent_name, "response", request, response, started, batched)
+
+    if LLM_TRANSPORT == "record":
+        await asyncio.to_thread(cassettes.save_interaction, agent_name, "response", request, response.model_dump(mode="json"))
+    if cache_key and response.status == "completed":
+        await asyncio.to_thread(response_cache.put_cached, cache_key, agent_name, request.get("model"), response.model_dump(mode="json"))
+    return response
+
+
+def parse_completion(agent_name, **request):
+    """Run a structured LiteLLM chat completion synchronously, served from the agent cache when possible"""
+    request = routing.route(agent_name, "parse", request)
+    response_model = request["response_model"]
+    if LLM_TRANSPORT == "replay":
+        return response_model.model_validate(cassettes.load_interaction(agent_name, "parse", request))
+    cache_key = _response_cache_key(agent_name, request)
+    if cache_key:
+        cached = response_cache.get_cached(cache_key, agent_name)
+        if cached is not None:
+            return response_model.model_validate(cached)
+
+    started = time.monotonic()
+    ticket = rate_limiter.acquire(request.get("model"), request)
+    parsed = resilience.call(request.get("model"), litellm_client.chat.completions.create, **_litellm_request(request))
+    rate_limiter.reconcile(ticket, parsed)
+    _record_call(agent_name, "parse", request, parsed, started)
+
+    if LLM_TRANSPORT == "record":
+        cassettes.save_interaction(agent_name, "parse", request, parsed.model_dump(mode="json"))
+    if cache_key:
+        response_cache.put_cached(cache_key, agent_name, request.get("model"), parsed.model_dump(mode="json"))
+    return parsed
+
+
+async def aparse_completion(agent_name, **request):
+    """Run a structured LiteLLM chat completion inside the global concurrency budget, served from the agent cache when possible"""
+    request = routing.route(agent_name, "parse", request)
+    response_model = request["response_model"]
+    if LLM_TRANSPORT == "replay":
+        return response_model.model_validate(cassettes.load_interaction(agent_name, "parse", request))
+    cache_key = _response_cache_key(agent_name, request)
+    if cache_key:
+        cached = await asyncio.to_thread(response_cache.get_cached, cache_key, agent_name)
+        if cached is not None:
+            return response_model.model_validate(cached)
+
+    started = time.monotonic()
+    batched = _use_batch(agent_name, "parse")
+    if batched:
+        fingerprint = response_cache.request_fingerprint(f"{agent_name}:parse", request)
+        body = await batch.arun_batched(get_async_openai_client(), fingerprint, "parse", _batch_body("parse", request))
+        parsed = _parsed_from_batch(response_model, body)
+    else:
+        # Rate-limit wait first, so a throttled call holds no concurrency slot
+        ticket = await rate_limiter.aacquire(request.get("model"), request)
+        async with llm_slot(request.get("model")):
+            # LiteLLM takes its async session from a module global; point it at this loop's pool
+            litellm.aclient_session = http_pool.get_async_http_client()
+            parsed = await resilience.acall(request.get("model"), async_litellm_client.chat.completions.create, **_litellm_request(request))
+        await asyncio.to_thread(rate_limiter.reconcile, ticket, parsed)
+    _record_call(agent_name, "parse", request, parsed, started, batched)
+
+    if LLM_TRANSPORT == "record":
+        await asyncio.to_thread(cassettes.save_interaction, agent_name, "parse", request, parsed.model_dump(mode="json"))
+    if cache_key:
+        await asyncio.to_thread(response_cache.put_cached, cache_key, agent_name, request.get("model"), parsed.model_dump(mode="json"))
+    return parsed
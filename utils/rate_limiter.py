@@ -0,0 +1,212 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_model_rates(value):
+    """Parse "gpt-5=500/500000,o3-deep-research=250/200000" into {model: (rpm, tpm)}"""
+    rates = {}
+    for item in (value or "").split(","):
+        if "=" not in item or "/" not in item:
+            continue
+        model, limits = item.split("=", 1)
+        rpm, tpm = limits.split("/", 1)
+        try:
+            rates[model.strip()] = (int(rpm), int(tpm))
+        except ValueError:
+            logger.warning(f"Ignoring invalid rate limit: {item}")
+    return rates
+
+
+# Requests and tokens per minute per model. Models without an entry are not limited.
+MODEL_RATE_LIMITS = {
+    "gpt-5": (500, 500000),
+    "o3-deep-research": (250, 200000),
+    "gpt-4o": (500, 30000),
+    **_parse_model_rates(os.getenv("LLM_RATE_LIMITS")),
+}
+
+# "memory" limits callers in this process; "mongo" shares fixed one-minute
+# windows through MongoDB so several processes stay under the same limits
+RATE_LIMIT_BACKEND = os.getenv("LLM_RATE_LIMIT_BACKEND", "memory").strip().lower()
+
+# Output allowance added to the prompt estimate when a request sets no max_output_tokens
+ESTIMATED_OUTPUT_TOKENS = int(os.getenv("LLM_ESTIMATED_OUTPUT_TOKENS", "4000"))
+
+
+def estimate_request_tokens(request):
+    """Rough token count of a request (about 4 characters per token) plus its output allowance"""
+    chars = len(str(request.get("instructions") or "")) + len(str(request.get("input") or ""))
+    for message in request.get("messages") or []:
+        chars += len(str(message.get("content") or "")) if isinstance(message, dict) else len(str(message))
+    output = request.get("max_output_tokens") or request.get("max_tokens") or ESTIMATED_OUTPUT_TOKENS
+    return chars // 4 + int(output)
+
+
+def usage_total_tokens(result):
+    """Actual token usage of a Responses API response or an instructor-parsed completion, if reported"""
+    usage = getattr(result, "usage", None)
+    if usage is None:
+        raw = getattr(result, "_raw_response", None)
+        usage = getattr(raw, "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+
+class TokenBucket:
+    """Continuously refilling bucket; the level may go negative when usage exceeds its estimate"""
+
+    def __init__(self, capacity):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        return max(0.0, (amount - self.level) / self.rate)
+
+
+class InMemoryRateLimiter:
+    """Per-model RPM and TPM token buckets shared by every caller in this process"""
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def try_acquire(self, model, tokens):
+        """Return (ticket, 0) if the request may go now, else (None, seconds to wait)"""
+        with self.lock:
+            if model not in self.buckets:
+                rpm, tpm = self.limits[model]
+                self.buckets[model] = (TokenBucket(rpm), TokenBucket(tpm))
+            requests, token_bucket = self.buckets[model]
+            requests.refill()
+            token_bucket.refill()
+            # A request bigger than a whole minute's budget waits for a full bucket
+            tokens = min(tokens, token_bucket.capacity)
+            wait = max(requests.wait_time(1), token_bucket.wait_time(tokens))
+            if wait > 0:
+                return None, wait
+            requests.level -= 1
+            token_bucket.level -= tokens
+            return (model, tokens), 0.0
+
+    def reconcile(self, ticket, actual_tokens):
+        """Charge (or refund) the difference between the estimate and the reported usage"""
+        model, estimated = ticket
+        with self.lock:
+            self.buckets[model][1].level -= actual_tokens - estimated
+
+
+class MongoRateLimiter:
+    """Per-model fixed one-minute windows counted in MongoDB, shared across processes"""
+
+    def __init__(self, limits):
+        self.limits = limits
+
+    def try_acquire(self, model, tokens):
+        from datastore.models import RateLimitWindow
+
+        rpm, tpm = self.limits[model]
+        tokens = min(tokens, tpm)
+        now = time.time()
+        window = int(now // 60)
+        key = f"{model}:{window}"
+        window_start = datetime.utcfromtimestamp(window * 60)
+        try:
+            counters = RateLimitWindow.objects(key=key).modify(
+                upsert=True,
+                new=True,
+                inc__requests=1,
+                inc__tokens=tokens,
+                set_on_insert__model=model,
+                set_on_insert__window_start=window_start,
+                set_on_insert__expires_at=window_start + timedelta(minutes=5),
+            )
+        except Exception as e:
+            # Never block model calls on the limiter's own storage
+            logger.warning(f"Rate limit window unavailable for {model}, not limiting: {e}")
+            return (model, tokens, key), 0.0
+        if counters.requests <= rpm and (counters.tokens <= tpm or counters.requests == 1):
+            return (model, tokens, key), 0.0
+        # Over the limit: give the slot back and retry in the next window
+        RateLimitWindow.objects(key=key).update_one(inc__requests=-1, inc__tokens=-tokens)
+        return None, (window + 1) * 60 - now
+
+    def reconcile(self, ticket, actual_tokens):
+        from datastore.models import RateLimitWindow
+
+        model, estimated, key = ticket
+        try:
+            RateLimitWindow.objects(key=key).update_one(inc__tokens=int(actual_tokens - estimated))
+        except Exception as e:
+            logger.warning(f"Could not reconcile token usage for {model}: {e}")
+
+
+_limiter = None
+
+
+def get_rate_limiter():
+    global _limiter
+    if _limiter is None:
+        if RATE_LIMIT_BACKEND == "mongo":
+            _limiter = MongoRateLimiter(MODEL_RATE_LIMITS)
+        else:
+            _limiter = InMemoryRateLimiter(MODEL_RATE_LIMITS)
+    return _limiter
+
+
+def _jitter(wait):
+    # Spread waiters out so they do not all retry at the same instant
+    return wait + random.uniform(0, min(1.0, wait * 0.1))
+
+
+def acquire(model, request):
+    """Block until model has budget for request; returns a ticket for reconcile(), or None if unlimited"""
+    if model not in MODEL_RATE_LIMITS:
+        return None
+    limiter = get_rate_limiter()
+    tokens = estimate_request_tokens(request)
+    while True:
+        ticket, wait = limiter.try_acquire(model, tokens)
+        if ticket is not None:
+            return ticket
+        logger.info(f"Rate limit reached for {model}, waiting {wait:.1f}s")
+        time.sleep(_jitter(wait))
+
+
+async def aacquire(model, request):
+    """Async variant of acquire(); waits without blocking the event loop"""
+    if model not in MODEL_RATE_LIMITS:
+        return None
+    limiter = get_rate_limiter()
+    tokens = estimate_request_tokens(request)
+    while True:
+        if isinstance(limiter, MongoRateLimiter):
+            ticket, wait = await asyncio.to_thread(limiter.try_acquire, model, tokens)
+        else:
+            ticket, wait = limiter.try_acquire(model, tokens)
+        if ticket is not None:
+            return ticket
+        logger.info(f"Rate limit reached for {model}, waiting {wait:.1f}s")
+        await asyncio.sleep(_jitter(wait))
+
+
+def reconcile(ticket, result):
+    """Correct the limiter with the usage reported on a finished call"""
+    if ticket is None:
+        return
+    actual = usage_total_tokens(result)
+    if actual is not None:
+        get_rate_limiter().reconcile(ticket, actual)
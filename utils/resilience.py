@@ -0,0 +1,201 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+import openai
+
+logger = logging.getLogger(__name__)
+
+# Retries for transient API failures (connection errors, timeouts, 408/409/429
+# and 5xx responses), with exponential backoff and full jitter. The SDK clients
+# are created with max_retries=0 so these are the only retries.
+LLM_RETRY_ATTEMPTS = int(os.getenv("LLM_RETRY_ATTEMPTS", "4"))
+LLM_RETRY_BASE_DELAY_SECONDS = float(os.getenv("LLM_RETRY_BASE_DELAY_SECONDS", "1"))
+LLM_RETRY_MAX_DELAY_SECONDS = float(os.getenv("LLM_RETRY_MAX_DELAY_SECONDS", "60"))
+
+# Per-model circuit breaker: after this many consecutive outage failures (5xx,
+# connection errors, timeouts) calls to the model fail fast until the reset
+# period has passed, then a single trial call decides whether it closes again
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "60"))
+
+_RETRYABLE_STATUSES = {408, 409, 429}
+
+
+class CircuitOpenError(RuntimeError):
+    """A model's circuit breaker is open, so the call was not attempted"""
+
+
+def _api_error(exc):
+    """The API error behind exc; instructor re-raises provider errors as the cause of its own exception"""
+    seen = 0
+    while exc is not None and seen < 5:
+        if isinstance(exc, openai.APIConnectionError) or getattr(exc, "status_code", None) is not None:
+            return exc
+        exc, seen = exc.__cause__, seen + 1
+    return None
+
+
+def _status(exc):
+    return getattr(_api_error(exc), "status_code", None)
+
+
+def is_outage(exc):
+    """Whether an error suggests the model is down rather than that the request was bad"""
+    status = _status(exc)
+    return isinstance(_api_error(exc), openai.APIConnectionError) or (status is not None and status >= 500)
+
+
+def is_retryable(exc):
+    """Whether a failed call may succeed if repeated"""
+    return is_outage(exc) or _status(exc) in _RETRYABLE_STATUSES
+
+
+def _not_accepted(exc):
+    # The server answered with a status that means it did not act on the
+    # request. A timeout or dropped connection leaves that unknown.
+    return _status(exc) in _RETRYABLE_STATUSES or _status(exc) == 503
+
+
+def _retry_delay(exc, attempt):
+    """Seconds to wait before the next attempt: the server's Retry-After if given, else full-jitter backoff"""
+    headers = getattr(getattr(_api_error(exc), "response", None), "headers", None) or {}
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+        try:
+            return min(float(headers[header]) * scale, LLM_RETRY_MAX_DELAY_SECONDS)
+        except (KeyError, TypeError, ValueError):
+            continue
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY_SECONDS, LLM_RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Closed -> open after repeated outage failures -> half-open trial call -> closed or open again"""
+
+    def __init__(self, model, failure_threshold=LLM_BREAKER_FAILURE_THRESHOLD, reset_seconds=LLM_BREAKER_RESET_SECONDS):
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go ahead"""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.reset_seconds - time.monotonic()
+            if remaining > 0 or self.trial_in_flight:
+                raise CircuitOpenError(f"Circuit open for {self.model} after {self.failures} consecutive failures; retry in {max(remaining, 0):.0f}s")
+            self.trial_in_flight = True
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info(f"Circuit closed for {self.model}")
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def abandon_trial(self):
+        """Release the trial slot of a call that was cancelled before it finished"""
+        with self._lock:
+            self.trial_in_flight = False
+
+    def record_failure(self, exc):
+        with self._lock:
+            if not is_outage(exc):
+                # The model answered (e.g. a 400 or 429), so it is up
+                self.failures = 0
+                self.opened_at = None
+                self.trial_in_flight = False
+                return
+            self.failures += 1
+            if self.trial_in_flight or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.trial_in_flight:
+                    logger.warning(f"Circuit opened for {self.model} after {self.failures} consecutive failures: {exc}")
+                self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(model):
+    """The process-wide circuit breaker for a model, or None for calls not tied to one"""
+    if not model:
+        return None
+    with _breakers_lock:
+        if model not in _breakers:
+            _breakers[model] = CircuitBreaker(model)
+        return _breakers[model]
+
+
+def _should_retry(exc, attempt, idempotent):
+    if attempt + 1 >= LLM_RETRY_ATTEMPTS or not is_retryable(exc):
+        return False
+    # Repeating a call that creates something server-side (a background
+    # response, a batch) is only safe if the first attempt was refused
+    return idempotent or _not_accepted(exc)
+
+
+def call(model, fn, /, *args, idempotent=True, **kwargs):
+    """Call fn with retries and model's circuit breaker; idempotent=False retries only refused requests"""
+    breaker = get_breaker(model)
+    attempt = 0
+    while True:
+        if breaker:
+            breaker.before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if breaker:
+                breaker.record_failure(e)
+            # Once the breaker has opened, give up now rather than wait for a refused retry
+            if not _should_retry(e, attempt, idempotent) or (breaker and breaker.is_open):
+                raise
+            delay = _retry_delay(e, attempt)
+            logger.warning(f"Model call to {model or 'API'} failed ({e}); retry {attempt + 1}/{LLM_RETRY_ATTEMPTS - 1} in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+            continue
+        if breaker:
+            breaker.record_success()
+        return result
+
+
+async def acall(model, fn, /, *args, idempotent=True, **kwargs):
+    """Async variant of call for coroutine functions"""
+    breaker = get_breaker(model)
+    attempt = 0
+    while True:
+        if breaker:
+            breaker.before_call()
+        try:
+            result = await fn(*args, **kwargs)
+        except asyncio.CancelledError:
+            if breaker:
+                breaker.abandon_trial()
+            raise
+        except Exception as e:
+            if breaker:
+                breaker.record_failure(e)
+            # Once the breaker has opened, give up now rather than wait for a refused retry
+            if not _should_retry(e, attempt, idempotent) or (breaker and breaker.is_open):
+                raise
+            delay = _retry_delay(e, attempt)
+            logger.warning(f"Model call to {model or 'API'} failed ({e}); retry {attempt + 1}/{LLM_RETRY_ATTEMPTS - 1} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        if breaker:
+            breaker.record_success()
+        return result
@@ -0,0 +1,116 @@
+import os
+import json
+import hashlib
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_agent_seconds(value):
+    """Parse "agent_a=3600,agent_b=60" into {"agent_a": 3600, "agent_b": 60}"""
+    overrides = {}
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        name, seconds = item.split("=", 1)
+        try:
+            overrides[name.strip()] = int(seconds)
+        except ValueError:
+            logger.warning(f"Ignoring invalid cache override: {item}")
+    return overrides
+
+
+CACHE_ENABLED = os.getenv("AGENT_CACHE_ENABLED", "true").strip().lower() not in ("0", "false", "no")
+
+# How long an entry is kept before MongoDB's TTL monitor evicts it
+CACHE_TTL_SECONDS = int(os.getenv("AGENT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# Agents that always call the model, e.g. AGENT_CACHE_DISABLED_AGENTS=cashflow_refinement
+CACHE_DISABLED_AGENTS = {
+    name.strip() for name in os.getenv("AGENT_CACHE_DISABLED_AGENTS", "").split(",") if name.strip()
+}
+
+# Per-agent freshness: entries older than this are ignored even if not yet evicted.
+# Web research on competitors goes stale faster than analysis of our own data.
+CACHE_MAX_AGE_SECONDS = {
+    "competitive_analysis": 24 * 3600,
+    **_parse_agent_seconds(os.getenv("AGENT_CACHE_MAX_AGE")),
+}
+
+# Request options that change how a response is delivered, not what it contains
+_TRANSPORT_KEYS = {"background", "stream", "timeout", "extra_headers", "prompt_cache_key"}
+
+
+def _canonical(value):
+    if isinstance(value, type) and hasattr(value, "model_json_schema"):
+        return {"__schema__": value.__name__, "schema": value.model_json_schema()}
+    if isinstance(value, dict):
+        return {str(key): _canonical(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    return value
+
+
+def request_fingerprint(agent_name, request):
+    """Content address of a model request: agent, model, instructions, input and tool config"""
+    payload = {
+        "agent": agent_name,
+        "request": _canonical({key: value for key, value in request.items() if key not in _TRANSPORT_KEYS}),
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def set_cache_enabled(enabled):
+    """Turn the response cache on or off for this process (e.g. from --no-cache)"""
+    global CACHE_ENABLED
+    CACHE_ENABLED = bool(enabled)
+
+
+def cache_key_for(agent_name, request):
+    """Return the cache key for a request, or None if caching is off for this agent"""
+    if not CACHE_ENABLED or not agent_name or agent_name in CACHE_DISABLED_AGENTS:
+        return None
+    return request_fingerprint(agent_name, request)
+
+
+def get_cached(cache_key, agent_name):
+    """Return the cached payload for cache_key, or None on a miss or stale entry"""
+    from datastore.models import AgentResponseCache
+
+    try:
+        entry = AgentResponseCache.objects(cache_key=cache_key).first()
+    except Exception as e:
+        logger.warning(f"Response cache lookup failed for {agent_name}: {e}")
+        return None
+    if entry is None:
+        return None
+
+    now = datetime.utcnow()
+    if entry.expires_at and entry.expires_at <= now:
+        return None
+    max_age = CACHE_MAX_AGE_SECONDS.get(agent_name)
+    if max_age is not None and entry.created_at and entry.created_at < now - timedelta(seconds=max_age):
+        return None
+
+    logger.info(f"Response cache hit for {agent_name} ({cache_key[:12]})")
+    return json.loads(entry.response)
+
+
+def put_cached(cache_key, agent_name, model, payload):
+    """Store a response payload under cache_key, replacing any previous entry"""
+    from datastore.models import AgentResponseCache
+
+    now = datetime.utcnow()
+    try:
+        AgentResponseCache.objects(cache_key=cache_key).update_one(
+            upsert=True,
+            set__agent_name=agent_name,
+            set__model=model,
+            set__response=json.dumps(payload, default=str),
+            set__created_at=now,
+            set__expires_at=now + timedelta(seconds=CACHE_TTL_SECONDS),
+        )
+    except Exception as e:
+        logger.warning(f"Response cache write failed for {agent_name}: {e}")
@@ -0,0 +1,96 @@
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Routing profiles: how each agent's model requests are adjusted before they
+# are sent. A profile may set
+#   models          - replacement models, keyed by the model the agent asks for
+#   model           - one model for every request (usually set per agent)
+#   reasoning_effort - for requests that already ask for reasoning
+#   max_tool_calls  - for Responses API requests that use tools
+# and an "agents" map with the same settings per agent name, which take
+# precedence over the profile-wide ones. "standard" leaves every request as
+# the agent builds it.
+ROUTING_PROFILES = {
+    "standard": {},
+    "fast": {
+        "models": {
+            "o3-deep-research": "o4-mini-deep-research",
+            "gpt-5": "gpt-5-mini",
+            "gpt-4o": "gpt-4o-mini",
+        },
+        "reasoning_effort": "low",
+        "max_tool_calls": 8,
+    },
+    "thorough": {
+        "reasoning_effort": "high",
+        "agents": {
+            "segmentwise_roi": {"max_tool_calls": 20},
+            "pricing_analysis": {"max_tool_calls": 20},
+            "experimental_pricing_recommendation": {"max_tool_calls": 25},
+        },
+    },
+}
+
+
+def _load_profiles(path):
+    """Profiles from a JSON file of {profile: settings}, merged over the built-in ones"""
+    if not path:
+        return {}
+    try:
+        with open(path) as f:
+            profiles = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring routing profiles file {path}: {e}")
+        return {}
+    if not isinstance(profiles, dict):
+        logger.warning(f"Ignoring routing profiles file {path}: expected a JSON object of profiles")
+        return {}
+    return profiles
+
+
+ROUTING_PROFILES.update(_load_profiles(os.getenv("LLM_ROUTING_PROFILES_FILE")))
+
+ROUTING_PROFILE = os.getenv("LLM_ROUTING_PROFILE", "standard").strip().lower()
+
+
+def set_profile(name):
+    """Route this process's model calls through a named profile (e.g. from --profile)"""
+    global ROUTING_PROFILE
+    if name not in ROUTING_PROFILES:
+        raise ValueError(f"Unknown routing profile '{name}' (available: {', '.join(sorted(ROUTING_PROFILES))})")
+    ROUTING_PROFILE = name
+
+
+def agent_settings(agent_name):
+    """The current profile's settings for one agent, with its per-agent overrides applied"""
+    profile = ROUTING_PROFILES.get(ROUTING_PROFILE)
+    if profile is None:
+        logger.warning(f"Unknown routing profile '{ROUTING_PROFILE}'; using the agents' own models")
+        return {}
+    settings = {key: value for key, value in profile.items() if key != "agents"}
+    overrides = (profile.get("agents") or {}).get(agent_name) or {}
+    settings["models"] = {**(settings.get("models") or {}), **(overrides.get("models") or {})}
+    settings.update({key: value for key, value in overrides.items() if key != "models"})
+    return settings
+
+
+def route(agent_name, kind, request):
+    """Apply the current profile to one wrapper request; returns a new request dict"""
+    settings = agent_settings(agent_name)
+    if not any(settings.values()):
+        return request
+    request = dict(request)
+    model = request.get("model")
+    request["model"] = settings.get("model") or settings["models"].get(model, model)
+    if kind != "response":
+        # Structured completions only swap models
+        return request
+    effort = settings.get("reasoning_effort")
+    if effort and request.get("reasoning"):
+        request["reasoning"] = {**request["reasoning"], "effort": effort}
+    if settings.get("max_tool_calls") and request.get("tools"):
+        request["max_tool_calls"] = settings["max_tool_calls"]
+    return request
@@ -0,0 +1,77 @@
+import contextvars
+from collections import namedtuple
+
+# The orchestration step the current task is running, as seen by the model
+# call wrappers: a dict of request fingerprint -> background response id that
+# is persisted with the step, a coroutine function that checkpoints it, a
+# coroutine function that receives streamed output text as it arrives, a dict
+# of request fingerprint -> Batch API batch id (also persisted), and a function
+# that receives the usage record (tokens, latency, cost) of every model call.
+_StepBinding = namedtuple("_StepBinding", ["background_jobs", "on_change", "on_partial", "batch_jobs", "on_usage"])
+_current_step = contextvars.ContextVar("current_step", default=None)
+
+
+def bind_step(background_jobs, on_change=None, on_partial=None, batch_jobs=None, on_usage=None):
+    """Route background response ids, batch ids, streamed text and token usage from this task (and tasks it spawns) to the step"""
+    return _current_step.set(_StepBinding(background_jobs, on_change, on_partial, batch_jobs if batch_jobs is not None else {}, on_usage))
+
+
+def get_partial_handler():
+    """Return the coroutine function that takes streamed text deltas for the current step, if any"""
+    binding = _current_step.get()
+    return binding.on_partial if binding is not None else None
+
+
+def record_usage(call):
+    """Report the usage record of one finished model call (see utils.usage.call_usage) to the step"""
+    binding = _current_step.get()
+    if binding is not None and binding.on_usage is not None:
+        binding.on_usage(call)
+
+
+def find_background_job(fingerprint):
+    """Return the response id previously submitted for this request in the current step, if any"""
+    binding = _current_step.get()
+    if binding is None:
+        return None
+    return binding.background_jobs.get(fingerprint)
+
+
+def record_background_job(fingerprint, response_id):
+    """Remember a submitted background response; returns the step's checkpoint callback, if any"""
+    binding = _current_step.get()
+    if binding is None:
+        return None
+    binding.background_jobs[fingerprint] = response_id
+    return binding.on_change
+
+
+def forget_background_job(fingerprint):
+    """Drop a background response that failed or was cancelled so the next attempt resubmits"""
+    binding = _current_step.get()
+    if binding is not None:
+        binding.background_jobs.pop(fingerprint, None)
+
+
+def find_batch_job(fingerprint):
+    """Return the id of the batch this request was previously submitted in for the current step, if any"""
+    binding = _current_step.get()
+    if binding is None:
+        return None
+    return binding.batch_jobs.get(fingerprint)
+
+
+def record_batch_job(fingerprint, batch_id):
+    """Remember the batch a request was submitted in; returns the step's checkpoint callback, if any"""
+    binding = _current_step.get()
+    if binding is None:
+        return None
+    binding.batch_jobs[fingerprint] = batch_id
+    return binding.on_change
+
+
+def forget_batch_job(fingerprint):
+    """Drop a batched request that failed or expired so the next attempt resubmits"""
+    binding = _current_step.get()
+    if binding is not None:
+        binding.batch_jobs.pop(fingerprint, None)
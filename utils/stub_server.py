@@ -0,0 +1,204 @@
+"""
+Local stand-in for the OpenAI API, for running the whole pipeline offline.
+
+    python -m utils.stub_server --port 8765
+    LLM_TRANSPORT=stub python main.py --orchestrator --product-id <id>
+
+Serves /v1/responses (create, retrieve, cancel) and /v1/chat/completions.
+Responses complete immediately (background requests included) with a short
+deterministic text. Structured completions answer the requested tool call or
+JSON schema with a minimal valid instance, so instructor parsing succeeds.
+"""
+import json
+import time
+import uuid
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STUB_TEXT = """Stub analysis for {model} (request {digest}).
+
+Recommended plan: Pro at $49 per month with a minimum of 5 units.
+Projected revenue of $120,000 in the first year at a 62% margin, 1,200 customers and 4% monthly churn.
+"""
+
+_responses = {}
+_lock = threading.Lock()
+
+
+def _digest(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:12]
+
+
+def _resolve(schema, definitions):
+    while "$ref" in schema:
+        schema = definitions.get(schema["$ref"].split("/")[-1], {})
+    return schema
+
+
+def minimal_instance(schema, definitions=None):
+    """Build the smallest value that validates against a JSON schema"""
+    definitions = definitions if definitions is not None else schema.get("$defs", schema.get("definitions", {}))
+    schema = _resolve(schema, definitions)
+    if "enum" in schema:
+        return schema["enum"][0]
+    if "const" in schema:
+        return schema["const"]
+    for key in ("anyOf", "oneOf", "allOf"):
+        if key in schema:
+            options = [option for option in schema[key] if _resolve(option, definitions).get("type") != "null"]
+            return minimal_instance(options[0] if options else schema[key][0], definitions)
+    if "default" in schema:
+        return schema["default"]
+    kind = schema.get("type", "object")
+    if isinstance(kind, list):
+        kind = next((item for item in kind if item != "null"), "null")
+    if kind == "object":
+        return {name: minimal_instance(prop, definitions) for name, prop in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [minimal_instance(schema.get("items", {}), definitions) for _ in range(schema.get("minItems", 0))]
+    if kind == "string":
+        return "stub"
+    if kind == "integer":
+        return 1
+    if kind == "number":
+        return 1.0
+    if kind == "boolean":
+        return False
+    return None
+
+
+def build_response(request):
+    model = request.get("model", "stub")
+    text_format = (request.get("text") or {}).get("format") or {}
+    if text_format.get("type") == "json_schema":
+        text = json.dumps(minimal_instance(text_format.get("schema", {})))
+    else:
+        text = STUB_TEXT.format(model=model, digest=_digest(request))
+    input_tokens = len(json.dumps(request.get("input", ""))) // 4
+    output_tokens = len(text) // 4
+    return {
+        "id": f"resp_{uuid.uuid4().hex}",
+        "object": "response",
+        "created_at": int(time.time()),
+        "model": model,
+        "status": "completed",
+        "background": bool(request.get("background")),
+        "output": [{
+            "type": "message",
+            "id": f"msg_{uuid.uuid4().hex}",
+            "role": "assistant",
+            "status": "completed",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }],
+        "parallel_tool_calls": True,
+        "tool_choice": "auto",
+        "tools": [],
+        "usage": {
+            "input_tokens": input_tokens,
+            "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens": output_tokens,
+            "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": input_tokens + output_tokens,
+        },
+    }
+
+
+def build_chat_completion(request):
+    model = request.get("model", "stub")
+    message = {"role": "assistant", "content": None}
+    finish_reason = "stop"
+    tools = request.get("tools") or []
+    response_format = request.get("response_format") or {}
+    if tools:
+        function = tools[0].get("function", {})
+        arguments = minimal_instance(function.get("parameters", {}))
+        message["tool_calls"] = [{
+            "id": f"call_{uuid.uuid4().hex[:24]}",
+            "type": "function",
+            "function": {"name": function.get("name", "stub"), "arguments": json.dumps(arguments)},
+        }]
+        finish_reason = "tool_calls"
+    elif response_format.get("type") == "json_schema":
+        message["content"] = json.dumps(minimal_instance(response_format.get("json_schema", {}).get("schema", {})))
+    else:
+        message["content"] = STUB_TEXT.format(model=model, digest=_digest(request))
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20},
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real API, so clients can reuse their connections
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_POST(self):
+        path = self.path.split("?")[0].rstrip("/")
+        request = self._read_json()
+        if self.latency:
+            time.sleep(self.latency)
+        if path.endswith("/chat/completions"):
+            return self._send(200, build_chat_completion(request))
+        if path.endswith("/responses"):
+            response = build_response(request)
+            with _lock:
+                _responses[response["id"]] = response
+            return self._send(200, response)
+        if path.endswith("/cancel"):
+            response_id = path.split("/")[-2]
+            with _lock:
+                response = _responses.get(response_id)
+            if response is None:
+                return self._send(404, {"error": {"message": f"No response {response_id}"}})
+            return self._send(200, response)
+        self._send(404, {"error": {"message": f"Unknown endpoint {self.path}"}})
+
+    def do_GET(self):
+        response_id = self.path.split("?")[0].rstrip("/").split("/")[-1]
+        with _lock:
+            response = _responses.get(response_id)
+        if response is None:
+            return self._send(404, {"error": {"message": f"No response {response_id}"}})
+        self._send(200, response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stub of the OpenAI API for offline pipeline runs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before answering each request")
+    args = parser.parse_args()
+
+    StubHandler.latency = args.latency
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    print(f"Stub OpenAI API listening on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
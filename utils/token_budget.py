@@ -0,0 +1,125 @@
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Rough size of a token in characters, used when tiktoken or its encoding
+# files are unavailable (the encodings are downloaded on first use)
+CHARS_PER_TOKEN = 4
+# gpt-5, gpt-4o and the o-series all tokenize with o200k_base
+DEFAULT_ENCODING = "o200k_base"
+TRUNCATION_NOTE = "\n... (truncated to fit the token budget)\n"
+
+# One prompt section: its title, its renderings from most to least detailed,
+# and its weight in the budget split. A rendering is either a string or a
+# function that takes the section's token allowance and returns a string, or
+# None when it cannot fit in that allowance (so a renderer can bail out on a
+# row-count estimate without building a table it would throw away).
+Section = namedtuple("Section", ["title", "candidates", "weight"])
+
+_encodings = {}
+
+
+def _encoding(model=None):
+    """The tiktoken encoding for a model, or None to fall back to the character estimate"""
+    key = model or DEFAULT_ENCODING
+    if key not in _encodings:
+        try:
+            import tiktoken
+            try:
+                _encodings[key] = tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding(DEFAULT_ENCODING)
+            except KeyError:
+                _encodings[key] = tiktoken.get_encoding(DEFAULT_ENCODING)
+        except Exception as e:
+            # Budgets built on the estimate can be off by a wide margin, so say so loudly
+            logger.warning(
+                f"tiktoken encoding for {key} unavailable ({e}); token budgets will be estimated at "
+                f"{CHARS_PER_TOKEN} characters per token and may be wrong. Pre-download the encodings "
+                f"into TIKTOKEN_CACHE_DIR on hosts without internet access"
+            )
+            _encodings[key] = None
+    return _encodings[key]
+
+
+def count_tokens(text, model=None):
+    """Number of tokens in text for the given model"""
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text, max_tokens, model=None):
+    """Cut text down to at most max_tokens tokens, marking the cut"""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    keep = max(max_tokens - count_tokens(TRUNCATION_NOTE, model), 0)
+    encoding = _encoding(model)
+    if encoding is None:
+        head = text[:keep * CHARS_PER_TOKEN]
+    else:
+        head = encoding.decode(encoding.encode(text, disallowed_special=())[:keep])
+    # Cut at a line boundary so a table is not left with half a row
+    if "\n" in head:
+        head = head[:head.rfind("\n")]
+    return head + TRUNCATION_NOTE
+
+
+def _render(candidate, max_tokens, model):
+    text = candidate(max_tokens) if callable(candidate) else candidate
+    if text is None:
+        return None, None
+    return text, count_tokens(text, model)
+
+
+def fit_sections(sections, budget, model=None):
+    """Choose a rendering for each section so that together they fit in budget tokens
+
+    The budget is split by weight. A section whose most detailed rendering
+    needs less than its share keeps it and gives the rest back to the
+    others, repeating until no section releases more. Each remaining section
+    then gets the most detailed rendering that fits its share, or its most
+    compact one truncated to the share. Returns (title, text) pairs in the
+    input order, ready for compose_input.
+    """
+    chosen = {}
+    pending = [i for i, section in enumerate(sections) if section.candidates]
+    remaining = budget
+    # Headings and spacing added around each section by compose_input
+    overhead = {i: count_tokens(f"## {sections[i].title}\n\n", model) for i in pending}
+
+    while pending:
+        total_weight = sum(sections[i].weight for i in pending) or 1
+        fits = []
+        for i in pending:
+            share = remaining * sections[i].weight / total_weight - overhead[i]
+            text, tokens = _render(sections[i].candidates[0], max(int(share), 0), model)
+            if text is not None and tokens <= share:
+                fits.append((i, text, tokens))
+        if not fits:
+            break
+        for i, text, tokens in fits:
+            chosen[i] = text
+            remaining -= tokens + overhead[i]
+            pending.remove(i)
+
+    total_weight = sum(sections[i].weight for i in pending) or 1
+    for i in pending:
+        share = max(int(remaining * sections[i].weight / total_weight - overhead[i]), 0)
+        for candidate in sections[i].candidates[1:]:
+            text, tokens = _render(candidate, share, model)
+            if text is not None and tokens <= share:
+                chosen[i] = text
+                break
+        else:
+            text = None
+            for candidate in reversed(sections[i].candidates):
+                text, _ = _render(candidate, share, model)
+                if text is not None:
+                    break
+            chosen[i] = truncate_to_tokens(text, share, model) if text else None
+            logger.warning(f"Section '{sections[i].title}' truncated to {share} tokens")
+
+    return [(section.title, chosen.get(i)) for i, section in enumerate(sections)]
@@ -0,0 +1,133 @@
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_model_prices(value):
+    """Parse "gpt-5=1.25/0.125/10,gpt-4o=2.5/1.25/10" into {model: (input, cached input, output)}"""
+    prices = {}
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        model, rates = item.split("=", 1)
+        try:
+            input_price, cached_price, output_price = (float(rate) for rate in rates.split("/"))
+        except ValueError:
+            logger.warning(f"Ignoring invalid model price: {item}")
+            continue
+        prices[model.strip()] = (input_price, cached_price, output_price)
+    return prices
+
+
+# USD per million tokens: (input, cached input, output). Reasoning tokens are
+# billed as output. Tool calls are counted but not priced.
+MODEL_PRICES = {
+    "gpt-5": (1.25, 0.125, 10.0),
+    "o3-deep-research": (10.0, 2.5, 40.0),
+    "gpt-4o": (2.5, 1.25, 10.0),
+    # Models used by the "fast" routing profile
+    "gpt-5-mini": (0.25, 0.025, 2.0),
+    "o4-mini-deep-research": (2.0, 0.5, 8.0),
+    "gpt-4o-mini": (0.15, 0.075, 0.6),
+    **_parse_model_prices(os.getenv("LLM_PRICES")),
+}
+
+# Batch API requests are billed at half the synchronous price
+BATCH_DISCOUNT = 0.5
+
+
+def model_prices(model):
+    """Prices for a model, matching dated snapshots (gpt-5-2025-08-07) to their base name"""
+    if model in MODEL_PRICES:
+        return MODEL_PRICES[model]
+    matches = [name for name in MODEL_PRICES if (model or "").startswith(name)]
+    return MODEL_PRICES[max(matches, key=len)] if matches else None
+
+
+def estimate_cost(model, input_tokens, cached_tokens, output_tokens, batched=False):
+    """Cost of one call in USD, or None if the model has no price"""
+    prices = model_prices(model)
+    if prices is None:
+        return None
+    input_price, cached_price, output_price = prices
+    cost = ((input_tokens - cached_tokens) * input_price + cached_tokens * cached_price + output_tokens * output_price) / 1_000_000
+    return round(cost * (BATCH_DISCOUNT if batched else 1), 6)
+
+
+def _usage_of(result):
+    usage = getattr(result, "usage", None)
+    if usage is None:
+        usage = getattr(getattr(result, "_raw_response", None), "usage", None)
+    return usage
+
+
+def count_tool_calls(result):
+    """Tool calls made while producing a response (web/file search, code interpreter, functions)"""
+    output = getattr(result, "output", None)
+    if output is not None:
+        return sum(1 for item in output if str(getattr(item, "type", "")).endswith("_call"))
+    raw = getattr(result, "_raw_response", result)
+    count = 0
+    for choice in getattr(raw, "choices", None) or []:
+        count += len(getattr(getattr(choice, "message", None), "tool_calls", None) or [])
+    return count
+
+
+def call_usage(agent_name, kind, model, result, latency_seconds, batched=False):
+    """Token counts, tool calls, latency and cost of one finished model call"""
+    usage = _usage_of(result)
+    # Responses API usage reports input/output tokens, chat completions prompt/completion tokens
+    input_tokens = getattr(usage, "input_tokens", None) or getattr(usage, "prompt_tokens", None) or 0
+    output_tokens = getattr(usage, "output_tokens", None) or getattr(usage, "completion_tokens", None) or 0
+    input_details = getattr(usage, "input_tokens_details", None) or getattr(usage, "prompt_tokens_details", None)
+    output_details = getattr(usage, "output_tokens_details", None) or getattr(usage, "completion_tokens_details", None)
+    cached_tokens = getattr(input_details, "cached_tokens", None) or 0
+    reasoning_tokens = getattr(output_details, "reasoning_tokens", None) or 0
+    return {
+        "agent_name": agent_name,
+        "kind": kind,
+        "model": model,
+        "input_tokens": input_tokens,
+        "cached_tokens": cached_tokens,
+        "output_tokens": output_tokens,
+        "reasoning_tokens": reasoning_tokens,
+        "tool_calls": count_tool_calls(result),
+        "latency_seconds": round(latency_seconds, 3),
+        "batched": batched,
+        "cost_usd": estimate_cost(model, input_tokens, cached_tokens, output_tokens, batched),
+    }
+
+
+def summarize_calls(calls):
+    """Totals per agent, most expensive first, plus an overall "total" row"""
+    fields = ("input_tokens", "cached_tokens", "output_tokens", "reasoning_tokens", "tool_calls", "latency_seconds", "cost_usd")
+    rows = {}
+    for call in calls:
+        call = call if isinstance(call, dict) else call.model_dump()
+        for name in (call["agent_name"] or "unnamed", "total"):
+            row = rows.setdefault(name, {"agent_name": name, "calls": 0, **{field: 0 for field in fields}})
+            row["calls"] += 1
+            for field in fields:
+                row[field] += call.get(field) or 0
+    for row in rows.values():
+        row["latency_seconds"] = round(row["latency_seconds"], 3)
+        row["cost_usd"] = round(row["cost_usd"], 6)
+    total = rows.pop("total", None)
+    summary = sorted(rows.values(), key=lambda row: (row["cost_usd"], row["latency_seconds"]), reverse=True)
+    return summary + ([total] if total else [])
+
+
+def format_usage_breakdown(calls):
+    """Render summarize_calls() as a markdown table"""
+    lines = [
+        "| Agent | Calls | Input | Cached | Output | Reasoning | Tool calls | Latency | Cost (USD) |",
+        "|---|---|---|---|---|---|---|---|---|",
+    ]
+    for row in summarize_calls(calls):
+        cached = f"{row['cached_tokens']:,} ({row['cached_tokens'] / row['input_tokens']:.0%})" if row["input_tokens"] else "0"
+        lines.append(
+            f"| {row['agent_name']} | {row['calls']} | {row['input_tokens']:,} | {cached} | {row['output_tokens']:,} | "
+            f"{row['reasoning_tokens']:,} | {row['tool_calls']} | {row['latency_seconds']:.1f}s | ${row['cost_usd']:.4f} |"
+        )
+    return "\n".join(lines)